@@ -2,7 +2,6 @@
 # It stores the logs in a sqlite database
 
 import argparse
-import requests
 import datetime
 import os
 import sys
@@ -12,6 +11,7 @@ import urllib
 # Project imports
 sys.path.insert(0, os.path.normpath('..'))
 import log_manager
+import peer_client
 import util
 
 class Aggregator:
@@ -35,7 +35,7 @@ class Aggregator:
       print "Retrieving logs from server <http://" + server + "> for date: " + date + "..."
       url = 'http://%s/logs?%s' % (server, urllib.urlencode({ 'date': date }))
     print url
-    r = requests.get(url)
+    r = peer_client.get(url)
     if r.status_code == 200:
       return r.text
     else:
@@ -114,12 +114,24 @@ class Aggregator:
     self.update_aggregated_logs('update')
     return self.log_mgr.get_redirects(start_timestamp, end_timestamp)
 
+  # Retrive all log entries aggregated after the entry with the given rowid
+  #
+  # params:
+  #   rowid: the rowid of the last entry already processed
+  # return val:
+  #   list of tuples, each starting with the rowid of the entry
+  def get_log_entries_since(self, rowid):
+    # to get latest logs, update first
+    self.update_aggregated_logs('update')
+    return self.log_mgr.get_log_entries_since(rowid)
+
 if __name__ == '__main__':
   # Parse arguments for app
   parser = argparse.ArgumentParser(description='Aggregator CLI for EECS591.')
   parser.add_argument('--update', action='store_true', help='Aggregate logs, beginning from timestamp of last log added to aggregated logs')
   parser.add_argument('--time', help='Specify start date in Unix timestamp format.')
   parser.add_argument('--date', help='Specify start date in YYYY-MM-DD format.')
+  parser.add_argument('--prefetch-locations', action='store_true', help='Look up the locations of all clients missing from the ip location cache after aggregating')
 
   args = parser.parse_args()
   aggregator = Aggregator()
@@ -131,3 +143,5 @@ if __name__ == '__main__':
     aggregator.update_aggregated_logs(aggregator.date_to_timestamp(args.date))
   else:
     aggregator.update_aggregated_logs()
+  if args.prefetch_locations is True:
+    util.ip_location_cache().prefetch(aggregator.log_mgr.get_unique_sources())
@@ -19,7 +19,8 @@ class LogManager:
       self.conn.executescript(initialization_file.read())
     self.cursor = self.conn.cursor()
 
-  # Adds log entry into database
+  # Adds log entry into database. Entries that are already stored are kept as they are, so that
+  # re-fetching a day of logs does not give them new rowids (see get_entries_since).
   #
   # params:
   #   log_entry: tab-separated column values for log
@@ -29,7 +30,7 @@ class LogManager:
       for i, col in enumerate(log_columns):
         if col == 'null':
           log_columns[i] = None
-      self.cursor.execute('INSERT OR REPLACE INTO Log VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+      self.cursor.execute('INSERT OR IGNORE INTO Log VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
                           (log_columns[0], log_columns[1], log_columns[2], log_columns[3],
                            log_columns[4], log_columns[5], log_columns[6], log_columns[7]))
       self.conn.commit()
@@ -85,6 +86,14 @@ class LogManager:
       'WHERE uuid = ? AND request_type = "READ" AND status = 200 AND timestamp >= ? AND timestamp <= ? GROUP BY source_entity', (uuid, self.start_time, self.end_time))
     return self.cursor.fetchall()
 
+  # Retrieve successful log read entries of every uuid in one scan, grouped by uuid and source_entity.
+  # Rows are ordered by uuid and then source_entity, the order get_reads_grouped_by_source returns for each uuid.
+  def get_reads_grouped_by_uuid_and_source(self):
+    self.cursor.execute('SELECT uuid, source_entity, COUNT(source_entity) AS weight FROM Log '
+      'WHERE request_type = "READ" AND status = 200 AND timestamp >= ? AND timestamp <= ? '
+      'GROUP BY uuid, source_entity ORDER BY uuid, source_entity', (self.start_time, self.end_time))
+    return self.cursor.fetchall()
+
   # Retrieve all distinct destination entities.
   def get_unique_destinations(self):
     self.cursor.execute('SELECT DISTINCT destination_entity FROM Log WHERE request_type = "READ" AND timestamp >= ? AND timestamp <= ?', (self.start_time, self.end_time))
@@ -95,6 +104,11 @@ class LogManager:
       servers.append(server_tuple[0])
     return servers
 
+  # Retrieve all distinct source entities of reads, e.g. to prefetch their locations.
+  def get_unique_sources(self):
+    self.cursor.execute('SELECT DISTINCT source_entity FROM Log WHERE request_type = "READ" AND timestamp >= ? AND timestamp <= ?', (self.start_time, self.end_time))
+    return [ source_tuple[0] for source_tuple in self.cursor.fetchall() ]
+
   # Returns a count for unique uuids a uuid is interdependent with, and how many requests for each interdependent request are made
   def get_interdependency_grouped_by_uuid(self, uuid):
     self.cursor.execute(
@@ -106,6 +120,39 @@ class LogManager:
       "GROUP BY uuid", (uuid, self.start_time, self.end_time, uuid, self.start_time, self.end_time))
     return self.cursor.fetchall()
 
+  # Returns every interdependent (uuid, source_uuid) pair and how many requests were made for it, in one scan.
+  # The interdependencies of a uuid are the pairs it appears in on either side, as in get_interdependency_grouped_by_uuid.
+  def get_interdependencies(self):
+    self.cursor.execute('SELECT uuid, source_uuid, COUNT(*) FROM Log '
+      'WHERE source_uuid IS NOT null AND timestamp >= ? AND timestamp <= ? GROUP BY uuid, source_uuid', (self.start_time, self.end_time))
+    return self.cursor.fetchall()
+
+  # Retrieve the log entries added after the entry with the given rowid, oldest first. Not limited to the time window.
+  #
+  # params:
+  #   rowid: the rowid of the last entry already processed, 0 for all entries
+  # returns: list of (rowid, timestamp, uuid, source_entity, source_uuid, request_type, status)
+  def get_entries_since(self, rowid):
+    self.cursor.execute('SELECT rowid, timestamp, uuid, source_entity, source_uuid, request_type, status FROM Log WHERE rowid > ? ORDER BY rowid', (rowid,))
+    return self.cursor.fetchall()
+
+  # Retrieve the full log entries added after the entry with the given rowid, ordered by rowid.
+  #
+  # params:
+  #   rowid: the rowid of the last entry already processed, 0 for all entries
+  # returns: list of (rowid, timestamp, uuid, source_entity, source_uuid, destination_entity, request_type, status, response_size)
+  def get_log_entries_since(self, rowid):
+    self.cursor.execute('SELECT rowid, * FROM Log WHERE rowid > ? ORDER BY rowid', (rowid,))
+    return self.cursor.fetchall()
+
+  # Retrieve the rowid of the last entry added, 0 if there are none
+  def last_rowid(self):
+    self.cursor.execute('SELECT MAX(rowid) FROM Log')
+    result = self.cursor.fetchone()
+    if result is None or result[0] is None:
+      return 0
+    return result[0]
+
   # Retrieve all distinct uuids.
   #
   # params:
@@ -133,6 +180,13 @@ class LogManager:
 
     return request_count_result[0]
 
+  # Retrieve the number of successful reads of every uuid in one query.
+  #
+  # returns: dictionary mapping uuid -> read count, uuids without reads are left out
+  def successful_read_counts(self):
+    self.cursor.execute('SELECT uuid, count(*) FROM Log WHERE request_type = "READ" AND status = 200 AND timestamp >= ? AND timestamp <= ? GROUP BY uuid', (self.start_time, self.end_time))
+    return dict(self.cursor.fetchall())
+
   # Closes the connection to the database
   def __del__(self):
     self.conn.close()
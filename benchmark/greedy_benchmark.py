@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# Measures rounds of the greedy replication algorithm on synthetic demand: every content is read by a
+# few random clients and starts with just enough replicas, every client can be served by one or two
+# random servers, and every round checks all (content, client) perturbations and adds replicas.
+import argparse
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+# Project imports
+import greedy_algo
+
+# Greedy replication on generated demand, recording replicas instead of copying files.
+class SyntheticGreedyReplication(greedy_algo.GreedyReplication):
+
+  def __init__(self, num_contents, num_clients, num_servers, clients_per_content):
+    random.seed(591)
+    self.server_set = set([ '4.4.4.' + str(i) for i in range(num_servers) ])
+    self.client_set = set([ '5.5.%d.%d' % (i / 256, i % 256) for i in range(num_clients) ])
+    self.content_set = set([ 'file-' + str(i) for i in range(num_contents) ])
+    self.requests_per_replica = 3
+    self.batch_replicas = 0
+    servers = sorted(self.server_set)
+    self.client_servers = dict((a, frozenset(random.sample(servers, random.randint(1, 2)))) for a in self.client_set)
+
+    clients = sorted(self.client_set)
+    self.access_map = {}
+    self.replica_map = {}
+    for c in self.content_set:
+      self.access_map[c] = dict((a, random.randint(1, 5)) for a in random.sample(clients, clients_per_content))
+    self.update_demand()
+    for c in self.demand_map:
+      for group, demand in self.demand_map[c].iteritems():
+        self.record_replica(c, min(group), int(math.ceil(float(demand) / self.requests_per_replica)))
+
+  def replicate(self, content, source, dest):
+    self.record_replica(content, dest)
+
+  def replicate_batch(self, source, moves):
+    self.batch_replicas += len(moves)
+    for content, dest in moves:
+      self.record_replica(content, dest)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--contents', type=int, default=10000, help='the number of contents')
+  parser.add_argument('--clients', type=int, default=1000, help='the number of clients')
+  parser.add_argument('--servers', type=int, default=10, help='the number of servers')
+  parser.add_argument('--clients-per-content', type=int, default=5, help='the number of clients reading every content')
+  parser.add_argument('--rounds', type=int, default=10, help='the number of rounds to run')
+  args = parser.parse_args()
+
+  greedy = SyntheticGreedyReplication(args.contents, args.clients, args.servers, args.clients_per_content)
+  request_delta = greedy.requests_per_replica / 10.0
+
+  print '************************* Greedy replication rounds ****************************'
+  print str(args.contents) + ' contents, ' + str(args.clients) + ' clients, ' + str(args.servers) + ' servers'
+  for i in range(args.rounds):
+    start_time = time.time()
+    if not greedy.enough_replica_on_increase(request_delta):
+      greedy.add_replica(request_delta, 1)
+    elapsed = time.time() - start_time
+    print 'Round ' + str(i + 1) + ': ' + ('%.3f' % elapsed) + ' seconds'
+  print str(greedy.batch_replicas) + ' replicas added for starved contents'
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# Measures how many /read requests per second a single server process can answer and their tail latency:
+# first with a fresh metadata connection and a synchronous log write per request, then with the pooled
+# metadata backend, and finally with the buffered access logger on top.
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+# Project imports
+import logger
+import metadata_manager
+import server
+
+HOST = 'localhost:5000'
+FILE_SIZE = 1000
+
+# Creates the uploaded files and their metadata inside the working directory.
+#
+# params:
+#   num_files: the number of files to store on the server
+def populate(num_files):
+    os.makedirs(server.UPLOAD_FOLDER)
+    os.makedirs(server.LOG_DIRECTORY)
+    pool = metadata_manager.MetadataPool()
+    metadata = pool.acquire()
+    file_uuids = []
+    for i in range(num_files):
+        file_uuid = 'file-' + str(i)
+        with open(os.path.join(server.UPLOAD_FOLDER, file_uuid), 'wb') as upload:
+            upload.write(str(FILE_SIZE))
+        metadata.update_file_stored(file_uuid, HOST, FILE_SIZE)
+        file_uuids.append(file_uuid)
+    metadata.close()
+    pool.close()
+    return file_uuids
+
+# Issues the reads against the Flask app and returns the number of reads per second
+# and the 50th and 99th percentile latencies in milliseconds.
+#
+# params:
+#   file_uuids: the files to read, in round robin order
+#   num_reads: the number of reads to issue
+#   use_pool: whether the server uses the pooled metadata backend
+#   buffered_logging: whether the access log is written by the background writer
+def run_reads(file_uuids, num_reads, use_pool, buffered_logging):
+    server.app.config[server.USE_METADATA_POOL] = use_pool
+    logger.BUFFERED = buffered_logging
+    client = server.app.test_client()
+    latencies = []
+    start_time = time.time()
+    for i in range(num_reads):
+        file_uuid = file_uuids[i % len(file_uuids)]
+        request_start_time = time.time()
+        response = client.get('/read?uuid=%s&ip=5.5.5.1' % file_uuid)
+        latencies.append(time.time() - request_start_time)
+        if response.status_code != 200:
+            raise Exception('Read failed for ' + file_uuid + ' with status ' + str(response.status_code))
+    elapsed = time.time() - start_time
+    latencies.sort()
+    return (num_reads / elapsed, latencies[int(len(latencies) * 0.5)] * 1000, latencies[int(len(latencies) * 0.99)] * 1000)
+
+def print_result(name, result):
+    print name + ': ' + str(int(result[0])) + ' reads/sec, p50 latency: ' + ('%.3f' % result[1]) + ' ms, p99 latency: ' + \
+        ('%.3f' % result[2]) + ' ms'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=1000, help='the number of files stored on the server')
+    parser.add_argument('--reads', type=int, default=5000, help='the number of reads to issue per run')
+    args = parser.parse_args()
+
+    working_directory = tempfile.mkdtemp()
+    current_directory = os.getcwd()
+    os.chdir(working_directory)
+    # send_from_directory resolves the relative upload folder against the root path of the app
+    server.app.root_path = working_directory
+    try:
+        server.app.config['HOST'] = HOST
+        server.app.config[server.USE_DIST_REPLICATION] = None
+        file_uuids = populate(args.files)
+
+        per_request = run_reads(file_uuids, args.reads, False, False)
+        pooled = run_reads(file_uuids, args.reads, True, False)
+        buffered = run_reads(file_uuids, args.reads, True, True)
+        metadata_manager.flush()
+        logger.shutdown()
+
+        print '************************* /read throughput ****************************'
+        print_result('BEFORE (connection per request, synchronous log)', per_request)
+        print_result('AFTER (pooled metadata, synchronous log)', pooled)
+        print_result('AFTER (pooled metadata, buffered log)', buffered)
+    finally:
+        os.chdir(current_directory)
+        shutil.rmtree(working_directory)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# Compares the quality and runtime of the Volley capacity redistribution modes on the synthetic datasets.
+# The items of a dataset are copied many times, with readers sampled from the original item's reads,
+# and the servers are given just enough room for all the data so that the nearest server cannot take everything.
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'volley'))
+
+# Project imports
+import volley
+
+DATASET_DIRECTORY = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'dataset', 'synthetic')
+SERVER_PREFIX = '4.4.4.'
+DEFAULT_FILE_SIZE = 1000
+
+# Stands in for the aggregated log database, returning the generated reads.
+class SyntheticLogs:
+
+    def __init__(self, uuids, request_logs):
+        self.uuids = uuids
+        self.request_logs = request_logs
+
+    def get_unique_uuids(self):
+        return self.uuids
+
+    def get_reads_grouped_by_uuid_and_source(self):
+        return self.request_logs
+
+# Stands in for the ip location cache, returning the dataset locations.
+class SyntheticLocations:
+
+    def __init__(self, locations):
+        self.locations = locations
+
+    def get_lat_lon_from_ip(self, ip):
+        return self.locations.get(ip)
+
+    def get_many(self, ips):
+        return dict((ip, self.locations.get(ip)) for ip in ips)
+
+# Volley reading from the generated logs, with fixed server capacities instead of /capacity calls.
+class SyntheticVolley(volley.Volley):
+
+    def __init__(self, log_manager, ip_cache, servers, capacities):
+        self.log_manager = log_manager
+        self.ip_cache = ip_cache
+        self.servers = servers
+        self.capacities = capacities
+        self.uuid_metadata = {}
+        self.server_locations = {}
+
+    def total_server_capacity(self, server):
+        return self.capacities[server]
+
+# Reads the locations from ip_lat_long_map.txt and the reads and file sizes from access_log.txt of a dataset.
+def load_dataset(dataset):
+    locations = {}
+    with open(os.path.join(DATASET_DIRECTORY, dataset, 'ip_lat_long_map.txt'), 'rb') as ip_map:
+        for line in ip_map:
+            columns = line.rstrip('\n').split('\t')
+            if len(columns) < 3:
+                continue
+            locations[columns[0]] = (float(columns[1]), float(columns[2]))
+
+    readers_by_uuid = {}
+    file_sizes = {}
+    with open(os.path.join(DATASET_DIRECTORY, dataset, 'access_log.txt'), 'rb') as access_log:
+        for line in access_log:
+            columns = line.rstrip('\n').split('\t')
+            if len(columns) < 8:
+                continue
+            if columns[5] == 'WRITE':
+                file_sizes[columns[1]] = int(columns[7])
+            elif columns[5] == 'READ' and columns[6] == '200':
+                readers_by_uuid.setdefault(columns[1], []).append(columns[2])
+    return (locations, readers_by_uuid, file_sizes)
+
+# Copies every item of the dataset `copies` times, sampling the readers of every copy from the original reads.
+def generate_items(readers_by_uuid, file_sizes, copies):
+    random.seed(591)
+    counts = {}
+    sizes = {}
+    for original_uuid, readers in readers_by_uuid.iteritems():
+        for copy in range(copies):
+            uuid = original_uuid + '-' + str(copy)
+            sizes[uuid] = file_sizes.get(original_uuid, DEFAULT_FILE_SIZE)
+            for i in range(len(readers)):
+                key = (uuid, random.choice(readers))
+                counts[key] = counts.get(key, 0) + 1
+    request_logs = sorted((uuid, client, count) for (uuid, client), count in counts.iteritems())
+    return (request_logs, sizes)
+
+# Returns the request-weighted distance of the items to the servers they are placed on.
+def weighted_distance(volley_instance, placements_by_server):
+    total = 0.0
+    for server, uuids in placements_by_server.iteritems():
+        for uuid in uuids:
+            metadata = volley_instance.uuid_metadata[uuid]
+            distance = [ server_info['distance'] for server_info in metadata['server_ranking'] if server_info['server'] == server ][0]
+            total += metadata['request_count'] * distance
+    return total
+
+# Runs one redistribution mode and returns its request-weighted distance and runtime.
+# The progress printed by the heuristic is discarded.
+def run_mode(volley_instance, uuids, mode):
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'wb')
+    try:
+        return run_mode_quietly(volley_instance, uuids, mode)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def run_mode_quietly(volley_instance, uuids, mode):
+    start_time = time.time()
+    if mode == volley.REDISTRIBUTION_REGRET:
+        placements_by_server = volley_instance.assign_servers_by_capacity(uuids)
+    else:
+        placements_by_server = dict((server, []) for server in volley_instance.servers)
+        for uuid in uuids:
+            placements_by_server[volley_instance.uuid_metadata[uuid]['server_ranking'][0]['server']].append(uuid)
+        placements_by_server = volley_instance.redistribute_server_data_by_capacity(placements_by_server)
+    elapsed = time.time() - start_time
+    return (weighted_distance(volley_instance, placements_by_server), elapsed)
+
+def benchmark_dataset(dataset, copies, slack):
+    locations, readers_by_uuid, file_sizes = load_dataset(dataset)
+    servers = sorted(ip for ip in locations if ip.startswith(SERVER_PREFIX))
+    request_logs, sizes = generate_items(readers_by_uuid, file_sizes, copies)
+    uuids = sorted(sizes.keys())
+
+    capacity = sum(sizes.values()) * slack / len(servers)
+    volley_instance = SyntheticVolley(SyntheticLogs(uuids, request_logs), SyntheticLocations(locations), servers,
+        dict((server, capacity) for server in servers))
+    locations_by_uuid = volley_instance.place_initial()
+    rankings = volley_instance.rank_servers([ locations_by_uuid[uuid] for uuid in uuids ])
+    request_counts = {}
+    for uuid, client, count in request_logs:
+        request_counts[uuid] = request_counts.get(uuid, 0) + count
+    for uuid, server_ranking in zip(uuids, rankings):
+        volley_instance.uuid_metadata[uuid] = { 'uuid': uuid, 'optimal_location': locations_by_uuid[uuid], 'file_size': sizes[uuid],
+            'request_count': request_counts[uuid], 'server_ranking': server_ranking }
+
+    print '************************* ' + dataset + ' ****************************'
+    print str(len(uuids)) + ' items, ' + str(len(servers)) + ' servers, capacity ' + str(int(capacity)) + ' bytes per server'
+    for mode in [volley.REDISTRIBUTION_HEURISTIC, volley.REDISTRIBUTION_REGRET]:
+        try:
+            distance, elapsed = run_mode(volley_instance, uuids, mode)
+            print mode + ': request-weighted distance ' + ('%.0f' % distance) + ' km, ' + ('%.3f' % elapsed) + ' seconds'
+        except ValueError as error:
+            print mode + ': failed (' + str(error) + ')'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--copies', type=int, default=1000, help='the number of copies made of every item in the dataset')
+    parser.add_argument('--slack', type=float, default=1.1, help='total server capacity as a multiple of the total data size')
+    args = parser.parse_args()
+
+    for dataset in sorted(os.listdir(DATASET_DIRECTORY)):
+        benchmark_dataset(dataset, args.copies, args.slack)
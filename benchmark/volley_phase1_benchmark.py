@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# Measures Volley phase 1 (initial placement) on a synthetic read log: the vectorized engine places
+# every item at once, while the recursive per-item helper is timed on a sample and extrapolated.
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'volley'))
+
+# Project imports
+import volley
+
+# Stands in for the aggregated log database, returning the synthetic reads.
+class SyntheticLogs:
+
+    def __init__(self, uuids, request_logs):
+        self.uuids = uuids
+        self.request_logs = request_logs
+
+    def get_unique_uuids(self):
+        return self.uuids
+
+    def get_reads_grouped_by_uuid_and_source(self):
+        return self.request_logs
+
+# Stands in for the ip location cache, returning the synthetic client locations.
+class SyntheticLocations:
+
+    def __init__(self, client_locations):
+        self.client_locations = client_locations
+
+    def get_many(self, ips):
+        return dict((ip, self.client_locations[ip]) for ip in ips)
+
+# Volley reading from the synthetic log instead of the aggregated log database.
+class SyntheticVolley(volley.Volley):
+
+    def __init__(self, log_manager, ip_cache):
+        self.log_manager = log_manager
+        self.ip_cache = ip_cache
+        self.uuid_metadata = {}
+
+# Generates the (uuid, source, count) read groups for `num_reads` reads spread over `num_uuids` items.
+#
+# params:
+#   num_reads: the number of reads in the log
+#   num_uuids: the number of distinct items read
+#   num_clients: the number of distinct clients issuing reads
+def generate_reads(num_reads, num_uuids, num_clients):
+    random.seed(591)
+    client_locations = {}
+    for i in range(num_clients):
+        client_locations['5.%d.%d.%d' % (i / 65536, (i / 256) % 256, i % 256)] = (random.uniform(-60, 70), random.uniform(-180, 180))
+    clients = sorted(client_locations.keys())
+
+    counts = {}
+    for i in range(num_reads):
+        key = ('file-%06d' % random.randrange(num_uuids), random.choice(clients))
+        counts[key] = counts.get(key, 0) + 1
+    request_logs = sorted((uuid, client, count) for (uuid, client), count in counts.iteritems())
+    uuids = sorted(set(req[0] for req in request_logs))
+    return (uuids, request_logs, client_locations)
+
+# Times the recursive helper on the first `sample_size` items, the way phase 1 used to run per item.
+def run_recursive(volley_instance, request_logs, client_locations, sample_size):
+    reads_by_uuid = {}
+    for req in request_logs:
+        reads_by_uuid.setdefault(req[0], []).append(req)
+    sample = sorted(reads_by_uuid.keys())[:sample_size]
+
+    start_time = time.time()
+    for uuid in sample:
+        weights = [ req[2] for req in reads_by_uuid[uuid] ]
+        locations = [ client_locations[req[1]] for req in reads_by_uuid[uuid] ]
+        volley_instance.weighted_spherical_mean_helper(float(sum(weights)), weights, locations)
+    return (time.time() - start_time) / len(sample)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--reads', type=int, default=1000000, help='the number of reads in the synthetic log')
+    parser.add_argument('--uuids', type=int, default=100000, help='the number of distinct items')
+    parser.add_argument('--clients', type=int, default=10000, help='the number of distinct clients')
+    parser.add_argument('--sample', type=int, default=5000, help='the number of items timed with the recursive helper')
+    args = parser.parse_args()
+
+    uuids, request_logs, client_locations = generate_reads(args.reads, args.uuids, args.clients)
+
+    volley_instance = SyntheticVolley(SyntheticLogs(uuids, request_logs), SyntheticLocations(client_locations))
+
+    start_time = time.time()
+    volley_instance.place_initial()
+    vectorized_time = time.time() - start_time
+
+    recursive_time = run_recursive(volley_instance, request_logs, client_locations, args.sample) * len(uuids)
+
+    print '************************* Volley phase 1 ****************************'
+    print str(args.reads) + ' reads, ' + str(len(uuids)) + ' items, ' + str(len(request_logs)) + ' (item, client) groups'
+    print 'BEFORE (recursive per item, extrapolated from ' + str(args.sample) + ' items): ' + ('%.2f' % recursive_time) + ' seconds'
+    print 'AFTER (vectorized): ' + ('%.2f' % vectorized_time) + ' seconds'
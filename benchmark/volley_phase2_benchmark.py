@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# Measures Volley phase 2 (interdependency iterations) on a synthetic Twitter-style graph, where a few
+# popular timelines are read together with many tweets. The vectorized phase runs on the whole graph,
+# while the per-neighbor loop phase 2 used to run is timed on a sample of edges and extrapolated.
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'volley'))
+
+# Project imports
+import volley
+import util
+
+# Stands in for the aggregated log database, returning the synthetic interdependencies.
+class SyntheticLogs:
+
+    def __init__(self, interdependencies):
+        self.interdependencies = interdependencies
+
+    def get_interdependencies(self):
+        return self.interdependencies
+
+# Volley reading from the synthetic log instead of the aggregated log database.
+class SyntheticVolley(volley.Volley):
+
+    def __init__(self, log_manager):
+        self.log_manager = log_manager
+        self.uuid_metadata = {}
+
+# Generates item locations and (uuid, source_uuid, count) interdependencies whose degrees follow a power law.
+#
+# params:
+#   num_items: the number of items
+#   num_edges: the number of interdependent pairs
+def generate_graph(num_items, num_edges):
+    random.seed(591)
+    locations_by_uuid = {}
+    for i in range(num_items):
+        locations_by_uuid['item-%07d' % i] = (random.uniform(-60, 70), random.uniform(-180, 180))
+    uuids = sorted(locations_by_uuid.keys())
+
+    interdependencies = {}
+    for i in range(num_edges):
+        timeline = uuids[min(int(random.paretovariate(1.2)) - 1, num_items - 1)]
+        tweet = random.choice(uuids)
+        interdependencies[(tweet, timeline)] = interdependencies.get((tweet, timeline), 0) + 1
+    return (locations_by_uuid, [ (uuid, source_uuid, count) for (uuid, source_uuid), count in interdependencies.iteritems() ])
+
+# Times the per-neighbor loop on the first `sample_size` edges of an iteration, the way phase 2 used to
+# move every item. Returns the time per edge.
+def run_loop(volley_instance, locations_by_uuid, interdependencies, sample_size):
+    sample = interdependencies[:sample_size]
+    start_time = time.time()
+    for uuid, other_item_uuid, request_count in sample:
+        location = locations_by_uuid[uuid]
+        other_item_location = locations_by_uuid[other_item_uuid]
+        distance = util.get_distance(location, other_item_location)
+        weight = 1 / (1 + (volley.KAPPA * distance * request_count))
+        location = volley_instance.interp(weight, location, other_item_location)
+    return (time.time() - start_time) / len(sample)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', type=int, default=200000, help='the number of items')
+    parser.add_argument('--edges', type=int, default=2000000, help='the number of interdependent pairs')
+    parser.add_argument('--sample', type=int, default=100000, help='the number of edges timed with the per-neighbor loop')
+    args = parser.parse_args()
+
+    locations_by_uuid, interdependencies = generate_graph(args.items, args.edges)
+
+    volley_instance = SyntheticVolley(SyntheticLogs(interdependencies))
+
+    # every pair is visited from both of its items in every iteration
+    loop_time = run_loop(volley_instance, locations_by_uuid, interdependencies, args.sample) * 2 * len(interdependencies) * \
+        volley.INTERDEPENDENCY_ITERATIONS
+
+    start_time = time.time()
+    volley_instance.reduce_latency(dict(locations_by_uuid))
+    elapsed = time.time() - start_time
+
+    print '************************* Volley phase 2 ****************************'
+    print str(args.items) + ' items, ' + str(len(interdependencies)) + ' interdependent pairs'
+    print 'BEFORE (per-neighbor loop, ' + str(volley.INTERDEPENDENCY_ITERATIONS) + ' iterations, extrapolated from ' + str(args.sample) + \
+        ' edges): ' + ('%.2f' % loop_time) + ' seconds'
+    print 'AFTER (vectorized): ' + ('%.2f' % elapsed) + ' seconds'
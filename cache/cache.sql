@@ -1 +1,2 @@
 CREATE TABLE IF NOT EXISTS IpLocationMap (ip text PRIMARY KEY, lat REAL, long REAL, city text, region text, country text);
+CREATE TABLE IF NOT EXISTS UnresolvableIp (ip text PRIMARY KEY, checked_at REAL);
@@ -1,11 +1,29 @@
 # A cache for ip to location mapping
+import collections
 import os
+import Queue
 import requests
 import sqlite3
+import threading
+import time
+
+import ip_range_index
 
 # Config
+QUERY_CHUNK_SIZE = 500      # the number of ip addresses looked up per query, below sqlite's variable limit
 CACHE_INITIALIZATION = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cache.sql')
 IP_LOCATION_CACHE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'ip_location_cache.db')
+RESOLVER_CAPACITY = 100000  # the number of locations kept in memory by the shared resolver
+OFFLINE = False             # never call the lookup service, even if there is no range file
+LOOKUP_URL = 'http://ipinfo.io/%s/json'  # the lookup service, called with the ip address
+LOOKUP_TIMEOUT = 10         # seconds to wait for the lookup service
+NEGATIVE_CACHE_TTL = 86400  # seconds before an unresolvable address is looked up again
+PREFETCH_WORKERS = 8        # the number of lookups running at the same time while prefetching
+PREFETCH_RATE_LIMIT = 10    # the number of lookups per second while prefetching, None for no limit
+
+# One resolver per process, keyed by pid, since a sqlite connection must not cross a fork.
+resolvers = {}
+resolvers_lock = threading.Lock()
 
 class ip_location_cache:
 
@@ -15,32 +33,110 @@ class ip_location_cache:
             self.conn.executescript(initialization_file.read())
         self.cursor = self.conn.cursor()
 
-    # Add an entry to the cache based on the ip address.
+    # Add an entry to the cache based on the ip address. The offline range file is searched first
+    # when it exists, and the lookup service is only called if the address is not in it.
+    # Addresses the lookup service does not know are not looked up again for NEGATIVE_CACHE_TTL seconds;
+    # addresses only missing from the range file are not remembered, since the file can change.
     def find_and_add_entry(self, ip):
-        print 'Retrieving data for ' + ip + '...'
-        r = requests.get('http://ipinfo.io/' + ip + '/json')
-        try:
-            ip_info = r.json()
-            if 'loc' not in ip_info:
-                raise ValueError
-            loc = ip_info['loc'].split(',')
-            print 'Data for ' + ip + ' found. lat: ' + loc[0] + ', lng: ' + loc[1]
-
-            loc[0] = float(loc[0])
-            loc[1] = float(loc[1])
-
-            self.add_entry_to_cache(ip_info['ip'], loc[0], loc[1], ip_info['city'], ip_info['region'], ip_info['country'])
-            print 'Inserted into database.'
-            return (loc[0], loc[1])
-        except ValueError:
-            print 'Error retrieving data for ' + ip
-            pass
+        if self.is_unresolvable(ip):
+            return None
+        entry = find_offline_location(ip)
+        if entry is None:
+            if OFFLINE:
+                print 'Error retrieving data for ' + ip
+                return None
+            print 'Retrieving data for ' + ip + '...'
+            try:
+                entry = request_location(ip)
+            except requests.exceptions.RequestException:
+                print 'Error retrieving data for ' + ip
+                return None
+            if entry is None:
+                print 'Error retrieving data for ' + ip
+                self.add_unresolvable([ip])
+                return None
+        self.add_entry_to_cache(*entry)
+        return (entry[1], entry[2])
+
+    # Resolves the addresses missing from the cache concurrently and adds them to it. The misses are
+    # found in one query, skipping the addresses known to be unresolvable, and the lookup service
+    # is called from `workers` threads at no more than `requests_per_second` requests per second.
+    # Returns a dictionary mapping every missing address to its (lat, lon), or None if it could not be found.
+    def prefetch(self, ips, workers=PREFETCH_WORKERS, requests_per_second=PREFETCH_RATE_LIMIT):
+        misses = self.find_misses(ips)
+        if len(misses) == 0:
+            return {}
+        start_time = time.time()
+        entries = resolve_locations(misses, workers, requests_per_second)
+        with self.conn:
+            self.cursor.executemany('INSERT OR REPLACE INTO IpLocationMap VALUES (?, ?, ?, ?, ?, ?)',
+                                    [ entry for entry in entries.itervalues() if entry is not None ])
+        self.add_unresolvable([ ip for ip, entry in entries.iteritems() if entry is None ])
+
+        locations = {}
+        for ip in misses:
+            entry = entries.get(ip)
+            locations[ip] = (entry[1], entry[2]) if entry is not None else None
+        unresolvable = len([ entry for entry in entries.itervalues() if entry is None ])
+        print 'Prefetched ' + str(len(entries) - unresolvable) + ' of ' + str(len(misses)) + ' missing locations in ' + \
+            ('%.3f' % (time.time() - start_time)) + ' seconds, ' + str(unresolvable) + ' unresolvable, ' + str(len(misses) - len(entries)) + \
+            ' failed or not found offline'
+        return locations
+
+    # Returns the addresses that are neither cached nor known to be unresolvable, found in one query.
+    def find_misses(self, ips):
+        self.cursor.execute('CREATE TEMP TABLE IF NOT EXISTS RequestedIp (ip text PRIMARY KEY)')
+        with self.conn:
+            self.cursor.executemany('INSERT OR IGNORE INTO RequestedIp VALUES (?)', [ (ip,) for ip in ips ])
+            self.cursor.execute('SELECT RequestedIp.ip FROM RequestedIp '
+                                'LEFT JOIN IpLocationMap ON IpLocationMap.ip = RequestedIp.ip '
+                                'LEFT JOIN UnresolvableIp ON UnresolvableIp.ip = RequestedIp.ip AND UnresolvableIp.checked_at >= ? '
+                                'WHERE IpLocationMap.ip IS NULL AND UnresolvableIp.ip IS NULL', (time.time() - NEGATIVE_CACHE_TTL,))
+            misses = [ row[0] for row in self.cursor.fetchall() ]
+            self.cursor.execute('DELETE FROM RequestedIp')
+        return misses
+
+    def is_unresolvable(self, ip):
+        self.cursor.execute('SELECT ip FROM UnresolvableIp WHERE ip = ? AND checked_at >= ?', (ip, time.time() - NEGATIVE_CACHE_TTL))
+        return self.cursor.fetchone() is not None
+
+    # Records addresses that could not be resolved.
+    def add_unresolvable(self, ips):
+        now = time.time()
+        with self.conn:
+            self.cursor.executemany('INSERT OR REPLACE INTO UnresolvableIp VALUES (?, ?)', [ (ip, now) for ip in ips ])
 
     # Add an entry to the cache.
     def add_entry_to_cache(self, ip, lat, lon, city, region, country):
         self.cursor.execute('INSERT OR REPLACE INTO IpLocationMap VALUES (?, ?, ?, ?, ?, ?)', (ip, lat, lon, city, region, country))
         self.conn.commit()
 
+    # Loads an ip_lat_long_map.txt file (tab-separated ip, lat, lon, city, region, country per line)
+    # into the cache. The rows are streamed into a single executemany inside one transaction, with
+    # synchronous writes turned off until the import is done. Returns the number of rows loaded.
+    def bulk_load(self, ip_lat_long_map_file):
+        start_time = time.time()
+        loaded = [0]
+        def read_rows(map_file):
+            for line in map_file:
+                columns = line.rstrip('\r\n').split('\t')
+                if len(columns) < 6:
+                    continue
+                loaded[0] += 1
+                yield (columns[0], float(columns[1]), float(columns[2]), columns[3], columns[4], columns[5])
+
+        synchronous = self.cursor.execute('PRAGMA synchronous').fetchone()[0]
+        self.cursor.execute('PRAGMA synchronous = OFF')
+        try:
+            with open(ip_lat_long_map_file, 'rb') as map_file, self.conn:
+                self.cursor.executemany('INSERT OR REPLACE INTO IpLocationMap VALUES (?, ?, ?, ?, ?, ?)', read_rows(map_file))
+        finally:
+            self.cursor.execute('PRAGMA synchronous = %d' % (synchronous,))
+        elapsed = time.time() - start_time
+        rows_per_second = loaded[0] / elapsed if elapsed > 0 else 0.0
+        print 'Loaded ' + str(loaded[0]) + ' locations in ' + ('%.3f' % elapsed) + ' seconds (' + ('%.0f' % rows_per_second) + ' rows/sec)'
+        return loaded[0]
+
     # Returns the (lat, lon) information of the ip address.
     def get_lat_lon_from_ip(self, ip):
         self.cursor.execute('SELECT lat, long FROM IpLocationMap WHERE ip=?', (ip,))
@@ -49,7 +145,175 @@ class ip_location_cache:
             return self.find_and_add_entry(ip)
         else:
             return result
+
+    # Returns a dictionary mapping each ip address to its (lat, lon), looking up the cached
+    # addresses in a few queries instead of one per address and prefetching the rest.
+    # Addresses that cannot be found map to None.
+    def get_many(self, ips):
+        ips = list(set(ips))
+        locations = {}
+        for i in range(0, len(ips), QUERY_CHUNK_SIZE):
+            chunk = ips[i:i + QUERY_CHUNK_SIZE]
+            self.cursor.execute('SELECT ip, lat, long FROM IpLocationMap WHERE ip IN (' + ','.join('?' * len(chunk)) + ')', chunk)
+            for row in self.cursor.fetchall():
+                locations[row[0]] = (row[1], row[2])
+        missing = [ ip for ip in ips if ip not in locations ]
+        if len(missing) > 0:
+            locations.update(self.prefetch(missing))
+            for ip in missing:
+                locations.setdefault(ip, None)
+        return locations
+
+    # Returns up to `limit` cached (ip, lat, lon) rows.
+    def get_locations(self, limit):
+        self.cursor.execute('SELECT ip, lat, long FROM IpLocationMap LIMIT ?', (limit,))
+        return self.cursor.fetchall()
+
     # Close database connection
     def __del__(self):
         self.conn.close()
 
+# Returns the (ip, lat, lon, city, region, country) entry of the ip address from the offline range file,
+# None if there is no range file or the address is not in it.
+def find_offline_location(ip):
+    if not os.path.exists(ip_range_index.RANGE_FILE):
+        return None
+    location = ip_range_index.get_shared_index(ip_range_index.RANGE_FILE).lookup(ip)
+    if location is None:
+        return None
+    return (ip,) + tuple(location)
+
+# Returns the (ip, lat, lon, city, region, country) entry of the ip address from the lookup service,
+# None if the service does not know the address. Raises requests.exceptions.RequestException
+# when the service could not be reached or is throttling, so that the address is tried again later.
+def request_location(ip):
+    r = requests.get(LOOKUP_URL % (ip,), timeout=LOOKUP_TIMEOUT)
+    if r.status_code == 429 or r.status_code >= 500:
+        raise requests.exceptions.RequestException('Lookup of ' + ip + ' failed with status ' + str(r.status_code))
+    try:
+        ip_info = r.json()
+    except ValueError:
+        return None
+    if r.status_code != requests.codes.ok or 'loc' not in ip_info:
+        return None
+    loc = ip_info['loc'].split(',')
+    return (ip, float(loc[0]), float(loc[1]), ip_info.get('city'), ip_info.get('region'), ip_info.get('country'))
+
+# Resolves ip addresses from the offline range file and then from the lookup service, using `workers`
+# threads and starting no more than `requests_per_second` requests per second.
+# Returns a dictionary mapping every address that was answered to its entry (see request_location),
+# or None if the lookup service does not know it. Addresses whose lookup failed, and addresses missing
+# from the range file when OFFLINE, are left out.
+def resolve_locations(ips, workers=PREFETCH_WORKERS, requests_per_second=PREFETCH_RATE_LIMIT):
+    entries = {}
+    pending = Queue.Queue()
+    for ip in ips:
+        entry = find_offline_location(ip)
+        if entry is not None:
+            entries[ip] = entry
+        elif not OFFLINE:
+            pending.put(ip)
+
+    lock = threading.Lock()
+    next_request_at = [time.time()]
+    def run_worker():
+        while True:
+            try:
+                ip = pending.get_nowait()
+            except Queue.Empty:
+                return
+            if requests_per_second is not None:
+                with lock:
+                    start_at = max(time.time(), next_request_at[0])
+                    next_request_at[0] = start_at + 1.0 / requests_per_second
+                delay = start_at - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            try:
+                entry = request_location(ip)
+            except requests.exceptions.RequestException:
+                continue
+            with lock:
+                entries[ip] = entry
+
+    threads = [ threading.Thread(target=run_worker) for i in range(min(workers, pending.qsize())) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return entries
+
+# Returns the resolver shared by the current process, warmed up from IpLocationMap when it is created.
+def get_shared_resolver():
+    with resolvers_lock:
+        pid = os.getpid()
+        if pid not in resolvers:
+            resolvers.clear()
+            resolvers[pid] = ip_location_resolver()
+            resolvers[pid].warm_up()
+        return resolvers[pid]
+
+# In-memory front of ip_location_cache: ip -> (lat, lon).
+#
+# Holds up to `capacity` locations, evicting the least recently used ones, and falls back to the
+# sqlite cache (and from there to the lookup service) on a miss. Every thread gets its own sqlite
+# connection. Addresses that cannot be found are not kept, so they are looked up again next time.
+class ip_location_resolver:
+
+    def __init__(self, capacity=RESOLVER_CAPACITY):
+        self.capacity = capacity
+        self.locations = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def get_cache(self):
+        if not hasattr(self.local, 'cache'):
+            self.local.cache = ip_location_cache()
+        return self.local.cache
+
+    # Loads the cached locations into memory, up to the capacity.
+    def warm_up(self):
+        locations = self.get_cache().get_locations(self.capacity)
+        with self.lock:
+            for ip, lat, lon in locations:
+                self.locations[ip] = (lat, lon)
+
+    # Returns the (lat, lon) of the ip address, or None if it cannot be found.
+    def get_lat_lon_from_ip(self, ip):
+        with self.lock:
+            location = self.locations.pop(ip, None)
+            if location is not None:
+                self.locations[ip] = location
+                return location
+        location = self.get_cache().get_lat_lon_from_ip(ip)
+        self.add(ip, location)
+        return location
+
+    # Returns a dictionary mapping each ip address to its (lat, lon), or None if it cannot be found.
+    # The addresses missing from memory are looked up together with ip_location_cache.get_many.
+    def get_many(self, ips):
+        locations = {}
+        missing = []
+        with self.lock:
+            for ip in set(ips):
+                location = self.locations.pop(ip, None)
+                if location is None:
+                    missing.append(ip)
+                else:
+                    self.locations[ip] = location
+                    locations[ip] = location
+        if len(missing) > 0:
+            for ip, location in self.get_cache().get_many(missing).iteritems():
+                self.add(ip, location)
+                locations[ip] = location
+        return locations
+
+    def add(self, ip, location):
+        if location is None:
+            return
+        with self.lock:
+            self.locations.pop(ip, None)
+            self.locations[ip] = tuple(location)
+            while len(self.locations) > self.capacity:
+                self.locations.popitem(last=False)
+
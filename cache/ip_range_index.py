@@ -0,0 +1,150 @@
+# An offline index of ip ranges to locations
+#
+# Ranges are read from a tab-separated file with one `network, lat, lon, city, region, country` line
+# per range, where the network is either an address in CIDR notation or a single address. This makes
+# the ip_lat_long_map.txt files of the datasets valid range files of single addresses.
+# The ranges are flattened into sorted, non-overlapping intervals kept in arrays, so a lookup is a
+# binary search. When ranges are nested the most specific one wins.
+import argparse
+import array
+import bisect
+import os
+import socket
+import struct
+import threading
+
+# Config
+RANGE_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'ip_ranges.txt')
+
+# One index per range file, reloaded when the file changes.
+indexes = {}
+indexes_lock = threading.Lock()
+
+# Converts a dotted IPv4 address to an integer, None if it is not one.
+def ip_to_int(ip):
+    try:
+        return struct.unpack('!I', socket.inet_aton(ip))[0]
+    except (socket.error, TypeError):
+        return None
+
+def int_to_ip(value):
+    return socket.inet_ntoa(struct.pack('!I', value))
+
+# Returns the first and last address of a network in CIDR notation (or a single address) as integers.
+#
+# params:
+#   network: e.g. '5.5.5.0/24' or '5.5.5.1'
+#   prefix_length: the prefix length used when the network is a single address
+def parse_network(network, prefix_length=32):
+    if '/' in network:
+        network, prefix_length = network.split('/', 1)
+        prefix_length = int(prefix_length)
+    address = ip_to_int(network)
+    if address is None or prefix_length < 0 or prefix_length > 32:
+        raise ValueError('Invalid network: ' + network)
+    host_mask = (1 << (32 - prefix_length)) - 1
+    start = address & ~host_mask & 0xFFFFFFFF
+    return (start, start | host_mask)
+
+# Returns the index of the given range file, loading it again if the file changed since it was loaded.
+def get_shared_index(range_file=RANGE_FILE):
+    mtime = os.path.getmtime(range_file)
+    with indexes_lock:
+        if range_file not in indexes or indexes[range_file][0] != mtime:
+            index = ip_range_index()
+            index.load(range_file)
+            indexes[range_file] = (mtime, index)
+        return indexes[range_file][1]
+
+# Writes a range file from an ip_lat_long_map.txt file, widening every address to its /prefix_length network.
+# Returns the number of ranges written.
+def import_ip_lat_long_map(ip_lat_long_map_file, range_file=RANGE_FILE, prefix_length=32):
+    count = 0
+    with open(ip_lat_long_map_file, 'rb') as map_file, open(range_file, 'wb') as output_file:
+        for line in map_file:
+            columns = line.rstrip('\r\n').split('\t')
+            if len(columns) < 6:
+                continue
+            start, end = parse_network(columns[0], prefix_length)
+            output_file.write('\t'.join([int_to_ip(start) + '/' + str(prefix_length)] + columns[1:6]) + '\n')
+            count += 1
+    return count
+
+class ip_range_index:
+
+    def __init__(self):
+        self.ranges = []                  # (start, end, location) added since the last build
+        self.starts = array.array('I')    # first address of every interval, ascending
+        self.ends = array.array('I')      # last address of every interval
+        self.locations = []               # (lat, lon, city, region, country) of every interval
+
+    # Adds every range of a range file and builds the index.
+    def load(self, range_file):
+        with open(range_file, 'rb') as ranges:
+            for line in ranges:
+                columns = line.rstrip('\r\n').split('\t')
+                if len(columns) < 6:
+                    continue
+                start, end = parse_network(columns[0])
+                self.add_range(start, end, (float(columns[1]), float(columns[2]), columns[3], columns[4], columns[5]))
+        self.build()
+
+    # params:
+    #   start, end: the first and last address of the range as integers
+    #   location: (lat, lon, city, region, country)
+    def add_range(self, start, end, location):
+        self.ranges.append((start, end, location))
+
+    # Flattens the added ranges into non-overlapping intervals. Ranges sorted by start, outer ranges
+    # first, are nested like parentheses: an enclosing range is cut around the ranges inside it.
+    def build(self):
+        intervals = [ (self.starts[i], self.ends[i], self.locations[i]) for i in range(len(self.starts)) ]
+        ranges = sorted(intervals + self.ranges, key=lambda address_range: (address_range[0], -address_range[1]))
+        self.ranges = []
+        self.starts = array.array('I')
+        self.ends = array.array('I')
+        self.locations = []
+
+        enclosing = []
+        position = 0    # the first address not covered by an interval yet
+        for start, end, location in ranges:
+            while len(enclosing) > 0 and enclosing[-1][1] < start:
+                position = self.add_interval(max(position, enclosing[-1][0]), enclosing[-1][1], enclosing[-1][2])
+                enclosing.pop()
+            if len(enclosing) > 0:
+                position = self.add_interval(max(position, enclosing[-1][0]), start - 1, enclosing[-1][2])
+            enclosing.append((start, end, location))
+        while len(enclosing) > 0:
+            position = self.add_interval(max(position, enclosing[-1][0]), enclosing[-1][1], enclosing[-1][2])
+            enclosing.pop()
+
+    # Appends an interval unless it is empty, returning the address after it.
+    def add_interval(self, start, end, location):
+        if start <= end:
+            self.starts.append(start)
+            self.ends.append(end)
+            self.locations.append(location)
+        return max(start, end + 1)
+
+    # Returns (lat, lon, city, region, country) of the range containing the ip address, None if there is none.
+    def lookup(self, ip):
+        address = ip_to_int(ip)
+        if address is None:
+            return None
+        i = bisect.bisect_right(self.starts, address) - 1
+        if i >= 0 and address <= self.ends[i]:
+            return self.locations[i]
+        return None
+
+    def __len__(self):
+        return len(self.starts)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Builds the offline ip range file from an ip_lat_long_map.txt file.')
+    parser.add_argument('ip_lat_long_map', help='the ip_lat_long_map.txt file to import')
+    parser.add_argument('--output', default=RANGE_FILE, help='the range file to write')
+    parser.add_argument('--prefix-length', type=int, default=32, help='the prefix length of the network every address is widened to')
+    args = parser.parse_args()
+
+    count = import_ip_lat_long_map(args.ip_lat_long_map, args.output, args.prefix_length)
+    print 'Wrote ' + str(count) + ' ranges to ' + args.output
@@ -10,30 +10,32 @@ import time
 sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), 'aggregator'))
 import util
 from aggregator import Aggregator
+from migration import MigrationExecutor
 
 class SimpleCentralizedGreedy:
 
-  def __init__(self):
+  def __init__(self, executor = None):
     self.aggregator = Aggregator() # to retrive server logs
     self.server_set = set(util.retrieve_server_list()) # [server_ip, ]
     self.content_set = set()
-    self.replica_map = {} # { file_uuid: servers that store the file }
-    self.replication_task = []
+    self.replica_map = {} # { file_uuid: set of servers that store the file }
+    self.replication_task = set() # set([(file_uuid, target_server), ])
+    self.server_ranking = {} # { server_ip: [server_ip, ] }, all servers from the closest to the furthest
+    self.executor = executor if executor is not None else MigrationExecutor('replicate') # runs the replications concurrently
     self.last_timestamp = 0 # the time stamp of last update
-  
+
   def update(self):
     # update inner data
     self.replica_map = {}
-    self.replication_task = []
+    self.replication_task = set()
     # update content_set, replica_map
     for server in self.server_set:
       file_list = util.get_file_list_on_server(server)
       for file_uuid in file_list:
         self.content_set.add(file_uuid)
         if file_uuid not in self.replica_map:
-          self.replica_map[file_uuid] = []
-        if server not in self.replica_map[file_uuid]:
-          self.replica_map[file_uuid].append(server)
+          self.replica_map[file_uuid] = set()
+        self.replica_map[file_uuid].add(server)
 
     current_timestamp = int(time.time())
     logs = self.aggregator.get_redirect_log_entries(self.last_timestamp, current_timestamp)
@@ -41,25 +43,56 @@ class SimpleCentralizedGreedy:
     # used recently generated redirect logs to instruct replication
     for log in logs:
       timestamp, uuid, source, source_uuid, dest, req_type, status, response_size = log
-      dest = util.convert_to_local_hostname(dest)
-      if (uuid, dest) not in self.replication_task:
-        self.replication_task.append((uuid, dest))
+      self.replication_task.add((uuid, util.convert_to_local_hostname(dest)))
     self.last_timestamp = current_timestamp
 
+  # rank all servers by their distance to every server, once, so that choosing
+  # the source and destination of a replication does not look up any location
+  def update_server_ranking(self):
+    for server in self.server_set:
+      if server not in self.server_ranking:
+        ranking = util.find_closest_servers_with_ip(util.convert_to_simulation_ip(server), self.server_set)
+        self.server_ranking[server] = [ server_info['server'] for server_info in ranking ]
+
   def execute(self):
     self.update()
-    for file_uuid, target in self.replication_task:
-      candidate_servers = self.replica_map[file_uuid]
-      target_simulation_ip = util.convert_to_simulation_ip(target)
-      source = util.find_closest_servers_with_ip(target_simulation_ip, candidate_servers)[0]['server']
-      self.replicate(file_uuid, source, target)
+    self.update_server_ranking()
+    tasks = []
+    planned_replicas = {} # { file_uuid: set of servers the file is planned to be copied to }
+    for file_uuid, target in sorted(self.replication_task):
+      move = self.plan_replication(file_uuid, target, planned_replicas.get(file_uuid, set()))
+      if move is None:
+        continue
+      source, dest = move
+      # the replica is planned now, so later tasks do not copy the file there again. it is not a source
+      # yet: the executor runs the tasks concurrently, so it may not exist when a later task starts
+      planned_replicas.setdefault(file_uuid, set()).add(dest)
+      tasks.append({ 'uuid': file_uuid, 'source': source, 'destination': dest, 'file_size': None })
 
-  def replicate(self, content, source, dest):
-    print 'Greedy: replicate file %s from %s to %s', (content, source, dest)
-    if source == dest:
-      # a server can have at most one replcia, se we replicate to second nearest server
-      dest_simulation_ip = util.convert_to_simulation_ip(target)
-      candidate_servers = self.server_set - set(self.replica_map[content])
-      dest = util.find_closest_servers_with_ip(dest_simulation_ip, candidate_servers)[0]['server']
-    util.replicate(content, source, dest)
+    report = self.executor.execute(tasks)
+    replications_per_second = report['succeeded'] / report['wall_time'] if report['wall_time'] > 0 else 0.0
+    print 'Greedy: replicated ' + str(report['succeeded']) + ' files in ' + ('%.3f' % report['wall_time']) + ' seconds (' + \
+      ('%.1f' % replications_per_second) + ' replications/sec), ' + str(len(report['failed'])) + ' failed'
+    return report
 
+  # choose the closest server storing the content as the source. if the target stores the content
+  # already, a server can have at most one replica, so we replicate to the nearest server without one.
+  # sources are only picked from the replicas stored before the plan.
+  # params:
+  #   planned: servers the content is already planned to be copied to
+  # returns (source, dest), or None if the content is not stored anywhere or already stored everywhere
+  def plan_replication(self, content, target, planned = None):
+    if planned is None:
+      planned = set()
+    replicas = self.replica_map.get(content, set())
+    if len(replicas) == 0 or target not in self.server_ranking:
+      return None
+    source = [ server for server in self.server_ranking[target] if server in replicas ][0]
+    dest = target
+    if dest in replicas or dest in planned:
+      candidate_servers = [ server for server in self.server_ranking[target] if server not in replicas and server not in planned ]
+      if len(candidate_servers) == 0:
+        return None
+      dest = candidate_servers[0]
+    print 'Greedy: replicate file %s from %s to %s' % (content, source, dest)
+    return (source, dest)
@@ -0,0 +1,113 @@
+# Finds the peer that stores a file by asking the known peers concurrently
+import Queue
+import threading
+import time
+import urllib
+
+import requests
+
+# Project imports
+import peer_client
+
+# Config
+LOOKUP_TIMEOUT = 5           # seconds to wait for a single peer to answer /file_exists
+NEGATIVE_CACHE_TTL = 30      # seconds a uuid that no peer stores is remembered as missing
+NEGATIVE_CACHE_SIZE = 10000  # the number of missing uuids remembered at most
+LOOKUP_PARALLELISM = 8       # the number of peers asked at the same time
+ANSWER_GRACE_PERIOD = 1      # seconds waited for an answer on top of the lookup timeout
+
+class Discovery:
+
+    def __init__(self, timeout=LOOKUP_TIMEOUT, negative_cache_ttl=NEGATIVE_CACHE_TTL, parallelism=LOOKUP_PARALLELISM):
+        self.timeout = timeout
+        self.parallelism = parallelism
+        self.negative_cache_ttl = negative_cache_ttl
+        self.negative_cache = {}    # { uuid: expiration timestamp }
+        self.lock = threading.Lock()
+
+    # Returns the first server that answers that it stores the file, or None when no server does.
+    # At most LOOKUP_PARALLELISM servers are queried at the same time; once one answers positively,
+    # the servers not asked yet are skipped and the answers still in flight are ignored.
+    #
+    # params:
+    #   file_uuid: the file's uuid
+    #   servers: the servers to query
+    def find_server(self, file_uuid, servers):
+        if len(servers) == 0 or self.is_known_missing(file_uuid):
+            return None
+
+        pending = Queue.Queue()
+        for server in servers:
+            pending.put(server)
+        answers = Queue.Queue()
+        cancelled = threading.Event()
+        for i in range(min(self.parallelism, len(servers))):
+            lookup = threading.Thread(target=self.ask_servers, args=(pending, file_uuid, answers, cancelled))
+            lookup.daemon = True
+            lookup.start()
+
+        for i in range(len(servers)):
+            try:
+                # every lookup answers within its own timeout, so a longer wait means a peer misbehaves
+                server_with_file = answers.get(timeout=self.timeout + ANSWER_GRACE_PERIOD)
+            except Queue.Empty:
+                # not every server answered, so the file is not remembered as missing
+                cancelled.set()
+                return None
+            if server_with_file is not None:
+                cancelled.set()
+                return server_with_file
+
+        self.remember_missing(file_uuid)
+        return None
+
+    # Asks the pending servers one after the other until none is left or the lookup is cancelled,
+    # putting one answer on the answers queue for every server taken.
+    def ask_servers(self, pending, file_uuid, answers, cancelled):
+        while not cancelled.is_set():
+            try:
+                server = pending.get_nowait()
+            except Queue.Empty:
+                return
+            server_with_file = None
+            try:
+                server_with_file = self.ask_server(server, file_uuid)
+            finally:
+                # answer even when the lookup fails unexpectedly, so find_server never waits for it
+                answers.put(server_with_file)
+
+    # Returns the server if it answers that it stores the file, None otherwise.
+    def ask_server(self, server, file_uuid):
+        url = 'http://%s/file_exists?%s' % (server, urllib.urlencode({ 'uuid': file_uuid }))
+        try:
+            lookup_request = peer_client.get(url, timeout=self.timeout, retries=0)
+            return server if lookup_request.status_code == requests.codes.ok else None
+        except requests.exceptions.RequestException:
+            return None
+
+    # Returns whether the uuid was recently found on no server.
+    def is_known_missing(self, file_uuid):
+        with self.lock:
+            expiration = self.negative_cache.get(file_uuid)
+            if expiration is None:
+                return False
+            if expiration < time.time():
+                del self.negative_cache[file_uuid]
+                return False
+            return True
+
+    def remember_missing(self, file_uuid):
+        with self.lock:
+            now = time.time()
+            if len(self.negative_cache) >= NEGATIVE_CACHE_SIZE:
+                for missing_uuid, expiration in self.negative_cache.items():
+                    if expiration < now:
+                        del self.negative_cache[missing_uuid]
+                if len(self.negative_cache) >= NEGATIVE_CACHE_SIZE:
+                    self.negative_cache.clear()
+            self.negative_cache[file_uuid] = now + self.negative_cache_ttl
+
+    # Forgets that the uuid was missing, e.g. because it was just written.
+    def forget(self, file_uuid):
+        with self.lock:
+            self.negative_cache.pop(file_uuid, None)
@@ -4,11 +4,12 @@ import sys
 import os
 
 sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), 'aggregator'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cache'))
 
 # Project imports
 import util
 from aggregator import Aggregator
-from cache.ip_location_cache import ip_location_cache
+from ip_location_cache import get_shared_resolver
 
 class Evaluator:
 
@@ -30,11 +31,12 @@ class Evaluator:
     # calculate the average latency
     latency_sum = 0
     request_count = 0
-    ip_cache = ip_location_cache()
+    # resolve every client and server once instead of once per request
+    locations = get_shared_resolver().get_many([ log[2] for log in read_logs ] + [ log[4] for log in read_logs ])
     for log in read_logs:
       timestamp, uuid, source, source_uuid, dest, req_type, status, response_size = log
-      client_loc = ip_cache.get_lat_lon_from_ip(source)
-      server_loc = ip_cache.get_lat_lon_from_ip(dest)
+      client_loc = locations[source]
+      server_loc = locations[dest]
       distance = util.get_distance(client_loc, server_loc)
       unit = 1000.0
       latency = distance / unit
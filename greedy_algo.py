@@ -1,19 +1,28 @@
 # This file implement simplified greedy replication algorithm.
 
 # Python import
+import collections
 import random
 import os
 import sys
 import time
 
+import requests
+
 # Project imports
 sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), 'aggregator'))
 import util
 from aggregator import Aggregator
 
+EPSILON = 1e-9 # demand below this is considered served
+# A client may be served by any server at most this many km farther than its nearest server. Light in
+# fibre covers about 200 km per ms, so 500 km adds about 5 ms to a round trip, which is small next to a
+# read. 0 serves every client from its nearest servers only.
+DISTANCE_SLACK = 500
+
 class GreedyReplication:
 
-  def __init__(self):
+  def __init__(self, distance_slack = DISTANCE_SLACK):
     self.aggregator = Aggregator() # to retrive server logs
     self.client_set = set([]) # [client_ip, ]
     self.server_set = set(util.retrieve_server_list()) # [server_ip, ]
@@ -21,49 +30,115 @@ class GreedyReplication:
     self.access_map = {} # {uuid: {client_ip: num_request}}
     self.replica_map = {} # {uuid: {server_ip: num_replica}}
     self.last_timestamp = 0 # the timestamp of last update
+    self.last_rowid = None # the rowid of the last aggregated log entry processed, None before the first update
     self.requests_per_replica = 3
     self.uuid_to_server = None
+    self.distance_slack = distance_slack # km, a client can be served by servers this much farther than its nearest one
+    self.client_servers = {} # {client_ip: frozenset([server_ip, ])}, the servers eligible to serve the client
+    self.demand_map = {} # {uuid: {frozenset([server_ip, ]): num_request}}, requests grouped by eligible servers
+    self.starved_contents = set([]) # [uuid, ], contents whose replicas cannot serve their demand
     # self.sample_interval = 1000 # the time interval between two rounds in second
 
   # update client_set, server_set, content_set, access_info
   # and replication status
   # call this function before running greedy algorithm
+  #
+  # the first call loads the replicas from every server's file list and the reads since
+  # last_timestamp. later calls only process the log entries added since the previous call.
   def update(self):
-    # clear data
-    self.content_set = set([])
     self.access_map = {}
-    self.replica_map = {}
-    # update content_set, replica_map
-    for server in self.server_set:
-      file_list = util.get_file_list_on_server(server)
-      for file_uuid in file_list:
-        self.content_set.add(file_uuid)
-        if file_uuid not in self.replica_map:
-          self.replica_map[file_uuid] = {}
-        if server not in self.replica_map[file_uuid]:
-          self.replica_map[file_uuid][server] = 0
-        self.replica_map[file_uuid][server] += 1
-
-    current_timestamp = int(time.time())
-    logs = self.aggregator.get_read_log_entries(self.last_timestamp, current_timestamp)
+    if self.last_rowid is None:
+      current_timestamp = int(time.time())
+      logs = self.aggregator.get_read_log_entries(self.last_timestamp, current_timestamp)
+      self.last_rowid = self.aggregator.log_mgr.last_rowid()
+      self.load_replica_map()
+      self.last_timestamp = current_timestamp
+    else:
+      logs = self.aggregator.get_log_entries_since(self.last_rowid)
+      if len(logs) > 0:
+        self.last_rowid = logs[-1][0]
+        self.last_timestamp = max(self.last_timestamp, max(log[1] for log in logs))
+      # the logs of different servers are aggregated at different times, so apply them in time order
+      logs = [ log[1:] for log in sorted(logs, key=lambda log: (log[1], log[0])) ]
     # used recently generated logs to update inner data structure
     for log in logs:
       timestamp, uuid, source, source_uuid, dest, req_type, status, response_size = log
-      if uuid not in self.content_set:
-        continue
-      self.content_set.add(uuid)
-      if uuid not in self.access_map:
-        self.access_map[uuid] = {}
-      self.client_set.add(source)
-      if req_type == 'READ':
+      if req_type == 'WRITE' and status == 201:
+        self.add_stored_replica(uuid, util.convert_to_local_hostname(dest))
+      elif req_type == 'TRANSFER' and status == 200:
+        self.remove_stored_replica(uuid, util.convert_to_local_hostname(dest))
+      elif req_type == 'READ' and status == 200 and uuid in self.content_set:
+        if uuid not in self.access_map:
+          self.access_map[uuid] = {}
+        self.client_set.add(source)
         if source not in self.access_map[uuid]:
           self.access_map[uuid][source] = 0
         self.access_map[uuid][source] += 1
-    self.last_timestamp = current_timestamp
+    self.update_demand()
+
+  # rebuild content_set and replica_map from the file lists of all servers
+  def load_replica_map(self):
+    self.content_set = set([])
+    self.replica_map = {}
+    for server in self.server_set:
+      file_list = util.get_file_list_on_server(server)
+      for file_uuid in file_list:
+        self.add_stored_replica(file_uuid, server)
+
+  # a server stores a file at most once, so applying the same log entry again changes nothing.
+  # deletions are not logged, they are only picked up by load_replica_map.
+  def add_stored_replica(self, uuid, server):
+    self.content_set.add(uuid)
+    self.replica_map.setdefault(uuid, {})[server] = 1
+
+  def remove_stored_replica(self, uuid, server):
+    if uuid in self.replica_map:
+      self.replica_map[uuid].pop(server, None)
+      if len(self.replica_map[uuid]) == 0:
+        self.replica_map.pop(uuid)
+
+  # rebuild the per-(content, eligible servers) demand and the starved contents
+  # from access_map and replica_map, looking up the eligible servers of new clients only
+  def update_demand(self):
+    for a in self.client_set:
+      if a not in self.client_servers:
+        ranking = util.find_closest_servers_with_ip(a, self.server_set)
+        max_distance = ranking[0]['distance'] + self.distance_slack
+        self.client_servers[a] = frozenset(server['server'] for server in ranking if server['distance'] <= max_distance)
+    self.demand_map = {}
+    self.starved_contents = set()
+    for c in self.access_map:
+      self.demand_map[c] = {}
+      for a, num_request in self.access_map[c].iteritems():
+        servers = self.client_servers[a]
+        self.demand_map[c][servers] = self.demand_map[c].get(servers, 0) + num_request
+      if self.unmet_demand(c) > EPSILON:
+        self.starved_contents.add(c)
+
+  # the demand for content c that its replicas cannot serve, after adding extra_request
+  # requests from clients eligible for the given servers and extra_replica replicas on server s.
+  # every replica serves requests_per_replica requests of clients eligible for its server.
+  def unmet_demand(self, c, servers = None, extra_request = 0, s = None, extra_replica = 0):
+    demands = dict(self.demand_map.get(c, {}))
+    if servers is not None:
+      demands[servers] = demands.get(servers, 0) + extra_request
+    replicas = dict(self.replica_map.get(c, {}))
+    if s is not None:
+      replicas[s] = replicas.get(s, 0) + extra_replica
+    capacities = dict((server, replica * self.requests_per_replica) for server, replica in replicas.iteritems())
+    return find_unmet_demand(demands, capacities)
+
+  # test whether all contents have enough replicas after adding request_delta requests for
+  # content c from client a (and replica_delta replicas of c on server s), without changing any state.
+  # only the sufficiency of c can change, so this solves a single content's matching.
+  def enough_replica_after(self, c, a, request_delta, s = None, replica_delta = 0):
+    if len(self.starved_contents) > 1 or (len(self.starved_contents) == 1 and c not in self.starved_contents):
+      return False
+    return self.unmet_demand(c, self.client_servers[a], request_delta, s, replica_delta) <= EPSILON
 
   def run_replication(self):
     self.update()
-    request_delta = self.requests_per_replica / 10
+    request_delta = self.requests_per_replica / 10.0
     replica_delta = 1
     i = 0
     if not self.enough_replica_on_increase(request_delta):
@@ -79,13 +154,9 @@ class GreedyReplication:
     for c in self.content_set:
       if c in self.access_map:
         for a in self.access_map[c].keys():
-          # add a small amount of requests for content c from client a
-          self.access_map[c][a] += delta
-          # test whether current replicas can handle that much request
-          is_enough = self.enough_replica()
-          # back tracking,
-          self.access_map[c][a] -= delta
-          if not is_enough:
+          # test whether current replicas can handle a small amount of
+          # additional requests for content c from client a
+          if not self.enough_replica_after(c, a, delta):
             return False
     return True
 
@@ -94,13 +165,10 @@ class GreedyReplication:
     for c in self.content_set:
       if c in self.access_map:
         for a in self.access_map[c].keys():
-          # add a small amount of requests for content c from client a
-          self.access_map[c][a] += request_delta
-          # test whether current replicas can handle that much request
-          if not self.enough_replica():
+          # test whether current replicas can handle a small amount of
+          # additional requests for content c from client a
+          if not self.enough_replica_after(c, a, request_delta):
             I.append((a,c))
-          # back tracking,
-          self.access_map[c][a] -= request_delta
     max_satisfied_num = 0
     best_c = None
     best_s = None
@@ -109,16 +177,8 @@ class GreedyReplication:
     for a, c in I:
       for s in self.server_set:
         satisfied_num = 0
-        self.access_map[c][a] += request_delta
-        if s not in self.replica_map[c]:
-          self.replica_map[c][s] = 0
-        self.replica_map[c][s] += replica_delta
-        if self.enough_replica():
+        if self.enough_replica_after(c, a, request_delta, s, replica_delta):
           satisfied_num += 1
-        self.access_map[c][a] -= request_delta
-        self.replica_map[c][s] -= replica_delta
-        if self.replica_map[c][s] == 0:
-          self.replica_map[c].pop(s)
         if (satisfied_num > max_satisfied_num):
           max_satisfied_num = satisfied_num
           best_c = c
@@ -130,51 +190,136 @@ class GreedyReplication:
         best_s = random.sample(self.server_set - set([source]), 1)[0]
       self.replicate(best_c, source, best_s)
     else:
-      # replicate everything
-      print 'replicate to all servers'
+      # replicate every starved content to the servers that reduce its unmet demand the most
+      moves_by_source = {}
       for content in self.content_set:
-        if not self.enough_replica_for_content(content):
-          if content not in self.replica_map:
-            continue
-          source = self.replica_map[content].iterkeys().next()
-          #select first none zero replica
-          for server in self.server_set:
-            print 'replicate ' + 'content: ' + content + ' from: ' + source + ' to ' + server
-            util.replicate(content, source, server)
+        if self.enough_replica_for_content(content) or content not in self.replica_map:
+          continue
+        source = self.replica_map[content].iterkeys().next()
+        for server in self.select_servers_for_content(content):
+          print 'replicate ' + 'content: ' + content + ' from: ' + source + ' to ' + server
+          moves_by_source.setdefault(source, []).append((content, server))
+      for source, moves in moves_by_source.iteritems():
+        self.replicate_batch(source, moves)
+
+  # choose servers without a replica of content c, one at a time, picking the server that
+  # leaves the least unmet demand until c has enough replicas or no server helps anymore
+  def select_servers_for_content(self, c):
+    selected = []
+    demands = self.demand_map.get(c, {})
+    capacities = dict((server, replica * self.requests_per_replica) for server, replica in self.replica_map[c].iteritems())
+    candidates = set([]).union(*demands.keys()) - set(capacities.keys())
+    unmet = find_unmet_demand(demands, capacities)
+    while unmet > EPSILON:
+      best_server = None
+      best_unmet = unmet
+      for server in candidates:
+        capacities[server] = self.requests_per_replica
+        server_unmet = find_unmet_demand(demands, capacities)
+        del capacities[server]
+        if server_unmet < best_unmet - EPSILON:
+          best_server = server
+          best_unmet = server_unmet
+      if best_server is None:
+        break
+      capacities[best_server] = self.requests_per_replica
+      candidates.discard(best_server)
+      selected.append(best_server)
+      unmet = best_unmet
+    return selected
 
   def enough_replica(self):
-    # this is an approximate implementation, may need to
-    # construct a bipartite graph and run min matching algo
-    for c in self.content_set:
-      if not self.enough_replica_for_content(c):
-        return False
-    return True
-  
+    return len(self.starved_contents) == 0
+
   def enough_replica_for_content(self, c):
-    # this is an approximate implementation, may need to
-    # construct a bipartite graph and run min matching algo
-    server_to_request_sum_map = {}
-    if c not in self.access_map.keys():
-      # no client accesses c
-      return True
-    for a in self.access_map[c].keys():
-      nearest_server = util.find_closest_servers_with_ip(a, self.server_set)[0]['server']
-      if nearest_server not in server_to_request_sum_map:
-        server_to_request_sum_map[nearest_server] = 0 
-      server_to_request_sum_map[nearest_server] += self.access_map[c][a]
-    for server, request_sum in server_to_request_sum_map.iteritems():
-      if (c not in self.replica_map) or (server not in self.replica_map[c]):
-        return False
-      if self.replica_map[c][server] * self.requests_per_replica < request_sum:
-        return False
-    return True
+    return c not in self.starved_contents
 
+  # copy content from source to dest, recording the replica only if the copy succeeded so that
+  # a failed copy leaves the content starved and is tried again
   def replicate(self, content, source, dest):
-    print 'Greedy: replicate file %s from %s to %s', (content, source, dest)
-    if source == dest:
-      if dest not in self.replica_map[content]:
-        self.replica_map[content] = 0
-      self.replica_map[content][dest] += 1
+    print 'Greedy: replicate file %s from %s to %s' % (content, source, dest)
+    if source != dest and not util.replicate(content, source, dest):
+      return
+    self.record_replica(content, dest)
+
+  # replicate [(content, dest), ] from source in one batch, recording only the copies that succeeded
+  def replicate_batch(self, source, moves):
+    for status in util.replicate_batch(source, moves):
+      if status['status'] == requests.codes.ok:
+        self.record_replica(status['uuid'], status['destination'])
+
+  # add replica_delta replicas of content c on server s to replica_map and the starved contents
+  def record_replica(self, c, s, replica_delta = 1):
+    if c not in self.replica_map:
+      self.replica_map[c] = {}
+    self.replica_map[c][s] = self.replica_map[c].get(s, 0) + replica_delta
+    if self.unmet_demand(c) > EPSILON:
+      self.starved_contents.add(c)
     else:
-      util.replicate(content, source, dest)
+      self.starved_contents.discard(c)
+
+# Computes the demand left unserved by a maximum flow from client groups to servers, where a
+# group's requests may go to any of its eligible servers and a server serves at most its capacity.
+# Requests are first assigned greedily, and the rest is routed along augmenting paths that may
+# move requests already assigned to a server to another eligible server.
+#
+# params:
+#   demands: {frozenset([server_ip, ]): num_request}, the requests of clients eligible for those servers
+#   capacities: {server_ip: num_request}, the requests every server can serve
+def find_unmet_demand(demands, capacities):
+  remaining = dict(capacities)
+  assigned = {} # {server_ip: {group: num_request}}
+  unmet = 0.0
+  for group, demand in demands.iteritems():
+    for server in group:
+      amount = min(demand, remaining.get(server, 0))
+      if amount > EPSILON:
+        server_groups = assigned.setdefault(server, {})
+        server_groups[group] = server_groups.get(group, 0) + amount
+        remaining[server] -= amount
+        demand -= amount
+    while demand > EPSILON:
+      path = find_augmenting_path(group, assigned, remaining)
+      if path is None:
+        break
+      # the path can carry as much as the last server has left and the groups moved off every other server
+      amount = min(demand, remaining[path[-1][1]])
+      for i in range(len(path) - 1):
+        amount = min(amount, assigned[path[i][1]][path[i + 1][0]])
+      for i, (path_group, server) in enumerate(path):
+        server_groups = assigned.setdefault(server, {})
+        server_groups[path_group] = server_groups.get(path_group, 0) + amount
+        if i + 1 < len(path):
+          server_groups[path[i + 1][0]] -= amount
+      remaining[path[-1][1]] -= amount
+      demand -= amount
+    unmet += max(demand, 0)
+  return unmet
 
+# Finds a shortest path from a group to a server with remaining capacity, alternating between
+# assigning a group to an eligible server and taking requests of another group off that server.
+# Returns the path as [(group, server), ] where every group after the first was assigned to the
+# previous server, or None if there is no such path.
+def find_augmenting_path(group, assigned, remaining):
+  parents = {} # {server_ip: (group, previous server_ip)}
+  visited_groups = set([group])
+  queue = collections.deque([(group, None)])
+  while len(queue) > 0:
+    current_group, previous_server = queue.popleft()
+    for server in current_group:
+      if server in parents:
+        continue
+      parents[server] = (current_group, previous_server)
+      if remaining.get(server, 0) > EPSILON:
+        path = []
+        while server is not None:
+          path_group, previous = parents[server]
+          path.append((path_group, server))
+          server = previous
+        path.reverse()
+        return path
+      for next_group, amount in assigned.get(server, {}).iteritems():
+        if amount > EPSILON and next_group not in visited_groups:
+          visited_groups.add(next_group)
+          queue.append((next_group, server))
+  return None
@@ -1,16 +1,106 @@
 # a utility class for logging
+import atexit
 import datetime
 import os
+import threading
 import time
 
 LOG_DIRECTORY = 'logs'
+BUFFERED = True          # queue entries for the background writer instead of writing on the request thread
+FLUSH_INTERVAL = 1.0     # the longest time (in seconds) an entry stays in the buffer
+FLUSH_THRESHOLD = 500    # the number of buffered entries that wakes the writer up right away
+SECONDS_PER_DAY = 86400
+
+# Collects log entries and appends them to the daily log file from a background thread,
+# one write per flush instead of one open/write/close per entry.
+class BufferedLogWriter:
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL, flush_threshold=FLUSH_THRESHOLD):
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.day_start = None
+        self.day_end = None
+        self.log_file_path = None
+        self.start()
+
+    # Starts the writer thread of the current process. The entries buffered by the parent
+    # process before a fork are dropped so that they are not written twice.
+    def start(self):
+        self.pid = os.getpid()
+        self.entries = []
+        self.running = True
+        self.writer = threading.Thread(target=self.run)
+        self.writer.daemon = True
+        self.writer.start()
+
+    # Queues an entry logged at the given timestamp.
+    def append(self, timestamp, log_entry):
+        with self.condition:
+            if self.pid != os.getpid():
+                self.start()
+            self.entries.append((timestamp, log_entry))
+            if len(self.entries) >= self.flush_threshold:
+                self.condition.notify()
+
+    def run(self):
+        while self.running:
+            with self.condition:
+                if self.running:
+                    self.condition.wait(self.flush_interval)
+            self.flush()
+
+    # Stops the writer thread and writes what is left in the buffer.
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.pid == os.getpid():
+            self.writer.join()
+        self.flush()
+
+    # Writes every buffered entry to its daily log file.
+    def flush(self):
+        with self.write_lock:
+            with self.condition:
+                entries = self.entries
+                self.entries = []
+            if len(entries) == 0:
+                return
+            batch = []
+            batch_path = None
+            for timestamp, log_entry in entries:
+                log_file_path = self.get_log_file_path(timestamp)
+                if log_file_path != batch_path and len(batch) > 0:
+                    write_entries(batch_path, batch)
+                    batch = []
+                batch_path = log_file_path
+                batch.append(log_entry)
+            write_entries(batch_path, batch)
+
+    # Returns the log file for the timestamp, only formatting the date again when the UTC day changes.
+    def get_log_file_path(self, timestamp):
+        if self.day_start is None or not (self.day_start <= timestamp < self.day_end):
+            self.day_start = timestamp - (timestamp % SECONDS_PER_DAY)
+            self.day_end = self.day_start + SECONDS_PER_DAY
+            log_file = datetime.datetime.utcfromtimestamp(self.day_start).strftime('%Y-%m-%d') + '.log'
+            self.log_file_path = os.path.join(LOG_DIRECTORY, log_file)
+        return self.log_file_path
+
+writer = None
+writer_lock = threading.Lock()
+
+def write_entries(log_file_path, log_entries):
+    with open(log_file_path, 'a+') as log:
+        log.write(''.join(log_entries))
 
 # Log format:
 #   [timestamp]\t[uuid]\t[source_entity]\t[source_uuid]\t[destination_entity]\t[request_type]\t[status]\t[response_size]
 def log(uuid, source_entity, source_uuid, destination_entity, request_type, status, response_size):
-    log_file = datetime.datetime.utcnow().strftime('%Y-%m-%d') + '.log'
-    timestamp = time.time()
-    log_entry = str(int(timestamp)) + '\t' + \
+    global writer
+    timestamp = int(time.time())
+    log_entry = str(timestamp) + '\t' + \
                 str(uuid) + '\t' + \
                 str(source_entity) + '\t' + \
                 str(source_uuid) + '\t' + \
@@ -18,6 +108,23 @@ def log(uuid, source_entity, source_uuid, destination_entity, request_type, stat
                 str(request_type) + '\t' + \
                 str(status) + '\t' + \
                 str(response_size) + '\n'
-    log_file_path = os.path.join(LOG_DIRECTORY, log_file)
-    with open(log_file_path, 'a+') as log:
-        log.write(log_entry)
+    if not BUFFERED:
+        log_file = datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d') + '.log'
+        write_entries(os.path.join(LOG_DIRECTORY, log_file), [log_entry])
+        return
+    if writer is None:
+        with writer_lock:
+            if writer is None:
+                writer = BufferedLogWriter()
+    writer.append(timestamp, log_entry)
+
+# Writes the buffered entries to disk, e.g. before serving the logs or shutting down.
+def flush():
+    if writer is not None:
+        writer.flush()
+
+def shutdown():
+    if writer is not None:
+        writer.stop()
+
+atexit.register(shutdown)
@@ -1,4 +1,6 @@
 CREATE TABLE IF NOT EXISTS Connections(uuid text, requestId text);
 CREATE TABLE IF NOT EXISTS FileMap(uuid text, server text, file_size int, PRIMARY KEY (uuid, server));
 CREATE TABLE IF NOT EXISTS KnownServer(server text, distance real);
-CREATE INDEX FileMap_UUID ON FileMap(uuid);
+CREATE TABLE IF NOT EXISTS StorageUsage(server text PRIMARY KEY, used_bytes int);
+CREATE INDEX IF NOT EXISTS FileMap_UUID ON FileMap(uuid);
+INSERT OR IGNORE INTO StorageUsage SELECT server, SUM(file_size) FROM FileMap GROUP BY server;
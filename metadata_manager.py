@@ -1,12 +1,40 @@
 # Manages the metadata
 # It stores the metadata in a sqlite database
+import atexit
+import collections
+import os
 import sqlite3
+import threading
+import time
+
+# Config
+METADATA_DB = 'metadata.db'
+METADATA_INITIALIZATION = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'metadata.sql')
+FLUSH_INTERVAL = 0.5         # the longest time (in seconds) a pooled write stays uncommitted
+FLUSH_THRESHOLD = 100        # the number of pooled writes that forces a commit right away
+STATEMENT_CACHE_SIZE = 128   # the number of prepared statements kept per connection
+LOCATION_INDEX_CAPACITY = 100000  # the number of uuids kept in the in-memory location index
+QUERY_CHUNK_SIZE = 500       # the number of uuids looked up per query, below sqlite's variable limit
+
+# One pool per worker process, keyed by pid, since a sqlite connection must not cross a fork.
+pools = {}
+pools_lock = threading.Lock()
+forked_workers = False   # set when the server forks a worker per request, see prepare_forked_workers
 
 class MetadataManager:
 
-    def __init__(self):
-        self.conn = sqlite3.connect('metadata.db', check_same_thread=False)
+    def __init__(self, pool=None):
+        self.pool = pool
+        self.index = None
+        if pool is None:
+            self.conn = sqlite3.connect(METADATA_DB, check_same_thread=False)
+            self.lock = threading.RLock()
+        else:
+            self.conn = pool.conn
+            self.lock = pool.lock
+            self.index = pool.index
         self.cursor = self.conn.cursor()
+        self.closed = False
 
     # Returns the server that stores the file excluding the local machine
     #
@@ -14,8 +42,14 @@ class MetadataManager:
     #   file_uuid: the file's uuid
     #   local: the local machine's address
     def lookup_file(self, file_uuid, local):
-        self.cursor.execute('SELECT server FROM FileMap WHERE uuid=? AND server<>?', (file_uuid, local))
-        result = self.cursor.fetchone()
+        with self.lock:
+            if self.index is not None:
+                for server in self.get_locations(file_uuid):
+                    if server != local:
+                        return server
+                return None
+            self.cursor.execute('SELECT server FROM FileMap WHERE uuid=? AND server<>?', (file_uuid, local))
+            result = self.cursor.fetchone()
         if result is None:
             return None
         else:
@@ -27,8 +61,14 @@ class MetadataManager:
     #   file_uuid: the file's uuid
     #   server: the server address
     def file_exists_on_server(self, file_uuid, server):
-        self.cursor.execute('SELECT * FROM FileMap WHERE uuid =? AND server=?', (file_uuid, server))
-        return self.cursor.fetchone()
+        with self.lock:
+            if self.index is not None:
+                locations = self.get_locations(file_uuid)
+                if server not in locations:
+                    return None
+                return (file_uuid, server, locations[server])
+            self.cursor.execute('SELECT * FROM FileMap WHERE uuid =? AND server=?', (file_uuid, server))
+            return self.cursor.fetchone()
 
     # Adds the file uuid with the server stored into the database
     #
@@ -36,8 +76,14 @@ class MetadataManager:
     #   file_uuid: the file's uuid
     #   server_stored: the hostname of the server
     def update_file_stored(self, file_uuid, server_stored, file_size):
-        self.cursor.execute('INSERT OR REPLACE INTO FileMap VALUES (?, ?, ?)', (file_uuid, server_stored, file_size))
-        self.conn.commit()
+        with self.lock:
+            previous_file_info = self.file_exists_on_server(file_uuid, server_stored)
+            self.cursor.execute('INSERT OR REPLACE INTO FileMap VALUES (?, ?, ?)', (file_uuid, server_stored, file_size))
+            if self.index is not None:
+                self.index.set_location(file_uuid, server_stored, file_size)
+            previous_file_size = 0 if previous_file_info is None else previous_file_info[2]
+            self.update_storage_used(server_stored, int(file_size or 0) - int(previous_file_size or 0))
+            self.commit()
 
     # Delete the file uuid with the server stored into the database
     #
@@ -45,16 +91,43 @@ class MetadataManager:
     #   file_uuid: the file's uuid
     #   server_stored: the hostname of the server
     def delete_file_stored(self, file_uuid, server_stored):
-        self.cursor.execute('DELETE FROM FileMap WHERE uuid=? AND server=?', (file_uuid, server_stored))
-        self.conn.commit()
+        with self.lock:
+            previous_file_info = self.file_exists_on_server(file_uuid, server_stored)
+            if previous_file_info is None:
+                return
+            self.cursor.execute('DELETE FROM FileMap WHERE uuid=? AND server=?', (file_uuid, server_stored))
+            if self.index is not None:
+                self.index.remove_location(file_uuid, server_stored)
+            self.update_storage_used(server_stored, -int(previous_file_info[2] or 0))
+            self.commit()
+
+    # Adds delta bytes to the running storage usage of the server.
+    def update_storage_used(self, server, delta):
+        if delta == 0:
+            return
+        self.cursor.execute('INSERT OR IGNORE INTO StorageUsage VALUES (?, 0)', (server,))
+        self.cursor.execute('UPDATE StorageUsage SET used_bytes=used_bytes+? WHERE server=?', (delta, server))
+
+    # Returns the number of bytes stored on the server.
+    #
+    # params:
+    #   server: the server address
+    def get_storage_used(self, server):
+        with self.lock:
+            self.cursor.execute('SELECT used_bytes FROM StorageUsage WHERE server=?', (server,))
+            result = self.cursor.fetchone()
+        if result is None:
+            return 0
+        return result[0]
 
     # Returns a list of the servers that the server knows about excluding itself
     #
     # params:
     #   local: the local address
     def get_all_server(self, local):
-        self.cursor.execute('SELECT DISTINCT * FROM KnownServer WHERE server<>?', (local,))
-        results = self.cursor.fetchall()
+        with self.lock:
+            self.cursor.execute('SELECT DISTINCT * FROM KnownServer WHERE server<>?', (local,))
+            results = self.cursor.fetchall()
         retval = []
         for result in results:
             retval.append(result[0])
@@ -65,35 +138,89 @@ class MetadataManager:
     # params:
     #   local: the local address
     def get_all_server_without_port(self, local):
-        self.cursor.execute('SELECT DISTINCT * FROM KnownServer WHERE server<>?', (local,))
-        results = self.cursor.fetchall()
+        with self.lock:
+            self.cursor.execute('SELECT DISTINCT * FROM KnownServer WHERE server<>?', (local,))
+            results = self.cursor.fetchall()
         retval = []
         for result in results:
             retval.append(result[0].split(':')[0])
         return retval
 
+    # Returns a dictionary mapping each server storing the file to the file size,
+    # filling the location index from the database when the uuid is not indexed yet.
+    #
+    # params:
+    #   file_uuid: the file's uuid
+    def get_locations(self, file_uuid):
+        locations = self.index.get(file_uuid)
+        if locations is None:
+            self.cursor.execute('SELECT server, file_size FROM FileMap WHERE uuid=?', (file_uuid,))
+            locations = dict(self.cursor.fetchall())
+            self.index.add(file_uuid, locations)
+        return locations
+
+    # Returns a dictionary mapping each of the file uuids that is known to a dictionary
+    # of the servers storing it to the file size.
+    #
+    # params:
+    #   file_uuids: a list of file uuids
+    def get_locations_of_files(self, file_uuids):
+        locations_by_uuid = {}
+        with self.lock:
+            if self.index is not None:
+                for file_uuid in file_uuids:
+                    locations = self.get_locations(file_uuid)
+                    if len(locations) > 0:
+                        locations_by_uuid[file_uuid] = locations
+                return locations_by_uuid
+            for i in range(0, len(file_uuids), QUERY_CHUNK_SIZE):
+                chunk = file_uuids[i:i + QUERY_CHUNK_SIZE]
+                self.cursor.execute('SELECT uuid, server, file_size FROM FileMap WHERE uuid IN (' + ','.join('?' * len(chunk)) + ')', chunk)
+                for result in self.cursor.fetchall():
+                    locations_by_uuid.setdefault(result[0], {})[result[1]] = result[2]
+        return locations_by_uuid
+
+    # Returns up to `limit` rows of the file map ordered by uuid and server, starting after the given row.
+    #
+    # params:
+    #   after_uuid: the uuid of the last row of the previous page, '' for the first page
+    #   after_server: the server of the last row of the previous page, '' for the first page
+    #   limit: the maximum number of rows to return
+    def get_file_map_page(self, after_uuid, after_server, limit):
+        with self.lock:
+            self.cursor.execute('SELECT uuid, server, file_size FROM FileMap WHERE uuid >= ? AND NOT (uuid = ? AND server <= ?) '
+                'ORDER BY uuid, server LIMIT ?', (after_uuid, after_uuid, after_server, limit))
+            return self.cursor.fetchall()
+
     def get_file_list_on_server(self, server):
-        self.cursor.execute('SELECT DISTINCT uuid FROM FileMap WHERE server == ?',
-            (server,))
-        return self.cursor.fetchall()
+        with self.lock:
+            self.cursor.execute('SELECT DISTINCT uuid FROM FileMap WHERE server == ?',
+                (server,))
+            return self.cursor.fetchall()
 
     # Clear all metadata from the database.
     def clear_metadata(self):
-        self.cursor.execute('DELETE FROM KnownServer')
-        self.cursor.execute('DELETE FROM FileMap')
-        self.cursor.execute('DELETE FROM Connections')
-        self.conn.commit()
+        with self.lock:
+            self.cursor.execute('DELETE FROM KnownServer')
+            self.cursor.execute('DELETE FROM FileMap')
+            self.cursor.execute('DELETE FROM Connections')
+            self.cursor.execute('DELETE FROM StorageUsage')
+            if self.index is not None:
+                self.index.clear()
+            self.flush()
 
     # Returns the number of concurrent requests for the specified uuid.
     def get_concurrent_request(self, uuid):
-        self.cursor.execute('SELECT count(*) FROM Connections WHERE uuid=?', (uuid,))
-        result = self.cursor.fetchone()
+        with self.lock:
+            self.cursor.execute('SELECT count(*) FROM Connections WHERE uuid=?', (uuid,))
+            result = self.cursor.fetchone()
         return result[0]
 
     # returns a list containing the concurrent connections to the file, uuid
     def get_concurrent_connections(self, uuid):
-        self.cursor.execute('SELECT requestId FROM Connections WHERE uuid=?', (uuid,))
-        results = self.cursor.fetchall()
+        with self.lock:
+            self.cursor.execute('SELECT requestId FROM Connections WHERE uuid=?', (uuid,))
+            results = self.cursor.fetchall()
         retval = []
         for result in results:
             retval.append(result[0])
@@ -101,36 +228,251 @@ class MetadataManager:
 
     # Removes a concurrent request of a uuid from the server.
     def remove_concurrent_request(self, uuid, request_id):
-        self.cursor.execute('DELETE FROM Connections WHERE uuid=? AND requestId=?', (uuid, request_id))
-        self.conn.commit()
+        with self.lock:
+            self.cursor.execute('DELETE FROM Connections WHERE uuid=? AND requestId=?', (uuid, request_id))
+            self.commit()
 
     # Add a concurrent request
     def add_concurrent_request(self, uuid, request_id):
-        self.cursor.execute('INSERT INTO Connections VALUES (?, ?)', (uuid, request_id))
-        self.conn.commit()
+        with self.lock:
+            self.cursor.execute('INSERT INTO Connections VALUES (?, ?)', (uuid, request_id))
+            self.commit()
 
     # Returns the closest server to our server.
     def find_closest_server(self):
-        self.cursor.execute('SELECT ks1.server FROM KnownServer ks1 WHERE ks1.distance=(SELECT MIN(distance) FROM KnownServer ks2)')
-        return self.cursor.fetchone()
+        with self.lock:
+            self.cursor.execute('SELECT ks1.server FROM KnownServer ks1 WHERE ks1.distance=(SELECT MIN(distance) FROM KnownServer ks2)')
+            return self.cursor.fetchone()
 
     # Adds the server into the metadata database.
     def update_server(self, server, distance):
-        self.cursor.execute('INSERT INTO KnownServer VALUES (?, ?)', (server.strip(), distance))
-        self.conn.commit()
+        with self.lock:
+            self.cursor.execute('INSERT INTO KnownServer VALUES (?, ?)', (server.strip(), distance))
+            self.commit()
 
     # Adds the server into the metadata database
     #
     # params:
     #   server: the server known to this server that it is online
     def update_servers(self, servers):
-        for server in servers:
-            self.cursor.execute('INSERT INTO KnownServer VALUES (?, ?)', (server.strip(), -1))
+        with self.lock:
+            for server in servers:
+                self.cursor.execute('INSERT INTO KnownServer VALUES (?, ?)', (server.strip(), -1))
+            self.commit()
+
+    # Commits a write. Pooled managers only record the write and leave the commit to the pool,
+    # which groups writes together until FLUSH_INTERVAL or FLUSH_THRESHOLD is reached.
+    def commit(self):
+        if self.pool is None:
             self.conn.commit()
+        else:
+            self.pool.record_write()
+
+    # Commits every pending write right away.
+    def flush(self):
+        if self.pool is None:
+            self.conn.commit()
+        else:
+            self.pool.flush()
 
-    # Closes the connection to the database
+    # Closes the connection to the database. Pooled managers hand the connection back to the pool instead.
     def close(self):
-        self.conn.close()
+        if self.closed:
+            return
+        self.closed = True
+        if self.pool is None:
+            self.conn.close()
+        else:
+            self.cursor.close()
 
     def __del__(self):
         self.close()
+
+# Creates the metadata tables if they do not exist yet.
+def initialize(db_file=METADATA_DB):
+    conn = sqlite3.connect(db_file)
+    with open(METADATA_INITIALIZATION, 'rb') as initialization_file:
+        conn.executescript(initialization_file.read())
+    conn.close()
+
+# In-memory, write-through index of FileMap: uuid -> { server: file_size }.
+#
+# The index is loaded from FileMap when the pool starts and is bounded to `capacity` uuids,
+# evicting the least recently used ones. As long as nothing was evicted the index holds every
+# row of FileMap, so a uuid missing from it is known not to be stored anywhere.
+class LocationIndex:
+
+    def __init__(self, capacity=LOCATION_INDEX_CAPACITY):
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.complete = True
+
+    # Loads FileMap into the index, up to the capacity.
+    def load(self, conn):
+        self.clear()
+        for file_uuid, server, file_size in conn.execute('SELECT uuid, server, file_size FROM FileMap ORDER BY uuid'):
+            if file_uuid not in self.entries:
+                if len(self.entries) >= self.capacity:
+                    self.complete = False
+                    break
+                self.entries[file_uuid] = {}
+            self.entries[file_uuid][server] = file_size
+
+    # Returns the locations of the uuid, {} when it is known to be stored nowhere,
+    # or None when the database has to be consulted.
+    def get(self, file_uuid):
+        locations = self.entries.pop(file_uuid, None)
+        if locations is None:
+            return {} if self.complete else None
+        self.entries[file_uuid] = locations
+        return locations
+
+    # Adds the locations of a uuid read from the database.
+    def add(self, file_uuid, locations):
+        self.entries.pop(file_uuid, None)
+        self.entries[file_uuid] = locations
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.complete = False
+
+    def set_location(self, file_uuid, server, file_size):
+        if file_uuid in self.entries:
+            self.entries[file_uuid][server] = file_size
+        elif self.complete:
+            self.add(file_uuid, { server: file_size })
+
+    def remove_location(self, file_uuid, server):
+        if file_uuid in self.entries:
+            self.entries[file_uuid].pop(server, None)
+
+    def clear(self):
+        self.entries = collections.OrderedDict()
+        self.complete = True
+
+# A long-lived connection to the metadata database shared by every request of a worker process.
+#
+# The connection runs in WAL mode so readers never wait on the writer, keeps its prepared statements
+# cached across requests, and groups writes into a single commit that happens at most FLUSH_INTERVAL
+# seconds after the first uncommitted write. It also owns the location index answering the
+# "is it here / where is it" questions of the read path without touching sqlite.
+class MetadataPool:
+
+    def __init__(self, db_file=METADATA_DB, flush_interval=FLUSH_INTERVAL, flush_threshold=FLUSH_THRESHOLD, use_index=True, initialize=True):
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.conn = sqlite3.connect(db_file, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+        if initialize:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            with open(METADATA_INITIALIZATION, 'rb') as initialization_file:
+                self.conn.executescript(initialization_file.read())
+        else:
+            # WAL mode is stored in the database file; synchronous is a setting of the connection.
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.lock = threading.RLock()
+        self.index = None
+        if use_index:
+            self.index = LocationIndex()
+            self.index.load(self.conn)
+        self.data_version = self.get_data_version()
+        self.pending_writes = 0
+        self.first_pending_write = None
+        self.running = True
+        self.flusher = None   # started by the first write, so read-only workers never start a thread
+
+    # Returns a MetadataManager that works on the pooled connection.
+    def acquire(self):
+        self.refresh_if_changed()
+        return MetadataManager(self)
+
+    # Returns the counter sqlite bumps whenever another connection commits to the database.
+    def get_data_version(self):
+        return self.conn.execute('PRAGMA data_version').fetchone()[0]
+
+    # Reloads the location index if another connection changed the database behind our back.
+    def refresh_if_changed(self):
+        if self.index is None:
+            return
+        with self.lock:
+            data_version = self.get_data_version()
+            if data_version != self.data_version:
+                self.index.load(self.conn)
+                self.data_version = data_version
+
+    # Records an uncommitted write and commits when the group is big or old enough.
+    def record_write(self):
+        with self.lock:
+            self.pending_writes += 1
+            if self.first_pending_write is None:
+                self.first_pending_write = time.time()
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self.flush_periodically)
+                self.flusher.daemon = True
+                self.flusher.start()
+            if self.pending_writes >= self.flush_threshold:
+                self.flush()
+
+    # Commits all pending writes.
+    def flush(self):
+        with self.lock:
+            self.conn.commit()
+            self.pending_writes = 0
+            self.first_pending_write = None
+
+    # Background loop bounding how long a write may stay uncommitted.
+    def flush_periodically(self):
+        while self.running:
+            time.sleep(self.flush_interval)
+            with self.lock:
+                if self.first_pending_write is not None and time.time() - self.first_pending_write >= self.flush_interval:
+                    self.flush()
+
+    # Flushes pending writes and closes the pooled connection.
+    def close(self):
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+            self.flush()
+            self.conn.close()
+
+# Returns the metadata pool of the current worker process, creating it once per pid and reusing it after.
+def get_pool():
+    pid = os.getpid()
+    with pools_lock:
+        if pid not in pools:
+            if len(pools) == 0 and not forked_workers:
+                pools[pid] = MetadataPool()
+            else:
+                # A forked worker: the process that started the server already created the schema and
+                # switched the database to WAL, so the worker only opens its own connection. Per-request
+                # workers would rebuild the whole index for a single request, so they read FileMap directly.
+                pools[pid] = MetadataPool(use_index=False, initialize=False)
+        return pools[pid]
+
+# Prepares the database before the server starts forking a worker per request: the schema is created
+# and WAL switched on once, but no location index is loaded. The workers could not use it, since it
+# would go stale as soon as one of them writes, so they read FileMap directly instead.
+def prepare_forked_workers():
+    global forked_workers
+    forked_workers = True
+    MetadataPool(use_index=False).close()
+
+# Returns a MetadataManager backed by the pool of the current worker process.
+def get_pooled_manager():
+    return get_pool().acquire()
+
+# Commits the pending writes of the current worker process, if it has a pool.
+def flush():
+    pool = pools.get(os.getpid())
+    if pool is not None:
+        pool.flush()
+
+# Commits the pending writes and closes the pool of the current process when it exits.
+def shutdown():
+    with pools_lock:
+        pool = pools.pop(os.getpid(), None)
+    if pool is not None:
+        pool.close()
+
+atexit.register(shutdown)
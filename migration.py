@@ -0,0 +1,190 @@
+# Executes file migrations between servers in parallel
+#
+# Each task moves one file from a source server to a destination server through the source's
+# /transfer (or /replicate) endpoint. Tasks run concurrently under per-source and per-destination
+# concurrency limits and an optional bandwidth budget, failed tasks are retried with exponential
+# backoff, and completed tasks are appended to a journal so an interrupted run can be resumed.
+import collections
+import os
+import threading
+import time
+import urllib
+
+import requests
+
+# Project imports
+import peer_client
+
+# Configurable Constants
+WORKERS = 8                   # the number of migrations running at the same time
+PER_SOURCE_LIMIT = 2          # the number of migrations a single server sends at the same time
+PER_DESTINATION_LIMIT = 2     # the number of migrations a single server receives at the same time
+MAX_RETRIES = 3               # extra attempts for a failed migration
+BACKOFF_FACTOR = 1.0          # seconds to wait before the first retry, doubled on every retry
+MIGRATION_TIMEOUT = 30        # seconds to wait for a single migration call
+
+class MigrationExecutor:
+
+  # params:
+  #   endpoint: 'transfer' to move the files, 'replicate' to copy them
+  #   bandwidth_limit: the number of bytes per second all migrations may move together, None for no limit
+  #   journal_file: the file recording completed migrations, None to disable resuming
+  def __init__(self, endpoint='transfer', workers=WORKERS, per_source_limit=PER_SOURCE_LIMIT,
+               per_destination_limit=PER_DESTINATION_LIMIT, bandwidth_limit=None, max_retries=MAX_RETRIES,
+               backoff_factor=BACKOFF_FACTOR, journal_file=None, timeout=MIGRATION_TIMEOUT):
+    self.endpoint = endpoint
+    self.workers = workers
+    self.per_source_limit = per_source_limit
+    self.per_destination_limit = per_destination_limit
+    self.bandwidth_limit = bandwidth_limit
+    self.max_retries = max_retries
+    self.backoff_factor = backoff_factor
+    self.journal_file = journal_file
+    self.timeout = timeout
+
+  # Runs the migrations and returns a report with the wall time, bytes moved and the failed tasks.
+  #
+  # params:
+  #   tasks: a list of dicts with `uuid`, `source`, `destination` and `file_size`
+  def execute(self, tasks):
+    completed = self.read_journal()
+    pending = [ task for task in tasks if self.task_key(task) not in completed ]
+    self.pending_count = len(pending)
+    self.queues = {} # { (source, destination): deque of the pending tasks between them }
+    self.ready = collections.deque() # the (source, destination) pairs that may have a free slot
+    for task in pending:
+      pair = (task['source'], task['destination'])
+      if pair not in self.queues:
+        self.queues[pair] = collections.deque()
+        self.ready.append(pair)
+      self.queues[pair].append(task)
+    self.waiting_on_source = {} # { source: [(source, destination), ] } pairs parked until the source frees a slot
+    self.waiting_on_destination = {} # { destination: [(source, destination), ] }
+    self.active_sources = {}
+    self.active_destinations = {}
+    self.condition = threading.Condition()
+    self.journal_lock = threading.Lock()
+    self.bandwidth_lock = threading.Lock()
+    self.bandwidth_available_at = time.time()
+    self.report = { 'succeeded': 0, 'skipped': len(tasks) - len(pending), 'failed': [], 'bytes_moved': 0, 'wall_time': 0.0 }
+
+    start_time = time.time()
+    workers = []
+    for i in range(min(self.workers, len(pending))):
+      worker = threading.Thread(target=self.run_worker)
+      worker.start()
+      workers.append(worker)
+    for worker in workers:
+      worker.join()
+    self.report['wall_time'] = time.time() - start_time
+
+    # A fully completed run does not need to be resumed.
+    if len(self.report['failed']) == 0 and self.journal_file is not None and os.path.exists(self.journal_file):
+      os.remove(self.journal_file)
+    return self.report
+
+  def run_worker(self):
+    while True:
+      task = self.next_task()
+      if task is None:
+        return
+      try:
+        succeeded = self.migrate_with_retries(task)
+      finally:
+        self.release_task(task)
+      with self.condition:
+        if succeeded:
+          self.report['succeeded'] += 1
+          self.report['bytes_moved'] += task['file_size'] or 0
+        else:
+          self.report['failed'].append(task)
+
+  # Takes a pending task whose source and destination both have a free slot, waiting until one does.
+  # Returns None when there are no pending tasks left.
+  #
+  # Pairs whose source or destination is busy are parked on that server and only made ready again
+  # when it frees a slot, so a task is taken without scanning every pending task.
+  def next_task(self):
+    with self.condition:
+      while self.pending_count > 0:
+        while len(self.ready) > 0:
+          pair = self.ready.popleft()
+          source, destination = pair
+          if self.active_sources.get(source, 0) >= self.per_source_limit:
+            self.waiting_on_source.setdefault(source, []).append(pair)
+            continue
+          if self.active_destinations.get(destination, 0) >= self.per_destination_limit:
+            self.waiting_on_destination.setdefault(destination, []).append(pair)
+            continue
+          task = self.queues[pair].popleft()
+          if len(self.queues[pair]) > 0:
+            self.ready.append(pair)
+          else:
+            del self.queues[pair]
+          self.pending_count -= 1
+          self.active_sources[source] = self.active_sources.get(source, 0) + 1
+          self.active_destinations[destination] = self.active_destinations.get(destination, 0) + 1
+          return task
+        self.condition.wait()
+      return None
+
+  def release_task(self, task):
+    with self.condition:
+      self.active_sources[task['source']] -= 1
+      self.active_destinations[task['destination']] -= 1
+      self.ready.extend(self.waiting_on_source.pop(task['source'], []))
+      self.ready.extend(self.waiting_on_destination.pop(task['destination'], []))
+      self.condition.notify_all()
+
+  def migrate_with_retries(self, task):
+    for attempt in range(self.max_retries + 1):
+      if attempt > 0:
+        time.sleep(self.backoff_factor * (2 ** (attempt - 1)))
+      self.wait_for_bandwidth(task['file_size'])
+      if self.migrate(task):
+        self.write_journal(task)
+        print 'SUCCESS: Migrating ' + task['uuid'] + ' from <' + task['source'] + '> to <' + task['destination'] + '>'
+        return True
+    print 'FAILED: Migrating ' + task['uuid'] + ' from <' + task['source'] + '> to <' + task['destination'] + '>'
+    return False
+
+  def migrate(self, task):
+    url = 'http://%s/%s?%s' % (task['source'], self.endpoint, urllib.urlencode({ 'uuid': task['uuid'], 'destination': task['destination'] }))
+    try:
+      r = peer_client.put(url, timeout=self.timeout, retries=0)
+    except requests.exceptions.RequestException:
+      return False
+    return r.status_code == requests.codes.ok
+
+  # Reserves the bandwidth needed for a file, sleeping until the budget allows it to be sent.
+  def wait_for_bandwidth(self, file_size):
+    if self.bandwidth_limit is None or not file_size:
+      return
+    with self.bandwidth_lock:
+      start_at = max(time.time(), self.bandwidth_available_at)
+      self.bandwidth_available_at = start_at + (float(file_size) / self.bandwidth_limit)
+    delay = start_at - time.time()
+    if delay > 0:
+      time.sleep(delay)
+
+  def task_key(self, task):
+    return (task['uuid'], task['source'], task['destination'])
+
+  # Returns the set of (uuid, source, destination) recorded as completed by a previous run.
+  def read_journal(self):
+    completed = set()
+    if self.journal_file is None or not os.path.exists(self.journal_file):
+      return completed
+    with open(self.journal_file, 'rb') as journal:
+      for line in journal:
+        columns = line.rstrip('\n').split('\t')
+        if len(columns) == 3:
+          completed.add(tuple(columns))
+    return completed
+
+  def write_journal(self, task):
+    if self.journal_file is None:
+      return
+    with self.journal_lock:
+      with open(self.journal_file, 'ab') as journal:
+        journal.write('\t'.join(self.task_key(task)) + '\n')
@@ -0,0 +1,135 @@
+# HTTP client for every server-to-server call
+# It keeps one keep-alive session per peer so that inter-datacenter calls reuse their TCP connections.
+import os
+import threading
+import time
+import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Config
+DEFAULT_TIMEOUT = 30         # seconds to wait for a peer before giving up on an attempt
+MAX_RETRIES = 2              # extra attempts after a connection error or timeout
+BACKOFF_FACTOR = 0.5         # seconds to sleep before the first retry, doubled on every retry
+POOL_SIZE = 10               # keep-alive connections kept per peer
+IDEMPOTENT_METHODS = set(['GET', 'HEAD', 'DELETE'])   # retried by default; idempotent PUTs opt in with `retries`
+
+class PeerClient:
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, retries=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR, pool_size=POOL_SIZE):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        self.reset()
+
+    # Drops every session, e.g. after a fork since connections must not be shared between processes.
+    def reset(self):
+        self.pid = os.getpid()
+        self.sessions = {}   # { host: requests.Session }
+        self.latencies = {}  # { host: { 'requests': count, 'total': seconds, 'max': seconds } }
+
+    # Returns the keep-alive session for a peer, creating it on first use.
+    #
+    # params:
+    #   host: the peer's host:port
+    def session_for(self, host):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.reset()
+            if host not in self.sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.sessions[host] = session
+            return self.sessions[host]
+
+    # Sends a request to a peer. Connection errors and timeouts are retried with exponential backoff
+    # for idempotent methods. PUT is not retried by default since endpoints like /transfer remove the
+    # local file; callers of idempotent PUTs pass `retries` to opt in.
+    #
+    # params:
+    #   method: the HTTP method
+    #   url: the full url of the request
+    #   kwargs: passed on to requests, except `retries` which overrides the number of retries
+    def request(self, method, url, **kwargs):
+        host = urlparse.urlparse(url).netloc
+        session = self.session_for(host)
+        kwargs.setdefault('timeout', self.timeout)
+        retries = kwargs.pop('retries', self.retries if method.upper() in IDEMPOTENT_METHODS else 0)
+        attempt = 0
+        while True:
+            start_time = time.time()
+            try:
+                response = session.request(method, url, **kwargs)
+                self.record_latency(host, time.time() - start_time)
+                return response
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt >= retries:
+                    raise
+                time.sleep(self.backoff_factor * (2 ** attempt))
+                attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def record_latency(self, host, elapsed):
+        with self.lock:
+            if host not in self.latencies:
+                self.latencies[host] = { 'requests': 0, 'total': 0.0, 'max': 0.0 }
+            latency = self.latencies[host]
+            latency['requests'] += 1
+            latency['total'] += elapsed
+            latency['max'] = max(latency['max'], elapsed)
+
+    # Returns per peer statistics: number of requests, new connections opened, connection reuse rate
+    # and average/max latency in seconds.
+    def stats(self):
+        result = {}
+        with self.lock:
+            for host, session in self.sessions.iteritems():
+                requests_sent = 0
+                connections_opened = 0
+                for adapter in set(session.adapters.values()):
+                    for pool in adapter.poolmanager.pools.values():
+                        requests_sent += pool.num_requests
+                        connections_opened += pool.num_connections
+                latency = self.latencies.get(host, { 'requests': 0, 'total': 0.0, 'max': 0.0 })
+                result[host] = {
+                    'requests': requests_sent,
+                    'connections': connections_opened,
+                    'reuse_rate': 0.0 if requests_sent == 0 else 1 - (float(connections_opened) / requests_sent),
+                    'average_latency': 0.0 if latency['requests'] == 0 else latency['total'] / latency['requests'],
+                    'max_latency': latency['max'],
+                }
+        return result
+
+# The client shared by the whole process.
+shared_client = PeerClient()
+
+def get(url, **kwargs):
+    return shared_client.get(url, **kwargs)
+
+def put(url, **kwargs):
+    return shared_client.put(url, **kwargs)
+
+def post(url, **kwargs):
+    return shared_client.post(url, **kwargs)
+
+def delete(url, **kwargs):
+    return shared_client.delete(url, **kwargs)
+
+def stats():
+    return shared_client.stats()
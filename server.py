@@ -1,11 +1,16 @@
 # Python Library import
 import argparse
+import errno
+import hashlib
 import json
 import socket
 import sys
 import operator
 import os
 import os.path
+import Queue
+import tempfile
+import threading
 import time
 import urllib
 import uuid
@@ -19,8 +24,10 @@ from flask import Flask, g, make_response,  redirect, request, send_from_directo
 from werkzeug import secure_filename
 
 # Project imports
+import discovery
 import logger
 import metadata_manager
+import peer_client
 import util
 
 # Constants
@@ -31,10 +38,19 @@ SERVER_CONFIG_FILE = 'server.cnf'
 DIST_GREEDY = 'greedy'
 DIST_HEURISTIC = 'heuristic'
 USE_DIST_REPLICATION = 'use_dist_replication'
+USE_METADATA_POOL = 'use_metadata_pool'
+EMULATE_FILE_SIZE = 'emulate_file_size'
+TRANSFER_CHUNK_SIZE = 65536
+BATCH_PARALLELISM = 4   # the number of destinations a batch streams to at the same time
+METADATA_PAGE_LIMIT = 10000   # the maximum number of file map rows returned by one /metadata/dump call
+CHECKSUM_HEADER = 'X-Content-SHA1'
+CHECKSUM_TRAILER = 'trailer'   # CHECKSUM_HEADER value saying the digest follows the file content in the body
+CHECKSUM_LENGTH = 40   # the length of a SHA-1 hex digest
 
 # Setup for the app
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+peer_discovery = discovery.Discovery()
 
 @app.route('/')
 def hello():
@@ -58,6 +74,7 @@ def write_file():
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], file_uuid)
         file.save(file_path)
         metadata.update_file_stored(file_uuid, app.config['HOST'], get_file_size(file_path))
+        peer_discovery.forget(file_uuid)
         host_address = app.config['simulation_ip'] if 'simulation_ip' in app.config else app.config['HOST']
         logger.log(file_uuid, ip_address, 'null', host_address, 'WRITE', requests.codes.created, 0)
         return file_uuid, requests.codes.created
@@ -66,6 +83,56 @@ def write_file():
         logger.log('NO_FILE', ip_address, 'null', host_address, 'WRITE', requests.codes.bad_request, -1)
         return 'Write Failed', requests.codes.bad_request
 
+# Endpoint for receiving a file streamed from another server. The body is the raw file content,
+# followed by its SHA-1 hex digest when the sender says so with CHECKSUM_TRAILER: it is written in
+# chunks to a temporary file, verified against the sender's checksum and then atomically renamed
+# into place. This API call should not be open to all users.
+@app.route('/receive', methods=['PUT'])
+def receive_file():
+    metadata = getattr(g, 'metadata', None)
+    ip_address = request.args.get('ip') if 'ip' in request.args else request.remote_addr
+    file_uuid = request.args.get('uuid')
+    expected_checksum = request.headers.get(CHECKSUM_HEADER)
+    host_address = app.config['simulation_ip'] if 'simulation_ip' in app.config else app.config['HOST']
+    if not file_uuid:
+        logger.log('NO_FILE', ip_address, 'null', host_address, 'WRITE', requests.codes.bad_request, -1)
+        return 'Missing uuid', requests.codes.bad_request
+    if not os.path.isdir(app.config['UPLOAD_FOLDER']):
+        os.makedirs(app.config['UPLOAD_FOLDER'])
+
+    checksum = hashlib.sha1()
+    temp_file = tempfile.NamedTemporaryFile(dir=app.config['UPLOAD_FOLDER'], prefix='.receive-', delete=False)
+    try:
+        with temp_file:
+            # the last CHECKSUM_LENGTH bytes read so far may be the trailer, so they are held back
+            held_back = ''
+            while True:
+                chunk = request.stream.read(TRANSFER_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if expected_checksum == CHECKSUM_TRAILER:
+                    chunk = held_back + chunk
+                    held_back = chunk[-CHECKSUM_LENGTH:]
+                    chunk = chunk[:-CHECKSUM_LENGTH]
+                checksum.update(chunk)
+                temp_file.write(chunk)
+        if expected_checksum == CHECKSUM_TRAILER:
+            expected_checksum = held_back
+        if expected_checksum is not None and checksum.hexdigest() != expected_checksum:
+            logger.log(file_uuid, ip_address, 'null', host_address, 'WRITE', requests.codes.bad_request, -1)
+            return 'Checksum mismatch', requests.codes.bad_request
+
+        file_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(file_uuid))
+        os.rename(temp_file.name, file_path)
+    finally:
+        # the temporary file is still there unless it was renamed into place
+        if os.path.exists(temp_file.name):
+            os.remove(temp_file.name)
+    metadata.update_file_stored(file_uuid, app.config['HOST'], get_file_size(file_path))
+    peer_discovery.forget(file_uuid)
+    logger.log(file_uuid, ip_address, 'null', host_address, 'WRITE', requests.codes.created, 0)
+    return file_uuid, requests.codes.created
+
 # Endpoint for read method
 @app.route('/read', methods=['GET'])
 def read_file():
@@ -76,8 +143,8 @@ def read_file():
     filename = request.args.get('uuid')
     host_address = app.config['simulation_ip'] if 'simulation_ip' in app.config else app.config['HOST']
 
-    file_path = os.path.join(UPLOAD_FOLDER, secure_filename(filename))
-    if (metadata.file_exists_on_server(filename, app.config['HOST']) is not None):
+    file_info = metadata.file_exists_on_server(filename, app.config['HOST'])
+    if (file_info is not None):
         if app.config[USE_DIST_REPLICATION] == DIST_HEURISTIC:
             metadata.add_concurrent_request(filename, ip_address)
             distributed_replication(filename, ip_address, delay_time, metadata)
@@ -86,7 +153,7 @@ def read_file():
             def remove_request(response):
                 metadata.remove_concurrent_request(filename, ip_address)
                 metadata.close()
-        logger.log(filename, ip_address, source_uuid, host_address, 'READ', requests.codes.ok, get_file_size(file_path))
+        logger.log(filename, ip_address, source_uuid, host_address, 'READ', requests.codes.ok, file_info[2])
         time.sleep(delay_time)
         return send_from_directory(UPLOAD_FOLDER, secure_filename(filename))
 
@@ -97,17 +164,13 @@ def read_file():
         redirect_args['source_uuid'] = source_uuid
     if (redirect_address is None):
         other_servers = metadata.get_all_server(app.config['HOST'])
-        if (len(other_servers) > 0):
-            for server in other_servers:
-                url = 'http://%s/file_exists?%s' % (server, urllib.urlencode({ 'uuid': filename }))
-                print 'url: ' + url
-                lookup_request = requests.get(url)
-                if (lookup_request.status_code == requests.codes.ok):
-                    # Update metadata - this might be a little inefficient right now, but want to avoid infinite redirects by
-                    # using file_exists
-                    update_metadata_from_another_server(server, filename)
-                    redirect_address = server
-    redirect_url = 'http://%s/read?%s' % (redirect_address, urllib.urlencode(redirect_args))
+        redirect_address = peer_discovery.find_server(filename, other_servers)
+        if redirect_address is not None:
+            # Update metadata - this might be a little inefficient right now, but want to avoid infinite redirects by
+            # using file_exists
+            update_metadata_from_another_server(redirect_address, filename)
+    if redirect_address is not None:
+        redirect_url = 'http://%s/read?%s' % (redirect_address, urllib.urlencode(redirect_args))
 
     if redirect_url is not None:
         logger.log(filename, ip_address, source_uuid, host_address, 'READ', requests.codes.found, -1)
@@ -116,10 +179,9 @@ def read_file():
             replicate_args = { 'uuid': filename, 'ip': ip_address, 'replication_method': 'DISTRIBUTED_REPLICATE', 'destination': app.config['HOST'] }
             replicate_url = 'http://%s/replicate?%s' % (redirect_address, urllib.urlencode(replicate_args))
             print 'Redirecting to: ' + replicate_url
-            r = requests.put(replicate_url)
+            r = peer_client.put(replicate_url, retries=peer_client.MAX_RETRIES)
             if r.status_code == requests.codes.ok:
-              file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-              metadata.update_file_stored(filename, app.config['HOST'], get_file_size(file_path))
+              metadata.update_file_stored(filename, app.config['HOST'], get_stored_file_size(metadata, filename))
               return send_from_directory(UPLOAD_FOLDER, secure_filename(filename))
             else:
               raise Exception('greedy replication failed.')
@@ -140,6 +202,7 @@ def file_exists():
 # return a list of files that are stored on this server, seperated by '\n'
 @app.route('/local_file_list', methods=['GET'])
 def local_file_list():
+    metadata = getattr(g, 'metadata', None)
     server = app.config['HOST']
     file_list = metadata.get_file_list_on_server(server)
     if len(file_list) <= 0:
@@ -152,13 +215,13 @@ def local_file_list():
 # Transfers the file. This API call should not be open to all users.
 @app.route('/transfer', methods=['PUT'])
 def transfer():
+    metadata = getattr(g, 'metadata', None)
     ip_address = request.args.get('ip') if 'ip' in request.args else request.remote_addr
     file_uuid = request.args.get('uuid')
     destination = request.args.get('destination')
     write_request = clone_file(file_uuid, destination, 'TRANSFER', ip_address)
-    if (write_request[1] == requests.codes.created):
-        os.remove(os.path.join(app.config['UPLOAD_FOLDER'], file_uuid))
-        metadata.delete_file_stored(request.args.get('uuid'), app.config['HOST'])
+    if (write_request[1] == requests.codes.ok):
+        remove_local_file(metadata, file_uuid)
     return write_request
 
 # Replicate the file. This API call should not be open to all users.
@@ -170,6 +233,48 @@ def replicate():
     replication_method = request.args.get('replication_method') if 'replication_method' in request.args else 'REPLICATE'
     return clone_file(file_uuid, destination, replication_method, ip_address)
 
+# Moves a batch of files to other servers. This API call should not be open to all users.
+#
+# The body is a JSON object: { "method": "TRANSFER" or "REPLICATE", "moves": [{ "uuid": ..., "destination": ... }, ...] }.
+# Moves are grouped by destination; the files of a group are streamed one after the other over the
+# keep-alive connection to that destination, and up to BATCH_PARALLELISM destinations are served at once.
+# Returns the status of every move: [{ "uuid": ..., "destination": ..., "status": ... }, ...]
+@app.route('/batch_transfer', methods=['POST'])
+def batch_transfer():
+    metadata = getattr(g, 'metadata', None)
+    ip_address = request.args.get('ip') if 'ip' in request.args else request.remote_addr
+    host_address = app.config['simulation_ip'] if 'simulation_ip' in app.config else app.config['HOST']
+    batch = json.loads(request.data)
+    method = batch.get('method', 'REPLICATE')
+
+    statuses = {}
+    moves_by_destination = {}
+    for move in batch['moves']:
+        file_uuid = move['uuid']
+        destination = move['destination']
+        file_path = os.path.join(UPLOAD_FOLDER, secure_filename(file_uuid))
+        if metadata.file_exists_on_server(file_uuid, destination) is not None:
+            statuses[(file_uuid, destination)] = requests.codes.ok
+        elif not os.path.exists(file_path):
+            statuses[(file_uuid, destination)] = requests.codes.not_found
+        else:
+            moves_by_destination.setdefault(destination, []).append((file_uuid, file_path))
+
+    # Only the network part runs on the worker threads; the metadata and the logs are updated here.
+    stream_statuses = stream_files_by_destination(moves_by_destination, host_address)
+    for (file_uuid, destination), status_code in stream_statuses.iteritems():
+        succeeded = status_code == requests.codes.created
+        record_clone(metadata, file_uuid, destination, method, ip_address, succeeded)
+        statuses[(file_uuid, destination)] = requests.codes.ok if succeeded else requests.codes.internal_server_error
+
+    response = []
+    for move in batch['moves']:
+        status_code = statuses[(move['uuid'], move['destination'])]
+        if method == 'TRANSFER' and status_code == requests.codes.ok:
+            remove_local_file(metadata, move['uuid'])
+        response.append({ 'uuid': move['uuid'], 'destination': move['destination'], 'status': status_code })
+    return json.dumps(response), requests.codes.ok
+
 # Deletes the file. This API call should not be open to all users.
 @app.route('/delete', methods=['DELETE'])
 def delete():
@@ -185,6 +290,7 @@ def delete():
 # Returns the log.
 @app.route('/logs', methods=['GET'])
 def logs():
+    logger.flush()
     if 'date' in request.args:
         date = request.args.get('date')
         file_name = date + '.log'
@@ -200,25 +306,29 @@ def logs():
 # Returns whether the server can handle more files.
 @app.route('/can_move_file', methods=['GET'])
 def can_move_file():
+    metadata = getattr(g, 'metadata', None)
     file_size = float(request.args.get('file_size'))
-    storage_limit = app.config['storage_limit']
-    current_storage = sum(get_file_size(f) for f in os.listdir(UPLOAD_FOLDER) if os.path.isfile(f))
-    space_left = int(storage_limit) - current_storage
+    space_left = get_free_space(metadata)
     response_message = space_left
     if file_size < space_left:
         return str(response_message), requests.codes.ok
     else:
         return str(response_message), requests.codes.request_entity_too_large
 
-# Returns the capacity of the server
+# Returns the capacity of the server: total, used and free bytes
 @app.route('/capacity', methods=['GET'])
 def capacity():
-    return str(app.config['storage_limit']), requests.codes.ok
+    metadata = getattr(g, 'metadata', None)
+    storage_limit = int(app.config['storage_limit'])
+    storage_used = metadata.get_storage_used(app.config['HOST'])
+    response = { 'total': storage_limit, 'used': storage_used, 'free': storage_limit - storage_used }
+    return json.dumps(response), requests.codes.ok
 
 # Updates and retrieves metadata for a file
 @app.route('/metadata', methods=['GET'])
 def metadata():
     response = None
+    metadata = getattr(g, 'metadata', None)
 
     filename = request.args.get('uuid')
 
@@ -231,13 +341,7 @@ def metadata():
 
         if server_with_file is None:
             other_servers = metadata.get_all_server(app.config['HOST'])
-            if (len(other_servers) > 0):
-                for server in other_servers:
-                    url = 'http://%s/file_exists?%s' % (server, urllib.urlencode({ 'uuid': filename }))
-                    lookup_request = requests.get(url)
-                    if (lookup_request.status_code == requests.codes.ok):
-                        server_with_file = server
-                        break
+            server_with_file = peer_discovery.find_server(filename, other_servers)
 
         if server_with_file is not None:
             response = update_metadata_from_another_server(server_with_file, filename)
@@ -247,12 +351,70 @@ def metadata():
 
     return json.dumps(response), requests.codes.ok
 
+# Returns the location and size of many files at once.
+#
+# The body is a JSON object: { "uuids": [...] }. Files this server has no metadata for are looked up
+# on the other servers like /metadata does. Returns { "files": [{ "uuid": ..., "server": ..., "file_size": ... }, ...],
+# "missing": [uuids not found on any server] }
+@app.route('/metadata/batch', methods=['POST'])
+def metadata_batch():
+    metadata = getattr(g, 'metadata', None)
+    file_uuids = json.loads(request.data)['uuids']
+    locations_by_uuid = metadata.get_locations_of_files(file_uuids)
+
+    files = []
+    missing = []
+    other_servers = None
+    for file_uuid in file_uuids:
+        locations = locations_by_uuid.get(file_uuid)
+        if locations is not None:
+            server = app.config['HOST'] if app.config['HOST'] in locations else sorted(locations.keys())[0]
+            files.append({ 'uuid': file_uuid, 'server': server, 'file_size': locations[server] })
+            continue
+
+        if other_servers is None:
+            other_servers = metadata.get_all_server(app.config['HOST'])
+        server_with_file = peer_discovery.find_server(file_uuid, other_servers)
+        if server_with_file is None:
+            missing.append(file_uuid)
+        else:
+            files.append(update_metadata_from_another_server(server_with_file, file_uuid))
+
+    return json.dumps({ 'files': files, 'missing': missing }), requests.codes.ok
+
+# Returns a page of all the file locations this server knows about, ordered by uuid and server.
+# Pass the `uuid` and `server` of the `next` object as `after_uuid` and `after_server` to get the next page.
+# `limit` is clamped to 1..METADATA_PAGE_LIMIT rows.
+# Returns { "files": [{ "uuid": ..., "server": ..., "file_size": ... }, ...], "next": { "uuid": ..., "server": ... } or null }
+@app.route('/metadata/dump', methods=['GET'])
+def metadata_dump():
+    metadata = getattr(g, 'metadata', None)
+    after_uuid = request.args.get('after_uuid', '')
+    after_server = request.args.get('after_server', '')
+    try:
+        limit = int(request.args.get('limit', METADATA_PAGE_LIMIT))
+    except ValueError:
+        return 'Invalid limit', requests.codes.bad_request
+    limit = max(1, min(limit, METADATA_PAGE_LIMIT))
+
+    rows = metadata.get_file_map_page(after_uuid, after_server, limit)
+    files = [ { 'uuid': row[0], 'server': row[1], 'file_size': row[2] } for row in rows ]
+    next_page = { 'uuid': rows[-1][0], 'server': rows[-1][1] } if len(rows) == limit else None
+    return json.dumps({ 'files': files, 'next': next_page }), requests.codes.ok
+
+# Returns the connection reuse and latency statistics of the calls to other servers
+@app.route('/peer_stats', methods=['GET'])
+def peer_stats():
+    return json.dumps(peer_client.stats()), requests.codes.ok
+
 # Shuts down the server
 @app.route('/shutdown', methods=['GET'])
 def shutdown():
     func = request.environ.get('werkzeug.server.shutdown')
     if func is None:
         raise RuntimeError('Not running with the Werkzeug Server')
+    metadata_manager.flush()
+    logger.flush()
     func()
     return 'Server is shutting down...', requests.codes.ok
 
@@ -263,7 +425,10 @@ def shutdown():
 # Connect to the metadata database
 @app.before_request
 def before_request():
-    g.metadata = metadata_manager.MetadataManager()
+    if app.config.get(USE_METADATA_POOL, True):
+        g.metadata = metadata_manager.get_pooled_manager()
+    else:
+        g.metadata = metadata_manager.MetadataManager()
 
 # Setup the callback method.
 @app.after_request
@@ -274,6 +439,10 @@ def call_after_request_callbacks(response):
     if hasattr(g, 'metadata'):
         g.metadata.close()
         g.metadata = None
+    # Forked workers exit right after the request, so their grouped writes cannot wait for the flushers.
+    if int(app.config.get('processes', 1)) > 1:
+        metadata_manager.flush()
+        logger.flush()
     return response
 
 # Helper method for executing function after the request is done.
@@ -293,21 +462,41 @@ def after_this_request(f):
 #   server: server to query/ask
 #   uuid: uuid to query for
 def update_metadata_from_another_server(server, uuid):
+    metadata = getattr(g, 'metadata', None)
     url = 'http://%s/metadata?%s' % (server, urllib.urlencode({ 'uuid': uuid }))
-    r = requests.get(url)
+    r = peer_client.get(url)
     response = json.loads(r.text)
     metadata.update_file_stored(response['uuid'], response['server'], response['file_size'])
     return response
 
+# Returns the number of bytes that can still be stored on this server
+#
+# params:
+#   metadata: the metadata manager
+def get_free_space(metadata):
+    return int(app.config['storage_limit']) - metadata.get_storage_used(app.config['HOST'])
+
 # Get the file size of a file
 #
 # params:
 #   file_path: absolute path to file
 def get_file_size(file_path):
-    # Here, we would normally run os.stat to retrieve the file size
-    # But our emulation is that the file consists of an integer with the file size, so we find that instead.
-    file = open(file_path, 'r')
-    return int(file.read())
+    if not app.config.get(EMULATE_FILE_SIZE, True):
+        return os.stat(file_path).st_size
+    # Our emulation is that the file consists of an integer with the file size, so we find that instead.
+    with open(file_path, 'r') as file:
+        return int(file.read())
+
+# Get the size of a file stored on this server, from the metadata when it is known
+#
+# params:
+#   metadata: the metadata manager
+#   file_uuid: the file's uuid
+def get_stored_file_size(metadata, file_uuid):
+    file_info = metadata.file_exists_on_server(file_uuid, app.config['HOST'])
+    if file_info is not None and file_info[2] is not None:
+        return file_info[2]
+    return get_file_size(os.path.join(UPLOAD_FOLDER, secure_filename(file_uuid)))
 
 # Helper method for sending a file to another server
 #
@@ -323,20 +512,141 @@ def clone_file(file_uuid, destination, method, ip_address):
         if not os.path.exists(file_path):
             return 'File not found', requests.codes.not_found
         host_address = app.config['simulation_ip'] if 'simulation_ip' in app.config else app.config['HOST']
-        destination_with_endpoint = 'http://%s/write?%s' % (destination, urllib.urlencode({ 'uuid': file_uuid, 'ip': host_address }))
-        files = {'file': open(file_path, 'rb')}
-        write_request = requests.post(destination_with_endpoint, files=files)
-        if (write_request.status_code == requests.codes.created):
-            metadata.update_file_stored(file_uuid, destination, get_file_size(file_path))
-            destination = util.convert_to_simulation_ip(destination)
-            logger.log(file_uuid, ip_address, 'null', host_address, method, requests.codes.ok, get_file_size(file_path))
+        write_request = stream_file(file_path, file_uuid, destination, host_address)
+        if record_clone(metadata, file_uuid, destination, method, ip_address, write_request.status_code == requests.codes.created):
             return 'Success', requests.codes.ok
         else:
-            logger.log(file_uuid, ip_address, 'null', host_address, method, requests.codes.internal_server_error, get_file_size(file_path))
             return 'Not okay', requests.codes.internal_server_error
     else:
         return 'Success', requests.codes.ok
 
+# Records the outcome of sending a file to another server in the metadata and the log.
+# Returns whether the clone succeeded.
+#
+# params:
+#   metadata: the metadata manager
+#   file_uuid: the file's uuid
+#   destination: the server the file was sent to
+#   method: the method either REPLICATE or TRANSFER
+#   ip_address: the request ip_address
+#   succeeded: whether the destination stored the file
+def record_clone(metadata, file_uuid, destination, method, ip_address, succeeded):
+    host_address = app.config['simulation_ip'] if 'simulation_ip' in app.config else app.config['HOST']
+    file_size = get_stored_file_size(metadata, file_uuid)
+    if succeeded:
+        metadata.update_file_stored(file_uuid, destination, file_size)
+        logger.log(file_uuid, ip_address, 'null', host_address, method, requests.codes.ok, file_size)
+    else:
+        logger.log(file_uuid, ip_address, 'null', host_address, method, requests.codes.internal_server_error, file_size)
+    return succeeded
+
+# Removes a file that has been transferred away from this server. A retried transfer finds the file
+# already removed, so a missing file or FileMap row is not an error.
+#
+# params:
+#   metadata: the metadata manager
+#   file_uuid: the file's uuid
+def remove_local_file(metadata, file_uuid):
+    try:
+        os.remove(os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(file_uuid)))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    metadata.delete_file_stored(file_uuid, app.config['HOST'])
+
+# Streams groups of files to their destinations, serving up to BATCH_PARALLELISM destinations at once.
+# Returns a dictionary mapping (uuid, destination) -> HTTP status code returned by the destination.
+#
+# params:
+#   moves_by_destination: dictionary mapping destination -> list of (uuid, file_path)
+#   host_address: the address of this server, logged by the destinations as the source
+def stream_files_by_destination(moves_by_destination, host_address):
+    destinations = Queue.Queue()
+    for destination, moves in moves_by_destination.iteritems():
+        destinations.put((destination, moves))
+    statuses = {}
+    statuses_lock = threading.Lock()
+
+    def stream_destinations():
+        while True:
+            try:
+                destination, moves = destinations.get_nowait()
+            except Queue.Empty:
+                return
+            for file_uuid, file_path in moves:
+                try:
+                    status_code = stream_file(file_path, file_uuid, destination, host_address).status_code
+                except requests.exceptions.RequestException:
+                    status_code = requests.codes.service_unavailable
+                except Exception as e:
+                    # e.g. the file was deleted or could not be read; the other moves still go on
+                    print 'Streaming ' + file_uuid + ' to ' + destination + ' failed: ' + str(e)
+                    status_code = requests.codes.internal_server_error
+                with statuses_lock:
+                    statuses[(file_uuid, destination)] = status_code
+
+    workers = []
+    for i in range(min(BATCH_PARALLELISM, len(moves_by_destination))):
+        worker = threading.Thread(target=stream_destinations)
+        worker.start()
+        workers.append(worker)
+    for worker in workers:
+        worker.join()
+    return statuses
+
+# Request body that reads a file in blocks and appends the SHA-1 hex digest of what it read after
+# the last block, so the file is checksummed while it is sent instead of being read twice.
+#
+# params:
+#   file: the open file
+class ChecksummedFile:
+    def __init__(self, file):
+        self.file = file
+        self.checksum = hashlib.sha1()
+        self.trailer = None   # the part of the digest not read yet, once the whole file is read
+        # the peer client sends a body of known length with a Content-Length header
+        self.len = os.fstat(file.fileno()).st_size + CHECKSUM_LENGTH
+
+    def __len__(self):
+        return self.len
+
+    def __iter__(self):
+        while True:
+            block = self.read(TRANSFER_CHUNK_SIZE)
+            if not block:
+                return
+            yield block
+
+    def read(self, size=-1):
+        block = ''
+        if self.trailer is None:
+            block = self.file.read(size)
+            self.checksum.update(block)
+            if block and size >= 0:
+                return block
+            self.trailer = self.checksum.hexdigest()
+        if size < 0:
+            size = len(self.trailer)
+        trailer_block, self.trailer = self.trailer[:size], self.trailer[size:]
+        return block + trailer_block
+
+# Helper method for streaming a file to the /receive endpoint of another server.
+# The open file is handed to the peer client as the request body, so it is sent in blocks straight
+# from disk instead of being loaded into memory and wrapped into a multipart form. Its checksum
+# follows it as a trailer.
+#
+# params:
+#   file_path: path to the file
+#   file_uuid: the file's uuid
+#   destination: the server receiving the file
+#   host_address: the address of this server, logged by the destination as the source
+def stream_file(file_path, file_uuid, destination, host_address):
+    url = 'http://%s/receive?%s' % (destination, urllib.urlencode({ 'uuid': file_uuid, 'ip': host_address }))
+    headers = { CHECKSUM_HEADER: CHECKSUM_TRAILER, 'Content-Type': 'application/octet-stream' }
+    with open(file_path, 'rb') as file:
+        # The body is consumed by the first attempt, so it cannot be retried as is.
+        return peer_client.put(url, data=ChecksummedFile(file), headers=headers, retries=0)
+
 # Helper for distributed replication
 #
 # params:
@@ -363,9 +673,9 @@ def distributed_replication(filename, ip_address, delay_time, metadata):
             target_server = max(closest_servers.iteritems(), key=operator.itemgetter(1))[0]
             target_server = util.convert_to_local_hostname(target_server)
             # 2) Check if there is enough space on the remote server.
-            url = 'http://%s/can_move_file?%s' % (target_server, urllib.urlencode({ 'uuid': filename, 'file_size': 0, 'delay': delay_time }))
-            response = requests.get(url)
-            if response.status_code == requests.codes.ok:
+            url = 'http://%s/capacity' % (target_server,)
+            response = peer_client.get(url)
+            if response.status_code == requests.codes.ok and json.loads(response.text)['free'] >= get_stored_file_size(metadata, filename):
                 # 3) Copy the file to that server.
                 clone_file(request.args.get('uuid'), target_server, 'DISTRIBUTED_REPLICATE', ip_address)
     else:
@@ -390,10 +700,14 @@ if __name__ == '__main__':
     parser.add_argument('--with-debug', action='store_true', help='starts the server with debug mode')
     parser.add_argument('--use-dist-replication', choices=[DIST_HEURISTIC, DIST_GREEDY], help='enables the distributed replication')
     parser.add_argument('--clear-metadata', action='store_true', help='the server should clear the metadata upon starting')
+    parser.add_argument('--disable-metadata-pool', action='store_true', help='open a new metadata connection for every request')
+    parser.add_argument('--real-file-sizes', action='store_true', help='size files with os.stat instead of reading the emulated size from their content')
 
     args = vars(parser.parse_args())
     server_list_file = args['serverlist']
     app.config[USE_DIST_REPLICATION] = args[USE_DIST_REPLICATION]
+    app.config[USE_METADATA_POOL] = not args['disable_metadata_pool']
+    app.config[EMULATE_FILE_SIZE] = not args['real_file_sizes']
 
     # Populate when there are arguments
     if args['host'] is not None:
@@ -412,6 +726,7 @@ if __name__ == '__main__':
         server_list = server_file.readlines()
 
     # Update the metadata
+    metadata_manager.initialize()
     metadata = metadata_manager.MetadataManager()
     current_machine = hostname + ':' + port
     if args['clear_metadata'] is not None and args['clear_metadata']:
@@ -433,7 +748,15 @@ if __name__ == '__main__':
     else:
         metadata.update_servers(server_list)
 
+    metadata.close()
+    if app.config[USE_METADATA_POOL]:
+        if int(processes) > 1:
+            metadata_manager.prepare_forked_workers()
+        else:
+            metadata_manager.get_pool()
+
     # Start Flask
     app.config['HOST'] = current_machine # todo: not sure if this is correct.
+    app.config['processes'] = int(processes)
     print ('Starting server on ' + current_machine + ' with ' + str(processes) + ' processes and debug turned on: ' + str(start_with_debug))
     app.run(host='0.0.0.0', port=int(port), processes=int(processes), debug=start_with_debug)
@@ -17,12 +17,7 @@ from evaluator import Evaluator
 
 def update_ip_lat_long_map(ip_lat_long_map_file):
   cache = ip_location_cache()
-
-  fd = open(ip_lat_long_map_file, 'r')
-
-  for line in fd:
-    ip, lat, lon, city, region, country = line.split('\t')
-    cache.add_entry_to_cache(ip, lat, lon, city, region, country)
+  cache.bulk_load(ip_lat_long_map_file)
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser()
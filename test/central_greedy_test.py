@@ -0,0 +1,49 @@
+import unittest
+import os
+import sys
+
+# Files to test
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import central_greedy
+from migration import MigrationExecutor
+from stubs import FakeServers
+
+class TestSimpleCentralizedGreedy(unittest.TestCase):
+  def setUp(self):
+    self.servers = FakeServers({ 's1': ['c2'], 's2': [], 's3': ['c1'] })
+    self.servers.patch(self, central_greedy)
+    executor = MigrationExecutor('replicate', max_retries=0, backoff_factor=0)
+    executor.migrate = self.servers.migrate
+    self.greedy = central_greedy.SimpleCentralizedGreedy(executor)
+    self.greedy.server_ranking = { 's1': ['s1', 's2', 's3'], 's2': ['s2', 's1', 's3'], 's3': ['s3', 's2', 's1'] }
+    # reads of c1 from s1 and s2, of c2 from s1 and of c3, which is stored nowhere, from s1
+    self.servers.aggregator.entries = [ (i, 100, uuid, 'a1', None, target, 'READ', 302, 0)
+      for i, (uuid, target) in enumerate([('c1', 's1'), ('c1', 's2'), ('c2', 's1'), ('c3', 's1')]) ]
+
+  def test_replications_use_the_closest_source_and_destination(self):
+    report = self.greedy.execute()
+    # the planned replica of c1 on s1 may not exist yet when copying to s2, so s3 is the source of both
+    # copies. c2 is already on s1 so it goes to s1's nearest server
+    self.assertEqual(sorted(self.servers.moves), [('c1', 's3', 's1'), ('c1', 's3', 's2'), ('c2', 's1', 's2')])
+    self.assertEqual(report['succeeded'], 3)
+
+  def test_failed_replications_are_reported(self):
+    self.servers.failing_uuids.add('c1')
+    report = self.greedy.execute()
+    self.assertEqual(report['succeeded'], 1)
+    self.assertEqual(sorted((task['uuid'], task['destination']) for task in report['failed']), [('c1', 's1'), ('c1', 's2')])
+    self.assertEqual(self.servers.files, { 's1': ['c2'], 's2': ['c2'], 's3': ['c1'] })
+
+    # the next round plans the failed copies again from the replicas that exist
+    self.servers.failing_uuids.clear()
+    self.servers.aggregator.entries = [ (0, 200, 'c1', 'a1', None, 's2', 'READ', 302, 0) ]
+    self.greedy.execute()
+    self.assertEqual(self.servers.moves[-1], ('c1', 's3', 's2'))
+
+  def test_planned_replicas_are_not_copied_to_again(self):
+    self.greedy.update()
+    self.assertEqual(self.greedy.plan_replication('c1', 's1', set(['s1'])), ('s3', 's2'))
+    self.assertEqual(self.greedy.plan_replication('c1', 's1', set(['s1', 's2'])), None)
+
+if __name__ == '__main__':
+  unittest.main()
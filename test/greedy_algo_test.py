@@ -0,0 +1,140 @@
+import unittest
+import mock
+import os
+import sys
+
+# Files to test
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import greedy_algo
+from stubs import FakeServers, FixedAggregator
+
+# Two servers and four clients, where every content has enough replicas.
+def fixed_greedy(distance_slack = greedy_algo.DISTANCE_SLACK):
+  greedy = greedy_algo.GreedyReplication(distance_slack)
+  greedy.client_set = set(['a1', 'a2', 'a3'])
+  greedy.content_set = set(['c1', 'c2'])
+  greedy.requests_per_replica = 3
+  greedy.client_servers = { 'a1': frozenset(['s1']), 'a2': frozenset(['s1']), 'a3': frozenset(['s2']), 'a4': frozenset(['s1', 's2']) }
+  greedy.access_map = { 'c1': { 'a1': 2, 'a2': 1, 'a3': 3 }, 'c2': { 'a3': 1 } }
+  greedy.replica_map = { 'c1': { 's1': 1, 's2': 1 }, 'c2': { 's2': 1 } }
+  greedy.last_rowid = 0
+  greedy.update_demand()
+  return greedy
+
+class TestGreedyReplication(unittest.TestCase):
+  def setUp(self):
+    self.servers = FakeServers({ 's1': ['c1'], 's2': ['c1', 'c2'] })
+    self.servers.patch(self, greedy_algo)
+    self.greedy = fixed_greedy()
+
+  def test_demand_is_aggregated_by_eligible_servers(self):
+    self.assertEqual(self.greedy.demand_map, { 'c1': { frozenset(['s1']): 3, frozenset(['s2']): 3 }, 'c2': { frozenset(['s2']): 1 } })
+    self.assertTrue(self.greedy.enough_replica())
+
+  def test_perturbations_match_recomputing(self):
+    for c, accesses in self.greedy.access_map.items():
+      for a in accesses.keys():
+        for s in [None, 's1', 's2']:
+          expected = fixed_greedy()
+          expected.access_map[c][a] += 0.3
+          if s is not None:
+            expected.replica_map[c][s] = expected.replica_map[c].get(s, 0) + 1
+          expected.update_demand()
+          self.assertEqual(self.greedy.enough_replica_after(c, a, 0.3, s, 1 if s is not None else 0), expected.enough_replica())
+
+  def test_record_replica_updates_starved_contents(self):
+    self.greedy.access_map['c2']['a1'] = 1
+    self.greedy.update_demand()
+    self.assertFalse(self.greedy.enough_replica_for_content('c2'))
+    self.greedy.record_replica('c2', 's1')
+    self.assertTrue(self.greedy.enough_replica_for_content('c2'))
+    self.assertTrue(self.greedy.enough_replica())
+
+  def test_demand_is_moved_to_other_eligible_servers(self):
+    # s1 is full with the requests of a1 and a2, so a4 is served by what a3 leaves on s2
+    self.greedy.access_map['c1']['a4'] = 3
+    self.greedy.replica_map['c1'] = { 's1': 1, 's2': 2 }
+    self.greedy.update_demand()
+    self.assertTrue(self.greedy.enough_replica())
+    self.assertFalse(self.greedy.enough_replica_after('c1', 'a4', 0.3))
+    self.assertTrue(self.greedy.enough_replica_after('c1', 'a4', 0.3, 's2', 1))
+    self.assertEqual(greedy_algo.find_unmet_demand({ frozenset(['s1']): 2, frozenset(['s1', 's2']): 2 }, { 's1': 2, 's2': 1 }), 1)
+
+  def test_add_replica_only_replicates_to_needed_servers(self):
+    self.greedy.server_set.add('s3')
+    self.greedy.access_map['c2']['a1'] = 1
+    self.greedy.access_map['c3'] = { 'a3': 4 }
+    self.greedy.replica_map['c3'] = { 's2': 1 }
+    self.greedy.content_set.add('c3')
+    self.greedy.update_demand()
+    self.greedy.add_replica(0.3, 1)
+    # c3 has no server left to replicate to, so only c2 is copied to s1 instead of to every server
+    self.assertEqual(self.servers.moves, [('c2', 's2', 's1')])
+    self.assertTrue(self.greedy.enough_replica_for_content('c2'))
+    self.assertFalse(self.greedy.enough_replica_for_content('c3'))
+
+  def test_failed_batch_copy_leaves_content_starved(self):
+    self.servers.failing_uuids.add('c2')
+    self.greedy.access_map['c2']['a1'] = 1
+    self.greedy.update_demand()
+    self.greedy.add_replica(0.3, 1)
+    self.assertEqual(self.servers.moves, [('c2', 's2', 's1')])
+    self.assertEqual(self.greedy.replica_map['c2'], { 's2': 1 })
+    self.assertFalse(self.greedy.enough_replica_for_content('c2'))
+
+    # the next round copies it again
+    self.servers.failing_uuids.clear()
+    self.greedy.add_replica(0.3, 1)
+    self.assertEqual(self.servers.moves, [('c2', 's2', 's1'), ('c2', 's2', 's1')])
+    self.assertTrue(self.greedy.enough_replica())
+
+  def test_failed_copy_is_not_recorded(self):
+    self.servers.failing_uuids.add('c2')
+    self.greedy.access_map['c2']['a1'] = 1
+    self.greedy.update_demand()
+    self.greedy.replicate('c2', 's2', 's1')
+    self.assertEqual(self.greedy.replica_map['c2'], { 's2': 1 })
+    self.assertFalse(self.greedy.enough_replica_for_content('c2'))
+    self.servers.failing_uuids.clear()
+    self.greedy.replicate('c2', 's2', 's1')
+    self.assertEqual(self.greedy.replica_map['c2'], { 's1': 1, 's2': 1 })
+    self.assertTrue(self.greedy.enough_replica_for_content('c2'))
+
+  def test_clients_are_served_by_servers_within_the_distance_slack(self):
+    rankings = { 'a5': [ { 'server': 's1', 'distance': 100 }, { 'server': 's2', 'distance': 600 }, { 'server': 's3', 'distance': 601 } ] }
+    with mock.patch.object(greedy_algo.util, 'find_closest_servers_with_ip', side_effect=lambda a, servers: rankings[a]):
+      # c2 is only on s2, which is exactly DISTANCE_SLACK farther than a5's nearest server
+      self.assertEqual(greedy_algo.DISTANCE_SLACK, 500)
+      self.greedy.client_set.add('a5')
+      self.greedy.access_map['c2']['a5'] = 1
+      self.greedy.update_demand()
+      self.assertEqual(self.greedy.client_servers['a5'], frozenset(['s1', 's2']))
+      self.assertTrue(self.greedy.enough_replica_for_content('c2'))
+
+      strict = fixed_greedy(greedy_algo.DISTANCE_SLACK - 1)
+      strict.client_set.add('a5')
+      strict.access_map['c2']['a5'] = 1
+      strict.update_demand()
+      self.assertEqual(strict.client_servers['a5'], frozenset(['s1']))
+      self.assertFalse(strict.enough_replica_for_content('c2'))
+
+  def test_update_applies_new_log_entries(self):
+    self.greedy.aggregator = FixedAggregator([
+      (7, 100, 'c1', 'a1', None, 's1', 'TRANSFER', 200, 10),
+      (5, 99, 'c1', 'a1', None, 's3', 'WRITE', 201, 0),
+      (6, 100, 'c2', 'a1', None, 's1', 'READ', 200, 10),
+      (8, 101, 'c3', 'a1', None, 's1', 'READ', 200, 10),
+      (9, 101, 'c2', 'a1', None, 's2', 'WRITE', 400, -1)
+    ])
+    self.greedy.update()
+    self.assertEqual(self.greedy.last_rowid, 9)
+    self.assertEqual(self.greedy.last_timestamp, 101)
+    self.assertEqual(self.greedy.replica_map, { 'c1': { 's2': 1, 's3': 1 }, 'c2': { 's2': 1 } })
+    self.assertEqual(self.greedy.access_map, { 'c2': { 'a1': 1 } })
+
+    self.greedy.update()
+    self.assertEqual(self.greedy.last_rowid, 9)
+    self.assertEqual(self.greedy.access_map, {})
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,109 @@
+import unittest
+import BaseHTTPServer
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+# Files to test
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'cache'))
+import ip_location_cache
+
+# Stands in for the lookup service: answers the known addresses, and reports every other one as a bogon.
+class StubLookupHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  locations = { '4.4.4.4': '51.5085,-0.1257' }
+  requested = []
+
+  def do_GET(self):
+    ip = self.path.split('/')[1]
+    StubLookupHandler.requested.append(ip)
+    if ip in self.locations:
+      body = { 'ip': ip, 'loc': self.locations[ip], 'city': 'London', 'region': 'England', 'country': 'GB' }
+    else:
+      body = { 'ip': ip, 'bogon': True }
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.end_headers()
+    self.wfile.write(json.dumps(body))
+
+  def log_message(self, format, *args):
+    pass
+
+class TestIpLocationResolver(unittest.TestCase):
+  def setUp(self):
+    self.working_directory = tempfile.mkdtemp()
+    self.cache_file = ip_location_cache.IP_LOCATION_CACHE
+    ip_location_cache.IP_LOCATION_CACHE = os.path.join(self.working_directory, 'ip_location_cache.db')
+    cache = ip_location_cache.ip_location_cache()
+    cache.add_entry_to_cache('1.1.1.1', 42.2733204, -83.7376894, 'Ann Arbor', 'Michigan', 'US')
+    cache.add_entry_to_cache('2.2.2.2', 37.7577, -122.4376, 'San Francisco', 'California', 'US')
+    cache.add_entry_to_cache('3.3.3.3', 35.6833, 139.6833, 'Tokyo', 'Tokyo', 'JP')
+
+  def test_warm_up_loads_the_cached_locations(self):
+    resolver = ip_location_cache.ip_location_resolver()
+    resolver.warm_up()
+    self.assertEqual(len(resolver.locations), 3)
+    self.assertEqual(resolver.get_lat_lon_from_ip('1.1.1.1'), (42.2733204, -83.7376894))
+
+  def test_least_recently_used_locations_are_evicted(self):
+    resolver = ip_location_cache.ip_location_resolver(capacity=2)
+    resolver.get_lat_lon_from_ip('1.1.1.1')
+    resolver.get_lat_lon_from_ip('2.2.2.2')
+    resolver.get_lat_lon_from_ip('1.1.1.1')
+    locations = resolver.get_many(['3.3.3.3', '1.1.1.1'])
+    self.assertEqual(locations, { '1.1.1.1': (42.2733204, -83.7376894), '3.3.3.3': (35.6833, 139.6833) })
+    self.assertEqual(list(resolver.locations.keys()), ['1.1.1.1', '3.3.3.3'])
+
+  def test_shared_resolver_is_reused(self):
+    ip_location_cache.resolvers.clear()
+    self.assertIs(ip_location_cache.get_shared_resolver(), ip_location_cache.get_shared_resolver())
+    ip_location_cache.resolvers.clear()
+
+  def test_bulk_load_strips_line_endings(self):
+    map_file = os.path.join(self.working_directory, 'ip_lat_long_map.txt')
+    with open(map_file, 'wb') as ip_map:
+      ip_map.write('5.5.5.1\t43.667872\t-116.367188\tBoise\tIdaho\tUS\n5.5.5.2\t40.538852\t-120.498047\tSusanville\tCalifornia\tUS\r\n\n')
+    cache = ip_location_cache.ip_location_cache()
+    self.assertEqual(cache.bulk_load(map_file), 2)
+    cache.cursor.execute('SELECT ip, lat, long, country FROM IpLocationMap WHERE ip LIKE ? ORDER BY ip', ('5.5.5.%',))
+    self.assertEqual(cache.cursor.fetchall(), [('5.5.5.1', 43.667872, -116.367188, 'US'), ('5.5.5.2', 40.538852, -120.498047, 'US')])
+
+  def test_misses_are_prefetched_and_unresolvable_ones_remembered(self):
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StubLookupHandler)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.start()
+    lookup_url = ip_location_cache.LOOKUP_URL
+    ip_location_cache.LOOKUP_URL = 'http://127.0.0.1:%d/%%s/json' % (server.server_address[1],)
+    try:
+      cache = ip_location_cache.ip_location_cache()
+      locations = cache.prefetch(['1.1.1.1', '4.4.4.4', '10.0.0.1'], requests_per_second=100)
+      self.assertEqual(locations, { '4.4.4.4': (51.5085, -0.1257), '10.0.0.1': None })
+      self.assertEqual(sorted(StubLookupHandler.requested), ['10.0.0.1', '4.4.4.4'])
+
+      self.assertEqual(cache.get_many(['4.4.4.4', '10.0.0.1']), { '4.4.4.4': (51.5085, -0.1257), '10.0.0.1': None })
+      self.assertIsNone(cache.get_lat_lon_from_ip('10.0.0.1'))
+      self.assertEqual(len(StubLookupHandler.requested), 2)
+    finally:
+      ip_location_cache.LOOKUP_URL = lookup_url
+      server.shutdown()
+      server_thread.join()
+      server.server_close()
+
+  def test_offline_misses_are_not_remembered(self):
+    ip_location_cache.OFFLINE = True
+    try:
+      cache = ip_location_cache.ip_location_cache()
+      self.assertEqual(cache.prefetch(['10.0.0.1']), { '10.0.0.1': None })
+      self.assertIsNone(cache.get_lat_lon_from_ip('10.0.0.2'))
+      self.assertEqual(sorted(cache.find_misses(['10.0.0.1', '10.0.0.2'])), ['10.0.0.1', '10.0.0.2'])
+    finally:
+      ip_location_cache.OFFLINE = False
+
+  def tearDown(self):
+    ip_location_cache.IP_LOCATION_CACHE = self.cache_file
+    shutil.rmtree(self.working_directory)
+
+if __name__ == '__main__':
+  unittest.main()
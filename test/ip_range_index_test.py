@@ -0,0 +1,65 @@
+import unittest
+import os
+import shutil
+import sys
+import tempfile
+
+# Files to test
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'cache'))
+import ip_location_cache
+import ip_range_index
+
+ANN_ARBOR = (42.2733204, -83.7376894, 'Ann Arbor', 'Michigan', 'US')
+SAN_FRANCISCO = (37.7577, -122.4376, 'San Francisco', 'California', 'US')
+TOKYO = (35.6833, 139.6833, 'Tokyo', 'Tokyo', 'JP')
+
+class TestIpRangeIndex(unittest.TestCase):
+  def setUp(self):
+    self.working_directory = tempfile.mkdtemp()
+
+  def add_network(self, index, network, location):
+    start, end = ip_range_index.parse_network(network)
+    index.add_range(start, end, location)
+
+  def test_most_specific_range_wins(self):
+    index = ip_range_index.ip_range_index()
+    self.add_network(index, '5.0.0.0/8', ANN_ARBOR)
+    self.add_network(index, '5.5.5.0/24', SAN_FRANCISCO)
+    self.add_network(index, '5.5.5.7', TOKYO)
+    index.build()
+    self.assertEqual(len(index), 5)
+    self.assertEqual(index.lookup('5.1.2.3'), ANN_ARBOR)
+    self.assertEqual(index.lookup('5.5.5.6'), SAN_FRANCISCO)
+    self.assertEqual(index.lookup('5.5.5.7'), TOKYO)
+    self.assertEqual(index.lookup('5.5.5.8'), SAN_FRANCISCO)
+    self.assertEqual(index.lookup('5.255.255.255'), ANN_ARBOR)
+    self.assertIsNone(index.lookup('6.0.0.0'))
+    self.assertIsNone(index.lookup('not an ip'))
+
+  def test_cache_misses_are_resolved_from_imported_map(self):
+    map_file = os.path.join(self.working_directory, 'ip_lat_long_map.txt')
+    with open(map_file, 'wb') as ip_map:
+      ip_map.write('5.5.5.1\t43.667872\t-116.367188\tBoise\tIdaho\tUS\n\n')
+    range_file = os.path.join(self.working_directory, 'ip_ranges.txt')
+    self.assertEqual(ip_range_index.import_ip_lat_long_map(map_file, range_file, 24), 1)
+
+    original_range_file = ip_range_index.RANGE_FILE
+    original_cache_file = ip_location_cache.IP_LOCATION_CACHE
+    original_offline = ip_location_cache.OFFLINE
+    ip_range_index.RANGE_FILE = range_file
+    ip_location_cache.IP_LOCATION_CACHE = os.path.join(self.working_directory, 'ip_location_cache.db')
+    ip_location_cache.OFFLINE = True
+    try:
+      cache = ip_location_cache.ip_location_cache()
+      self.assertEqual(cache.get_lat_lon_from_ip('5.5.5.200'), (43.667872, -116.367188))
+      self.assertEqual(cache.get_many(['5.5.5.200', '6.6.6.6']), { '5.5.5.200': (43.667872, -116.367188), '6.6.6.6': None })
+    finally:
+      ip_range_index.RANGE_FILE = original_range_file
+      ip_location_cache.IP_LOCATION_CACHE = original_cache_file
+      ip_location_cache.OFFLINE = original_offline
+
+  def tearDown(self):
+    shutil.rmtree(self.working_directory)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+import os
+import shutil
+import sys
+import tempfile
+
+# Files to test
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import logger
+
+class TestLogger(unittest.TestCase):
+  def setUp(self):
+    self.working_directory = tempfile.mkdtemp()
+    self.current_directory = os.getcwd()
+    os.chdir(self.working_directory)
+    os.makedirs(logger.LOG_DIRECTORY)
+    self.writer = logger.BufferedLogWriter(flush_interval=60)
+
+  def read_log(self, date):
+    with open(os.path.join(logger.LOG_DIRECTORY, date + '.log'), 'rb') as log:
+      return log.read()
+
+  def test_entries_are_buffered_until_flush(self):
+    self.writer.append(1427328000, 'first\n')
+    self.writer.append(1427328001, 'second\n')
+    self.assertFalse(os.path.exists(os.path.join(logger.LOG_DIRECTORY, '2015-03-26.log')))
+    self.writer.flush()
+    self.assertEqual(self.read_log('2015-03-26'), 'first\nsecond\n')
+
+  def test_entries_rotate_by_day(self):
+    self.writer.append(1427414399, 'before midnight\n')
+    self.writer.append(1427414400, 'after midnight\n')
+    self.writer.flush()
+    self.assertEqual(self.read_log('2015-03-26'), 'before midnight\n')
+    self.assertEqual(self.read_log('2015-03-27'), 'after midnight\n')
+
+  def tearDown(self):
+    self.writer.stop()
+    os.chdir(self.current_directory)
+    shutil.rmtree(self.working_directory)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,128 @@
+import unittest
+import mock
+import os
+import shutil
+import sys
+import tempfile
+
+# Files to test
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import metadata_manager
+
+class TestMetadataManager(unittest.TestCase):
+  def setUp(self):
+    self.working_directory = tempfile.mkdtemp()
+    self.current_directory = os.getcwd()
+    os.chdir(self.working_directory)
+    self.pool = metadata_manager.MetadataPool()
+    self.metadata = self.pool.acquire()
+
+  def test_pooled_writes_are_visible_before_commit(self):
+    self.metadata.update_file_stored('1', 'localhost:5000', 100)
+    self.assertEqual(self.metadata.file_exists_on_server('1', 'localhost:5000'), ('1', 'localhost:5000', 100))
+    self.assertEqual(self.pool.pending_writes, 1)
+    self.pool.flush()
+    unpooled = metadata_manager.MetadataManager()
+    self.assertEqual(tuple(unpooled.file_exists_on_server('1', 'localhost:5000')), ('1', 'localhost:5000', 100))
+    unpooled.close()
+
+  def test_location_index_write_through(self):
+    self.metadata.update_file_stored('1', 'localhost:5000', 100)
+    self.metadata.update_file_stored('1', 'localhost:5001', 100)
+    self.assertEqual(self.metadata.lookup_file('1', 'localhost:5000'), 'localhost:5001')
+    self.metadata.delete_file_stored('1', 'localhost:5001')
+    self.assertIsNone(self.metadata.lookup_file('1', 'localhost:5000'))
+    self.assertIsNone(self.metadata.file_exists_on_server('2', 'localhost:5000'))
+
+  def test_location_index_evicts_least_recently_used(self):
+    self.pool.index.capacity = 2
+    self.metadata.update_file_stored('1', 'localhost:5000', 100)
+    self.metadata.update_file_stored('2', 'localhost:5000', 200)
+    self.metadata.update_file_stored('3', 'localhost:5000', 300)
+    self.assertFalse(self.pool.index.complete)
+    self.assertNotIn('1', self.pool.index.entries)
+    # evicted uuids are read back from sqlite
+    self.assertEqual(self.metadata.file_exists_on_server('1', 'localhost:5000'), ('1', 'localhost:5000', 100))
+
+  def test_location_index_reloads_after_external_write(self):
+    self.pool.flush()
+    unpooled = metadata_manager.MetadataManager()
+    unpooled.update_file_stored('1', 'localhost:5001', 100)
+    unpooled.close()
+    metadata = self.pool.acquire()
+    self.assertEqual(metadata.lookup_file('1', 'localhost:5000'), 'localhost:5001')
+
+  def test_storage_usage_follows_writes_and_deletes(self):
+    self.metadata.update_file_stored('1', 'localhost:5000', 100)
+    self.metadata.update_file_stored('2', 'localhost:5000', 200)
+    self.metadata.update_file_stored('2', 'localhost:5000', 250)
+    self.metadata.update_file_stored('2', 'localhost:5001', 250)
+    self.assertEqual(self.metadata.get_storage_used('localhost:5000'), 350)
+    self.metadata.delete_file_stored('1', 'localhost:5000')
+    self.metadata.delete_file_stored('1', 'localhost:5000')
+    self.assertEqual(self.metadata.get_storage_used('localhost:5000'), 250)
+    self.assertEqual(self.metadata.get_storage_used('localhost:5001'), 250)
+
+  def test_locations_of_many_files(self):
+    self.metadata.update_file_stored('1', 'localhost:5000', 100)
+    self.metadata.update_file_stored('1', 'localhost:5001', 100)
+    self.metadata.update_file_stored('2', 'localhost:5001', 200)
+    expected = { '1': { 'localhost:5000': 100, 'localhost:5001': 100 }, '2': { 'localhost:5001': 200 } }
+    self.assertEqual(self.metadata.get_locations_of_files(['1', '2', '3']), expected)
+    self.pool.flush()
+    unpooled = metadata_manager.MetadataManager()
+    self.assertEqual(unpooled.get_locations_of_files(['1', '2', '3']), expected)
+    unpooled.close()
+
+  def test_file_map_pages(self):
+    self.metadata.update_file_stored('1', 'localhost:5000', 100)
+    self.metadata.update_file_stored('1', 'localhost:5001', 100)
+    self.metadata.update_file_stored('2', 'localhost:5000', 200)
+    first_page = self.metadata.get_file_map_page('', '', 2)
+    self.assertEqual(first_page, [('1', 'localhost:5000', 100), ('1', 'localhost:5001', 100)])
+    second_page = self.metadata.get_file_map_page(first_page[-1][0], first_page[-1][1], 2)
+    self.assertEqual(second_page, [('2', 'localhost:5000', 200)])
+
+  def test_pool_is_created_once_per_process(self):
+    with mock.patch.dict(metadata_manager.pools, clear=True):
+      with mock.patch('os.getpid', return_value=1):
+        pool = metadata_manager.get_pool()
+        self.assertIs(metadata_manager.get_pool(), pool)
+      # a forked worker reuses the schema of the process that started the server and keeps no index
+      with mock.patch('os.getpid', return_value=2):
+        worker_pool = metadata_manager.get_pool()
+        self.assertIs(metadata_manager.get_pool(), worker_pool)
+        self.assertIsNone(worker_pool.index)
+        self.assertIsNone(worker_pool.flusher)
+      worker_pool.close()
+      pool.close()
+
+  def test_forked_workers_keep_no_index(self):
+    with mock.patch.dict(metadata_manager.pools, clear=True):
+      with mock.patch.object(metadata_manager, 'forked_workers', False):
+        metadata_manager.prepare_forked_workers()
+        self.assertEqual(metadata_manager.pools, {})
+        with mock.patch('os.getpid', return_value=2):
+          worker_pool = metadata_manager.get_pool()
+          self.assertIsNone(worker_pool.index)
+          worker_pool.close()
+
+  def test_shutdown_closes_the_pool_of_the_process(self):
+    with mock.patch.dict(metadata_manager.pools, clear=True):
+      with mock.patch('os.getpid', return_value=1):
+        pool = metadata_manager.get_pool()
+        pool.acquire().update_file_stored('1', 'localhost:5000', 100)
+        metadata_manager.shutdown()
+        self.assertEqual(metadata_manager.pools, {})
+    unpooled = metadata_manager.MetadataManager()
+    self.assertEqual(unpooled.get_file_list_on_server('localhost:5000'), [('1',)])
+    unpooled.close()
+
+  def tearDown(self):
+    self.metadata.close()
+    self.pool.close()
+    os.chdir(self.current_directory)
+    shutil.rmtree(self.working_directory)
+
+if __name__ == '__main__':
+  unittest.main()
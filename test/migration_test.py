@@ -0,0 +1,80 @@
+import unittest
+import mock
+import os
+import shutil
+import sys
+import tempfile
+
+# Files to test
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from migration import MigrationExecutor
+from stubs import FakeServers
+
+class TestMigrationExecutor(unittest.TestCase):
+  def setUp(self):
+    self.working_directory = tempfile.mkdtemp()
+    self.journal_file = os.path.join(self.working_directory, 'journal.txt')
+    self.tasks = [
+      { 'uuid': '1', 'source': 'localhost:5000', 'destination': 'localhost:5001', 'file_size': 10 },
+      { 'uuid': '2', 'source': 'localhost:5000', 'destination': 'localhost:5002', 'file_size': 20 },
+      { 'uuid': '3', 'source': 'localhost:5001', 'destination': 'localhost:5002', 'file_size': 30 },
+    ]
+
+  def test_failed_migration_is_resumed_from_journal(self):
+    servers = FakeServers({ 'localhost:5000': ['1', '2'], 'localhost:5001': ['3'] }, failing_uuids=['2'])
+    executor = MigrationExecutor(journal_file=self.journal_file, max_retries=1, backoff_factor=0)
+    executor.migrate = servers.migrate
+    report = executor.execute(self.tasks)
+    self.assertEqual(report['succeeded'], 2)
+    self.assertEqual(report['bytes_moved'], 40)
+    self.assertEqual([ task['uuid'] for task in report['failed'] ], ['2'])
+    # the failed migration is tried once more, and the journal keeps the completed ones
+    self.assertEqual(sorted(move[0] for move in servers.moves), ['1', '2', '2', '3'])
+    self.assertTrue(os.path.exists(self.journal_file))
+
+    servers.failing_uuids.clear()
+    report = executor.execute(self.tasks)
+    self.assertEqual(report['succeeded'], 1)
+    self.assertEqual(report['skipped'], 2)
+    self.assertEqual(servers.moves[-1], ('2', 'localhost:5000', 'localhost:5002'))
+    self.assertFalse(os.path.exists(self.journal_file))
+
+  def test_failed_migration_does_not_block_its_servers(self):
+    servers = FakeServers({ 'localhost:5000': [ str(i) for i in range(4) ] }, failing_uuids=['0', '1'])
+    executor = MigrationExecutor(per_source_limit=1, per_destination_limit=1, max_retries=0, backoff_factor=0)
+    executor.migrate = servers.migrate
+    tasks = [ { 'uuid': str(i), 'source': 'localhost:5000', 'destination': 'localhost:5001', 'file_size': 1 } for i in range(4) ]
+    report = executor.execute(tasks)
+    self.assertEqual(report['succeeded'], 2)
+    self.assertEqual(sorted(task['uuid'] for task in report['failed']), ['0', '1'])
+    self.assertEqual(servers.files['localhost:5001'], ['2', '3'])
+
+  def test_per_source_limit(self):
+    executor = MigrationExecutor(per_source_limit=1, per_destination_limit=10)
+    active_sources = []
+    def migrate(task):
+      active_sources.append(executor.active_sources[task['source']])
+      return True
+    executor.migrate = mock.Mock(side_effect=migrate)
+    tasks = [ { 'uuid': str(i), 'source': 'localhost:5000', 'destination': 'localhost:500' + str(i), 'file_size': 1 } for i in range(5) ]
+    report = executor.execute(tasks)
+    self.assertEqual(report['succeeded'], 5)
+    self.assertEqual(max(active_sources), 1)
+
+  def test_per_destination_limit(self):
+    executor = MigrationExecutor(per_source_limit=10, per_destination_limit=1)
+    active_destinations = []
+    def migrate(task):
+      active_destinations.append(executor.active_destinations[task['destination']])
+      return True
+    executor.migrate = mock.Mock(side_effect=migrate)
+    tasks = [ { 'uuid': str(i), 'source': 'localhost:500' + str(i % 3), 'destination': 'localhost:600' + str(i % 2), 'file_size': 1 } for i in range(12) ]
+    report = executor.execute(tasks)
+    self.assertEqual(report['succeeded'], 12)
+    self.assertEqual(max(active_destinations), 1)
+
+  def tearDown(self):
+    shutil.rmtree(self.working_directory)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,80 @@
+import os
+import sys
+
+import mock
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import util
+
+# Stands in for the aggregator, returning the given log entries once.
+#
+# params:
+#   entries: [(rowid, timestamp, uuid, source, source_uuid, dest, req_type, status, response_size), ]
+class FixedAggregator:
+  def __init__(self, entries = []):
+    self.entries = list(entries)
+
+  def get_log_entries_since(self, rowid):
+    entries = [ entry for entry in self.entries if entry[0] > rowid ]
+    self.entries = []
+    return entries
+
+  def get_redirect_log_entries(self, start_timestamp, end_timestamp):
+    entries = [ entry[1:] for entry in self.entries if entry[6] == 'READ' and entry[7] == requests.codes.found ]
+    self.entries = []
+    return entries
+
+# Stands in for the servers the replication algorithms and the migration executor talk to.
+# Every copy asked of them is recorded, and the copies of the failing uuids fail.
+#
+# params:
+#   files: { server: [uuid, ] }, the files stored on every server
+#   failing_uuids: the uuids whose copies fail
+class FakeServers:
+  def __init__(self, files, failing_uuids = []):
+    self.files = files
+    self.failing_uuids = set(failing_uuids)
+    self.aggregator = FixedAggregator()
+    self.moves = [] # [(uuid, source, destination), ] in the order they were asked for
+
+  def copy(self, file_uuid, source, destination):
+    self.moves.append((file_uuid, source, destination))
+    if file_uuid in self.failing_uuids:
+      return False
+    self.files.setdefault(destination, [])
+    if file_uuid not in self.files[destination]:
+      self.files[destination].append(file_uuid)
+    return True
+
+  def replicate(self, file_uuid, source_ip, dest_ip):
+    return self.copy(file_uuid, source_ip, dest_ip)
+
+  def replicate_batch(self, source_ip, moves, method = 'REPLICATE'):
+    statuses = []
+    for file_uuid, dest_ip in moves:
+      succeeded = self.copy(file_uuid, source_ip, dest_ip)
+      statuses.append({ 'uuid': file_uuid, 'destination': dest_ip, 'status': requests.codes.ok if succeeded else requests.codes.internal_server_error })
+    return statuses
+
+  # MigrationExecutor.migrate
+  def migrate(self, task):
+    return self.copy(task['uuid'], task['source'], task['destination'])
+
+  # Points util and the aggregator of the module under test at these servers until the test ends.
+  #
+  # params:
+  #   test_case: the running unittest.TestCase
+  #   module: the module under test, whose Aggregator is replaced
+  def patch(self, test_case, module):
+    patchers = [
+      mock.patch.object(util, 'retrieve_server_list', side_effect=lambda: sorted(self.files.keys())),
+      mock.patch.object(util, 'get_file_list_on_server', side_effect=lambda server: list(self.files.get(server, []))),
+      mock.patch.object(util, 'convert_to_local_hostname', side_effect=lambda server: server),
+      mock.patch.object(util, 'replicate', side_effect=self.replicate),
+      mock.patch.object(util, 'replicate_batch', side_effect=self.replicate_batch),
+      mock.patch.object(module, 'Aggregator', return_value=self.aggregator),
+    ]
+    for patcher in patchers:
+      patcher.start()
+      test_case.addCleanup(patcher.stop)
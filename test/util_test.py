@@ -0,0 +1,47 @@
+import unittest
+import os
+import shutil
+import sys
+import tempfile
+
+# Files to test
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import util
+
+class TestSimulationIpMapping(unittest.TestCase):
+  def setUp(self):
+    self.working_directory = tempfile.mkdtemp()
+    self.files = (util.SERVER_LIST_FILE, util.SIMULATION_IP_FILE)
+    util.SERVER_LIST_FILE = os.path.join(self.working_directory, 'servers.txt')
+    util.SIMULATION_IP_FILE = os.path.join(self.working_directory, 'simulation_ip.txt')
+    with open(util.SERVER_LIST_FILE, 'wb') as server_file:
+      server_file.write('localhost:5000\nlocalhost:5001\n')
+    self.write_simulation_ips('4.4.4.1\n4.4.4.2\n', 1000)
+
+  def write_simulation_ips(self, simulation_ips, mtime):
+    with open(util.SIMULATION_IP_FILE, 'wb') as simulation_ip_file:
+      simulation_ip_file.write(simulation_ips)
+    os.utime(util.SIMULATION_IP_FILE, (mtime, mtime))
+
+  def test_mapping_goes_both_ways(self):
+    self.assertEqual(util.convert_to_simulation_ip('localhost:5001'), '4.4.4.2')
+    self.assertEqual(util.convert_to_local_hostname('4.4.4.1'), 'localhost:5000')
+    self.assertEqual(util.convert_to_simulation_ip('5.5.5.5'), '5.5.5.5')
+    self.assertEqual(util.convert_to_local_hostname('5.5.5.5'), '5.5.5.5')
+
+  def test_mapping_is_reloaded_when_a_file_changes(self):
+    self.assertEqual(util.convert_to_simulation_ip('localhost:5000'), '4.4.4.1')
+    self.write_simulation_ips('4.4.4.3\n4.4.4.4\n', 2000)
+    self.assertEqual(util.convert_to_simulation_ip('localhost:5000'), '4.4.4.3')
+    self.assertEqual(util.convert_to_local_hostname('4.4.4.1'), '4.4.4.1')
+
+  def test_no_simulation_ips(self):
+    os.remove(util.SIMULATION_IP_FILE)
+    self.assertEqual(util.convert_to_simulation_ip('localhost:5000'), 'localhost:5000')
+
+  def tearDown(self):
+    util.SERVER_LIST_FILE, util.SIMULATION_IP_FILE = self.files
+    shutil.rmtree(self.working_directory)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,19 +1,28 @@
 # Utility class
 import geopy
+import json
 import os
 import requests
+import threading
 import urllib
 import sys
 sys.path.insert(0, 'cache')
 
 # Project imports
 sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cache'))
-from ip_location_cache import ip_location_cache
+from ip_location_cache import ip_location_cache, get_shared_resolver
+import peer_client
 from geopy.distance import great_circle
 
 # Config
 SERVER_LIST_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'servers.txt')
 SIMULATION_IP_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'simulation_ip.txt')
+BATCH_TIMEOUT = 3600    # seconds to wait for a whole /batch_transfer call to complete
+
+# The mapping between local hostnames and simulation ips, loaded from SERVER_LIST_FILE and
+# SIMULATION_IP_FILE and reloaded when the modification time of either file changes.
+simulation_ip_mapping = { 'mtimes': None, 'to_simulation_ip': {}, 'to_local_hostname': {} }
+simulation_ip_mapping_lock = threading.Lock()
 
 # get distance between two (lat,log) pairs
 def get_distance(location1, location2):
@@ -22,14 +31,47 @@ def get_distance(location1, location2):
     dist = great_circle(pt1, pt2).km
     return dist
 
+# Copies a file stored on the source server to the destination server
+# returns: whether the destination stores the file
 def replicate(file_uuid, source_ip, dest_ip):
   print 'Replicate file ' + file_uuid + ' from ' + source_ip + ' to ' + dest_ip
   url = 'http://%s/replicate?%s' % (source_ip, urllib.urlencode({'uuid': file_uuid, 'destination': dest_ip}))
-  r = requests.put(url)
+  try:
+    # replicating the same file to the same destination again leaves the same copy, so it can be retried
+    r = peer_client.put(url, retries=peer_client.MAX_RETRIES)
+  except requests.exceptions.RequestException:
+    print "\t fail!"
+    return False
   if r.status_code == requests.codes.ok:
     print "\t succeed!"
+    return True
   else:
     print "\t fail!"
+    return False
+
+# Moves a batch of files stored on the source server with a single call to its /batch_transfer endpoint
+#
+# params:
+#   source_ip: the server storing the files
+#   moves: a list of (file_uuid, dest_ip) tuples
+#   method: REPLICATE to keep the source copy, TRANSFER to remove it
+# returns: a list of dicts with `uuid`, `destination` and `status`
+def replicate_batch(source_ip, moves, method='REPLICATE'):
+  print 'Batch ' + method + ' of ' + str(len(moves)) + ' files from ' + source_ip
+  url = 'http://%s/batch_transfer' % (source_ip,)
+  body = { 'method': method, 'moves': [ { 'uuid': file_uuid, 'destination': dest_ip } for file_uuid, dest_ip in moves ] }
+  try:
+    r = peer_client.post(url, data=json.dumps(body), headers={ 'Content-Type': 'application/json' }, timeout=BATCH_TIMEOUT)
+  except requests.exceptions.RequestException:
+    print "\t fail!"
+    return [ { 'uuid': file_uuid, 'destination': dest_ip, 'status': requests.codes.service_unavailable } for file_uuid, dest_ip in moves ]
+  if r.status_code != requests.codes.ok:
+    print "\t fail!"
+    return [ { 'uuid': file_uuid, 'destination': dest_ip, 'status': r.status_code } for file_uuid, dest_ip in moves ]
+  statuses = json.loads(r.text)
+  failed = [ status for status in statuses if status['status'] != requests.codes.ok ]
+  print "\t " + str(len(statuses) - len(failed)) + " succeeded, " + str(len(failed)) + " failed"
+  return statuses
 
 # Finds the closest server for a lat/long tuple pair
 #
@@ -59,34 +101,41 @@ def find_closest_servers(self, location, servers_to_search = None):
 # params:
 #   local_ip: the local hostname
 def convert_to_simulation_ip(local_ip):
-    if not os.path.exists(SIMULATION_IP_FILE):
+    mapping = get_simulation_ip_mapping()
+    if mapping is None:
         return local_ip
-    result = local_ip
-    with open(SERVER_LIST_FILE, 'rb') as server_file, open(SIMULATION_IP_FILE, 'rb') as simulation_ip_file:
-        for line in server_file:
-            line = line.strip()
-            simulation_ip = simulation_ip_file.next().strip()
-            if line == local_ip:
-                result = simulation_ip
-                break
-    return result
+    return mapping['to_simulation_ip'].get(local_ip, local_ip)
 
 # Converts the simulation ip address to the local hostname
 #
 # params:
 #   simulation_ip: the simulation ip
 def convert_to_local_hostname(simulation_ip):
-    if not os.path.exists(SIMULATION_IP_FILE):
+    mapping = get_simulation_ip_mapping()
+    if mapping is None:
         return simulation_ip
-    result = simulation_ip
-    with open(SERVER_LIST_FILE, 'rb') as server_file, open(SIMULATION_IP_FILE, 'rb') as simulation_ip_file:
-        for line in simulation_ip_file:
-            line = line.strip()
-            local_ip = server_file.next().strip()
-            if line == simulation_ip:
-                result = local_ip
-                break
-    return result
+    return mapping['to_local_hostname'].get(simulation_ip, simulation_ip)
+
+# Returns the mapping between local hostnames and simulation ips, None when there is no SIMULATION_IP_FILE.
+# The n-th line of SERVER_LIST_FILE maps to the n-th line of SIMULATION_IP_FILE; when a name appears
+# more than once, its first line is used.
+def get_simulation_ip_mapping():
+    try:
+        mtimes = (os.path.getmtime(SERVER_LIST_FILE), os.path.getmtime(SIMULATION_IP_FILE))
+    except OSError:
+        return None
+    with simulation_ip_mapping_lock:
+        if simulation_ip_mapping['mtimes'] != mtimes:
+            to_simulation_ip = {}
+            to_local_hostname = {}
+            with open(SERVER_LIST_FILE, 'rb') as server_file, open(SIMULATION_IP_FILE, 'rb') as simulation_ip_file:
+                for local_ip, simulation_ip in zip(server_file, simulation_ip_file):
+                    to_simulation_ip.setdefault(local_ip.strip(), simulation_ip.strip())
+                    to_local_hostname.setdefault(simulation_ip.strip(), local_ip.strip())
+            simulation_ip_mapping['to_simulation_ip'] = to_simulation_ip
+            simulation_ip_mapping['to_local_hostname'] = to_local_hostname
+            simulation_ip_mapping['mtimes'] = mtimes
+        return simulation_ip_mapping
 
 # Finds the closest server for a lat/long tuple pair
 #
@@ -95,14 +144,14 @@ def convert_to_local_hostname(simulation_ip):
 #   servers_to_search: a list of servers to search. Uses self.servers by default.
 # returns: list of closest to furthest, where each item is a dict with `server` and `distance`
 def find_closest_servers_with_ip(ip_addr, servers):
-    ip_cache = ip_location_cache()
+    resolver = get_shared_resolver()
     servers_to_search = servers
     best_servers = []
+    item_location = resolver.get_lat_lon_from_ip(ip_addr)
     for server in servers_to_search:
         server_dict = { 'server': server, 'distance': None }
         server = convert_to_simulation_ip(server)
-        item_location = ip_cache.get_lat_lon_from_ip(ip_addr)
-        server_lat_lon = ip_cache.get_lat_lon_from_ip(server)
+        server_lat_lon = resolver.get_lat_lon_from_ip(server)
         if server_lat_lon is None:
             raise ValueError('Server <' + server + '> latitude/longitude could not be found!')
         server_location = geopy.Point(server_lat_lon[0], server_lat_lon[1])
@@ -118,9 +167,9 @@ def get_distance_key(server_dict):
 
 # get distance between two ip addresses
 def get_distance_from_ip(ip_addr1, ip_addr2):
-    ip_cache = ip_location_cache()
-    location1 = ip_cache.get_lat_lon_from_ip(ip_addr1)
-    location2 = ip_cache.get_lat_lon_from_ip(ip_addr2)
+    resolver = get_shared_resolver()
+    location1 = resolver.get_lat_lon_from_ip(ip_addr1)
+    location2 = resolver.get_lat_lon_from_ip(ip_addr2)
     return get_distance(location1, location2)
 
 def retrieve_server_list():
@@ -128,20 +177,29 @@ def retrieve_server_list():
         return server_file.read().splitlines()
 
 # Construct a put request which involves a url and a uuid of the file
-def construct_put_request(url, uuid):
-    files = {'file': open(uuid, 'rb')}
-    request = requests.put(url, files)
-    return request
+#
+# params:
+#   files: send the file as a multipart upload instead of as the request data
+def construct_put_request(url, uuid, files=False):
+    return peer_client.put(url, **construct_body(uuid, files))
 
 # Construct a post request which involves a url and a uuid of the file
-def construct_post_request(url, uuid):
-    files = {'file': open(uuid, 'rb')}
-    request = requests.post(url, files)
-    return request
+#
+# params:
+#   files: send the file as a multipart upload instead of as the request data
+def construct_post_request(url, uuid, files=False):
+    return peer_client.post(url, **construct_body(uuid, files))
+
+# Returns the keyword arguments carrying the file in a put or post request
+def construct_body(uuid, files):
+    body = {'file': open(uuid, 'rb')}
+    if files:
+        return { 'files': body }
+    return { 'data': body }
 
 def get_file_list_on_server(server):
     url = 'http://%s/local_file_list' % (server,)
-    request = requests.get(url)
+    request = peer_client.get(url)
     if request.text == '':
       return []
     file_list = request.text.split('\n')
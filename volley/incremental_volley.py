@@ -0,0 +1,189 @@
+# Incremental Volley
+#
+# Keeps running statistics of every item between runs instead of recomputing them from the whole log:
+# the read-weighted sum of the client locations as unit vectors (whose direction is the item's centroid)
+# and the interdependency request counts. Both decay exponentially with the age of the requests.
+# Every run only reads the log entries added since the previous run, and only the items whose
+# optimal location moved more than REPLACEMENT_THRESHOLD kilometers since they were last placed are migrated.
+import json
+import math
+import numpy as np
+import os
+import sqlite3
+import sys
+import time
+
+# Project Imports
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import peer_client
+import spherical
+import util
+import volley
+
+# Configurable Constants
+STATE_DB = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'incremental_state.db')
+DECAY_HALF_LIFE = 86400.0       # seconds after which a request counts half as much
+REPLACEMENT_THRESHOLD = 100.0   # kilometers an item's optimal location has to move before it is placed again
+EDGE_PRUNE_THRESHOLD = 0.01     # decayed interdependency counts below this are forgotten
+
+class IncrementalVolley(volley.Volley):
+
+  # params:
+  #   state_file: the sqlite database keeping the statistics between runs
+  def __init__(self, state_file = STATE_DB, redistribution_mode = volley.REDISTRIBUTION_HEURISTIC):
+    volley.Volley.__init__(self, 0, int(time.time()), redistribution_mode)
+    self.decay_rate = math.log(2) / DECAY_HALF_LIFE
+    self.state_conn = sqlite3.connect(state_file)
+    self.state_conn.executescript(
+      'CREATE TABLE IF NOT EXISTS ItemState(uuid text PRIMARY KEY, x real, y real, z real, updated_at real, placed_lat real, placed_lng real);'
+      'CREATE TABLE IF NOT EXISTS EdgeState(uuid text, source_uuid text, count real, updated_at real, PRIMARY KEY (uuid, source_uuid));'
+      'CREATE TABLE IF NOT EXISTS Cursor(name text PRIMARY KEY, value real);')
+    self.load_state()
+
+  # Execute incremental Volley algorithm
+  def execute(self):
+    self.ingest(self.log_manager.get_entries_since(self.last_rowid))
+    locations_by_uuid = self.place_initial()
+    locations_by_uuid = self.reduce_latency(locations_by_uuid, self.get_decayed_interdependencies())
+    moved_locations_by_uuid = self.find_moved_items(locations_by_uuid)
+    print str(len(moved_locations_by_uuid)) + ' of ' + str(len(locations_by_uuid)) + ' items moved more than ' + str(REPLACEMENT_THRESHOLD) + ' km'
+
+    if len(moved_locations_by_uuid) > 0:
+      placements_by_server = self.collapse_to_datacenters(moved_locations_by_uuid)
+      self.migrate_to_locations(placements_by_server)
+      for uuid in self.uuid_metadata:
+        self.items[uuid]['placed'] = moved_locations_by_uuid[uuid]
+
+    self.save_state()
+    print 'Incremental Volley execution complete!'
+
+  # Reads the statistics left by the previous run
+  def load_state(self):
+    cursor = self.state_conn.cursor()
+    cursor.execute("SELECT value FROM Cursor WHERE name = 'rowid'")
+    result = cursor.fetchone()
+    self.last_rowid = int(result[0]) if result is not None else 0
+    cursor.execute("SELECT value FROM Cursor WHERE name = 'now'")
+    result = cursor.fetchone()
+    self.now = result[0] if result is not None else 0
+
+    self.items = {}   # uuid -> { 'vector': [x, y, z], 'updated_at': timestamp, 'placed': lat/long tuple or None }
+    cursor.execute('SELECT uuid, x, y, z, updated_at, placed_lat, placed_lng FROM ItemState')
+    for row in cursor.fetchall():
+      placed = (row[5], row[6]) if row[5] is not None else None
+      self.items[row[0]] = { 'vector': [row[1], row[2], row[3]], 'updated_at': row[4], 'placed': placed }
+
+    self.edges = {}   # (uuid, source_uuid) -> [count, updated_at]
+    cursor.execute('SELECT uuid, source_uuid, count, updated_at FROM EdgeState')
+    for row in cursor.fetchall():
+      self.edges[(row[0], row[1])] = [row[2], row[3]]
+
+  # Writes the statistics for the next run, forgetting interdependencies that have decayed away
+  def save_state(self):
+    edges = [ (key[0], key[1], count, updated_at) for key, (count, updated_at) in self.edges.iteritems()
+      if self.decay(count, updated_at, self.now) >= EDGE_PRUNE_THRESHOLD ]
+    items = [ (uuid, item['vector'][0], item['vector'][1], item['vector'][2], item['updated_at'],
+      item['placed'][0] if item['placed'] is not None else None, item['placed'][1] if item['placed'] is not None else None)
+      for uuid, item in self.items.iteritems() ]
+
+    with self.state_conn:
+      self.state_conn.execute('DELETE FROM ItemState')
+      self.state_conn.execute('DELETE FROM EdgeState')
+      self.state_conn.executemany('INSERT INTO ItemState VALUES (?, ?, ?, ?, ?, ?, ?)', items)
+      self.state_conn.executemany('INSERT INTO EdgeState VALUES (?, ?, ?, ?)', edges)
+      self.state_conn.execute("INSERT OR REPLACE INTO Cursor VALUES ('rowid', ?)", (self.last_rowid,))
+      self.state_conn.execute("INSERT OR REPLACE INTO Cursor VALUES ('now', ?)", (self.now,))
+
+  # Returns the value a quantity recorded at `updated_at` has decayed to at `now`
+  def decay(self, value, updated_at, now):
+    return value * math.exp(-self.decay_rate * max(now - updated_at, 0))
+
+  # Adds new log entries to the statistics
+  #
+  # params:
+  #   entries: list of (rowid, timestamp, uuid, source_entity, source_uuid, request_type, status)
+  def ingest(self, entries):
+    if len(entries) == 0:
+      return
+    reads = [ entry for entry in entries if entry[5] == 'READ' and entry[6] == 200 ]
+    client_locations = self.ip_cache.get_many([ entry[3] for entry in reads ])
+
+    for rowid, timestamp, uuid, source_entity, source_uuid, request_type, status in entries:
+      timestamp = float(timestamp)
+      self.now = max(self.now, timestamp)
+
+      if request_type == 'READ' and status == 200:
+        client_loc = client_locations.get(source_entity)
+        if client_loc is None:
+          print 'Could not find client ' + source_entity + ' in client DB, skipping its read of ' + uuid
+        else:
+          self.add_read(uuid, timestamp, client_loc)
+
+      if source_uuid is not None:
+        edge = self.edges.setdefault((uuid, source_uuid), [0.0, timestamp])
+        edge[0] = self.decay(edge[0], edge[1], max(edge[1], timestamp)) + self.decay(1.0, timestamp, edge[1])
+        edge[1] = max(edge[1], timestamp)
+
+    self.last_rowid = entries[-1][0]
+    print 'Ingested ' + str(len(entries)) + ' log entries up to rowid ' + str(self.last_rowid)
+
+  # Adds one read from a client location to the item's centroid accumulator. Older reads are
+  # decayed relative to the newest one, which leaves the direction of the sum meaningful.
+  def add_read(self, uuid, timestamp, client_loc):
+    item = self.items.setdefault(uuid, { 'vector': [0.0, 0.0, 0.0], 'updated_at': timestamp, 'placed': None })
+    lat = math.radians(client_loc[0])
+    lng = math.radians(client_loc[1])
+    client_vector = (math.cos(lat) * math.cos(lng), math.cos(lat) * math.sin(lng), math.sin(lat))
+    scale = self.decay(1.0, item['updated_at'], timestamp)
+    weight = self.decay(1.0, timestamp, item['updated_at'])
+    item['vector'] = [ item['vector'][i] * scale + client_vector[i] * weight for i in range(3) ]
+    item['updated_at'] = max(item['updated_at'], timestamp)
+
+  # PHASE 1: Compute Initial Placement from the centroid accumulators
+  def place_initial(self):
+    uuids = sorted(self.items.keys())
+    vectors = np.array([ self.items[uuid]['vector'] for uuid in uuids ]).reshape((len(uuids), 3))
+    lats = np.degrees(np.arctan2(vectors[:, 2], np.hypot(vectors[:, 0], vectors[:, 1])))
+    lngs = np.degrees(np.arctan2(vectors[:, 1], vectors[:, 0]))
+    has_reads = np.any(vectors != 0, axis=1)
+
+    locations_by_uuid = {}
+    for i, uuid in enumerate(uuids):
+      locations_by_uuid[uuid] = (float(lats[i]), float(lngs[i])) if has_reads[i] else None
+    return locations_by_uuid
+
+  # Returns the interdependency counts decayed to the time of the newest log entry
+  def get_decayed_interdependencies(self):
+    return [ (key[0], key[1], self.decay(count, updated_at, self.now)) for key, (count, updated_at) in self.edges.iteritems() ]
+
+  # Returns the items that were never placed or whose location moved beyond REPLACEMENT_THRESHOLD since they were placed
+  def find_moved_items(self, locations_by_uuid):
+    moved_locations_by_uuid = {}
+    for uuid, location in locations_by_uuid.iteritems():
+      if location is None:
+        continue
+      placed = self.items[uuid]['placed']
+      if placed is None or spherical.point_distance_km(placed[0], placed[1], location[0], location[1]) > REPLACEMENT_THRESHOLD:
+        moved_locations_by_uuid[uuid] = location
+    return moved_locations_by_uuid
+
+  # Only the moved items are placed again, so a server can take its free space plus
+  # the moved items it stores now.
+  #
+  # params:
+  #   server: hostname of server to check
+  def total_server_capacity(self, server):
+    server = util.convert_to_local_hostname(server)
+
+    url = 'http://%s/capacity' % (server,)
+    r = peer_client.get(url, timeout=30)
+    capacity = float(json.loads(r.text)['free'])
+    for metadata in self.uuid_metadata.itervalues():
+      if util.convert_to_local_hostname(metadata['current_server']) == server:
+        capacity += metadata['file_size'] or 0
+    return capacity
+
+if __name__ == '__main__':
+  redistribution_mode = sys.argv[1] if len(sys.argv) > 1 else volley.REDISTRIBUTION_HEURISTIC
+  incremental_volley = IncrementalVolley(redistribution_mode = redistribution_mode)
+  incremental_volley.execute()
@@ -0,0 +1,79 @@
+# Capacity-aware assignment of items to servers for Volley phase 3
+#
+# Every item has a ranking of the servers from closest to furthest. Items are assigned in the order
+# of their regret: the extra request-weighted distance they would pay if they lost their closest
+# server that still has room for them. Items with the most to lose pick first, so the items that end
+# up further away are the ones that are cheap to move.
+import heapq
+
+# Returns the position of the first server in the ranking, from `position` on, with room for the file.
+#
+# params:
+#   ranking: list of dicts with `server` and `distance`, closest first
+#   position: the position to start searching from
+#   file_size: the size of the file to place
+#   space_remaining: dictionary mapping server -> bytes still available
+def find_feasible_server(ranking, position, file_size, space_remaining):
+  while position < len(ranking):
+    server = ranking[position]['server']
+    if server in space_remaining and space_remaining[server] >= file_size:
+      return position
+    position += 1
+  return None
+
+# Returns the request-weighted distance lost by placing the item on its second choice instead of its first.
+def get_regret(metadata, best, second):
+  if second is None:
+    return float('inf')
+  ranking = metadata['server_ranking']
+  return (metadata['request_count'] or 0) * (ranking[second]['distance'] - ranking[best]['distance'])
+
+# Assigns every item to a server, minimizing the request-weighted distance of the items to their
+# servers without exceeding any server's capacity.
+#
+# params:
+#   uuid_metadata: dictionary mapping uuid -> metadata with `server_ranking`, `file_size` and `request_count`
+#   uuids: the uuids to place
+#   space_remaining: dictionary mapping server -> bytes available, updated as items are placed
+# returns: dictionary mapping server -> list of uuids
+def assign_by_regret(uuid_metadata, uuids, space_remaining):
+  placements_by_server = dict((server, []) for server in space_remaining)
+  choices = {}    # uuid -> (position of the best server, position of the second best server)
+  heap = []
+
+  for order, uuid in enumerate(uuids):
+    metadata = uuid_metadata[uuid]
+    file_size = metadata['file_size'] or 0
+    best = find_feasible_server(metadata['server_ranking'], 0, file_size, space_remaining)
+    if best is None:
+      raise ValueError("There is too much data for the servers' storage capacity to handle.")
+    second = find_feasible_server(metadata['server_ranking'], best + 1, file_size, space_remaining)
+    choices[uuid] = (best, second)
+    heap.append((-get_regret(metadata, best, second), order, uuid))
+  heapq.heapify(heap)
+
+  while len(heap) > 0:
+    negative_regret, order, uuid = heapq.heappop(heap)
+    metadata = uuid_metadata[uuid]
+    file_size = metadata['file_size'] or 0
+
+    # Servers only fill up, so the choices can only move further down the ranking.
+    best, second = choices[uuid]
+    new_best = find_feasible_server(metadata['server_ranking'], best, file_size, space_remaining)
+    if new_best is None:
+      raise ValueError("There is too much data for the servers' storage capacity to handle.")
+    new_second = None
+    if second is not None:
+      new_second = find_feasible_server(metadata['server_ranking'], max(second, new_best + 1), file_size, space_remaining)
+
+    # The regret is stale, put the item back with the new one.
+    if (new_best, new_second) != (best, second):
+      choices[uuid] = (new_best, new_second)
+      heapq.heappush(heap, (-get_regret(metadata, new_best, new_second), order, uuid))
+      continue
+
+    server = metadata['server_ranking'][best]['server']
+    space_remaining[server] -= file_size
+    placements_by_server[server].append(uuid)
+
+  return placements_by_server
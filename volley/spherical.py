@@ -0,0 +1,273 @@
+# Vectorized spherical geometry for Volley
+#
+# The functions work on NumPy arrays of latitudes/longitudes in degrees and follow the same formulas
+# as the scalar helpers of the Volley class, so that whole phases can be computed for every item at once.
+import math
+import numpy as np
+
+# Configurable Constants
+EARTH_RADIUS = 6372.795       # kilometers, as used by geopy's great_circle
+SCALAR_CHAIN_ITEMS = 64       # below this many items a step of phase 2 runs item by item, see reduce_latency
+
+def to_colatitude_radians(lat):
+  return np.radians(90.0 - lat)
+
+def to_latitude_degrees(colatitude):
+  return 90.0 - np.degrees(colatitude)
+
+# Element-wise version of Volley.interp: moves each location A towards location B by `weight`
+# of the great circle between them.
+#
+# params:
+#   weight: array of weights for interpolation
+#   lat_a, lng_a: arrays with the lat/lng of the locations A
+#   lat_b, lng_b: arrays with the lat/lng of the locations B
+# returns: (lat, lng) arrays
+def interp(weight, lat_a, lng_a, lat_b, lng_b):
+  lat_a = to_colatitude_radians(lat_a)
+  lng_a = np.radians(lng_a)
+  lat_b = to_colatitude_radians(lat_b)
+  lng_b = np.radians(lng_b)
+
+  d = np.arccos(np.clip(np.cos(lat_a) * np.cos(lat_b) + np.sin(lat_a) * np.sin(lat_b) * np.cos(lng_b - lng_a), -1.0, 1.0))
+
+  gamma = np.arctan2(np.sin(lat_b) * np.sin(lat_a) * np.sin(lng_b - lng_a), np.cos(lat_a) - (np.cos(d) * np.cos(lat_b)))
+
+  wd = weight * d
+  beta = np.arctan2(np.sin(lat_b) * np.sin(wd) * np.sin(gamma), np.cos(wd) - (np.cos(lat_a) * np.cos(lat_b)))
+
+  lat_c = np.arccos(np.clip(np.cos(wd) * np.cos(lat_b) + np.sin(wd) * np.sin(lat_b) * np.cos(gamma), -1.0, 1.0))
+
+  # Find an average of coming from either direction for antipodal nodes
+  lng_c_1 = np.mod(lng_b - beta, 2 * np.pi)
+  lng_c_2 = np.mod(lng_a + beta, 2 * np.pi)
+  lng_c = np.mod(((lng_c_1 + lng_c_2) / 2) + np.pi, 2 * np.pi) - np.pi
+
+  return (to_latitude_degrees(lat_c), np.degrees(lng_c))
+
+# Great circle distances in kilometers between arrays of locations.
+def distance_km(lat_a, lng_a, lat_b, lng_b, earth_radius=EARTH_RADIUS):
+  lat_a = np.radians(lat_a)
+  lat_b = np.radians(lat_b)
+  delta_lng = np.radians(lng_b - lng_a)
+  y = np.sqrt((np.cos(lat_b) * np.sin(delta_lng)) ** 2 + (np.cos(lat_a) * np.sin(lat_b) - np.sin(lat_a) * np.cos(lat_b) * np.cos(delta_lng)) ** 2)
+  x = np.sin(lat_a) * np.sin(lat_b) + np.cos(lat_a) * np.cos(lat_b) * np.cos(delta_lng)
+  return earth_radius * np.arctan2(y, x)
+
+# Scalar version of distance_km, for comparing a handful of locations.
+def point_distance_km(lat_a, lng_a, lat_b, lng_b, earth_radius=EARTH_RADIUS):
+  lat_a = math.radians(lat_a)
+  lat_b = math.radians(lat_b)
+  delta_lng = math.radians(lng_b - lng_a)
+  y = math.sqrt((math.cos(lat_b) * math.sin(delta_lng)) ** 2 + (math.cos(lat_a) * math.sin(lat_b) - math.sin(lat_a) * math.cos(lat_b) * math.cos(delta_lng)) ** 2)
+  x = math.sin(lat_a) * math.sin(lat_b) + math.cos(lat_a) * math.cos(lat_b) * math.cos(delta_lng)
+  return earth_radius * math.atan2(y, x)
+
+# Unit vectors on the sphere for arrays of locations, as an (n, 3) array.
+def to_unit_vectors(lat, lng):
+  lat = np.radians(lat)
+  lng = np.radians(lng)
+  return np.column_stack((np.cos(lat) * np.cos(lng), np.cos(lat) * np.sin(lng), np.sin(lat)))
+
+# Returns the position of every row within its group, for rows sorted by group.
+#
+# params:
+#   group_ids: array of group ids, sorted
+#   num_groups: the number of groups
+def positions_in_group(group_ids, num_groups):
+  counts = np.bincount(group_ids, minlength=num_groups)
+  starts = np.cumsum(counts) - counts
+  return np.arange(len(group_ids)) - starts[group_ids]
+
+# Weighted spherical mean of the client locations of every item, the vectorized version of
+# Volley.weighted_spherical_mean. For the clients c_0..c_n of an item the mean is computed as
+#   mean_0 = c_0, mean_k = interp(weight_k / total_weight, c_k, mean_(k-1))
+# which is the order the recursive helper used. All items are advanced one client at a time together.
+#
+# params:
+#   item_ids: array with the item index (0..num_items-1) of every (item, client) row, sorted by item
+#   weights: array with the number of reads of every row
+#   lats, lngs: arrays with the client location of every row
+#   num_items: the number of items
+# returns: (lat, lng, has_reads) arrays indexed by item; items without reads have has_reads False
+def weighted_spherical_means(item_ids, weights, lats, lngs, num_items):
+  item_ids = np.asarray(item_ids, dtype=np.int64)
+  weights = np.asarray(weights, dtype=np.float64)
+  lats = np.asarray(lats, dtype=np.float64)
+  lngs = np.asarray(lngs, dtype=np.float64)
+
+  total_weights = np.bincount(item_ids, weights=weights, minlength=num_items)
+  positions = positions_in_group(item_ids, num_items)
+
+  mean_lats = np.zeros(num_items)
+  mean_lngs = np.zeros(num_items)
+  first_rows = positions == 0
+  mean_lats[item_ids[first_rows]] = lats[first_rows]
+  mean_lngs[item_ids[first_rows]] = lngs[first_rows]
+
+  # rows grouped by their position, so step k only touches the k-th client of each item
+  order = np.argsort(positions, kind='mergesort')
+  step_counts = np.bincount(positions) if len(positions) > 0 else np.zeros(0, dtype=np.int64)
+  step_ends = np.cumsum(step_counts)
+  for step in range(1, len(step_counts)):
+    rows = order[step_ends[step - 1]:step_ends[step]]
+    items = item_ids[rows]
+    mean_lats[items], mean_lngs[items] = interp(weights[rows] / total_weights[items], lats[rows], lngs[rows], mean_lats[items], mean_lngs[items])
+
+  return (mean_lats, mean_lngs, total_weights > 0)
+
+# Builds a CSR adjacency structure from an edge list, summing the weights of repeated edges.
+# The neighbors of every item are ordered by their index.
+#
+# params:
+#   sources, targets: arrays with the item indices of the edge endpoints
+#   weights: array with the weight of every edge
+#   num_items: the number of items
+# returns: (indptr, indices, data), the neighbors of item i are indices[indptr[i]:indptr[i + 1]]
+def csr_from_edges(sources, targets, weights, num_items):
+  sources = np.asarray(sources, dtype=np.int64)
+  targets = np.asarray(targets, dtype=np.int64)
+  weights = np.asarray(weights, dtype=np.float64)
+
+  order = np.lexsort((targets, sources))
+  sources = sources[order]
+  targets = targets[order]
+  weights = weights[order]
+
+  keys = sources * num_items + targets
+  first_edges = np.ones(len(keys), dtype=bool)
+  first_edges[1:] = keys[1:] != keys[:-1]
+  data = np.bincount(np.cumsum(first_edges) - 1, weights=weights) if len(keys) > 0 else np.zeros(0)
+
+  indptr = np.zeros(num_items + 1, dtype=np.int64)
+  indptr[1:] = np.cumsum(np.bincount(sources[first_edges], minlength=num_items))
+  return (indptr, targets[first_edges], data)
+
+# Iteratively moves every item towards the items it is interdependent with, the vectorized version of
+# Volley.reduce_latency. Within an iteration every item is moved towards its neighbors one at a time,
+# in the order of their index, as the loop did:
+#   location = interp(1 / (1 + kappa * distance(location, neighbor) * count), location, neighbor)
+# All items are advanced one neighbor at a time together, so every item reads the locations its
+# neighbors had at the end of the previous iteration. The loop read the locations already updated
+# earlier in the same pass instead, which made the result depend on the dict order of the items.
+# Once fewer than SCALAR_CHAIN_ITEMS items have neighbors left, e.g. the hubs of a power-law graph,
+# they are finished one at a time with scalar math, which is cheaper than tiny vectorized steps.
+# Iterations stop once no item moves more than `tolerance` kilometers or after `max_iterations`.
+#
+# params:
+#   lats, lngs: arrays with the location of every item
+#   indptr, indices, counts: the interdependency graph in CSR form, see csr_from_edges
+# returns: (lat, lng, iterations)
+def reduce_latency(lats, lngs, indptr, indices, counts, kappa, max_iterations, tolerance, earth_radius=EARTH_RADIUS):
+  lats = np.array(lats, dtype=np.float64)
+  lngs = np.array(lngs, dtype=np.float64)
+  counts = np.asarray(counts, dtype=np.float64)
+  num_items = len(lats)
+  degrees = np.diff(indptr)
+  edge_items = np.repeat(np.arange(num_items), degrees)
+
+  # edges grouped by their position in the neighbor list, so step k only touches the k-th neighbor of each item
+  positions = positions_in_group(edge_items, num_items)
+  order = np.argsort(positions, kind='mergesort')
+  step_counts = np.bincount(positions) if len(positions) > 0 else np.zeros(0, dtype=np.int64)
+  step_ends = np.cumsum(step_counts)
+  num_steps = int(np.sum(step_counts >= SCALAR_CHAIN_ITEMS))
+  steps = [ (edge_items[edges], indices[edges], counts[edges]) for edges in np.split(order, step_ends[:-1])[:num_steps] ]
+  chain_items = np.nonzero(degrees > num_steps)[0]
+
+  iterations = 0
+  while iterations < max_iterations and len(indices) > 0:
+    iterations += 1
+    new_lats = lats.copy()
+    new_lngs = lngs.copy()
+    for items, neighbors, step_weights in steps:
+      item_lats = new_lats[items]
+      item_lngs = new_lngs[items]
+      distances = distance_km(item_lats, item_lngs, lats[neighbors], lngs[neighbors], earth_radius)
+      weights = 1.0 / (1 + (kappa * distances * step_weights))
+      new_lats[items], new_lngs[items] = interp(weights, item_lats, item_lngs, lats[neighbors], lngs[neighbors])
+
+    if len(chain_items) > 0:
+      colatitudes = to_colatitude_radians(lats)
+      neighbor_trigonometry = (np.cos(colatitudes).tolist(), np.sin(colatitudes).tolist(), np.radians(lngs).tolist())
+      for item in chain_items:
+        start = indptr[item] + num_steps
+        end = indptr[item + 1]
+        new_lats[item], new_lngs[item] = interp_chain(new_lats[item], new_lngs[item], indices[start:end].tolist(),
+          counts[start:end].tolist(), neighbor_trigonometry, kappa, earth_radius)
+
+    moved = distance_km(lats, lngs, new_lats, new_lngs, earth_radius)
+    lats = new_lats
+    lngs = new_lngs
+    if moved.max() <= tolerance:
+      break
+
+  return (lats, lngs, iterations)
+
+# Moves a single location towards the given neighbors one at a time, as the steps of reduce_latency
+# do, with scalar math. The trigonometry of the neighbors is computed once per iteration by the caller.
+#
+# params:
+#   lat, lng: the location to move
+#   neighbors, counts: lists with the index and request count of every neighbor, in order
+#   neighbor_trigonometry: (cos(colatitude), sin(colatitude), lng in radians) lists indexed by item
+# returns: (lat, lng)
+def interp_chain(lat, lng, neighbors, counts, neighbor_trigonometry, kappa, earth_radius):
+  cos_colatitudes, sin_colatitudes, radian_lngs = neighbor_trigonometry
+  lat_a = math.radians(90.0 - lat)
+  lng_a = math.radians(lng)
+  cos_a = math.cos(lat_a)
+  sin_a = math.sin(lat_a)
+  for neighbor, count in zip(neighbors, counts):
+    cos_b = cos_colatitudes[neighbor]
+    sin_b = sin_colatitudes[neighbor]
+    lng_b = radian_lngs[neighbor]
+    delta_lng = lng_b - lng_a
+
+    cos_d = cos_a * cos_b + sin_a * sin_b * math.cos(delta_lng)
+    cos_d = 1.0 if cos_d > 1.0 else (-1.0 if cos_d < -1.0 else cos_d)
+    d = math.acos(cos_d)
+    weight = 1.0 / (1 + (kappa * earth_radius * d * count))
+
+    gamma = math.atan2(sin_b * sin_a * math.sin(delta_lng), cos_a - (cos_d * cos_b))
+    wd = weight * d
+    cos_wd = math.cos(wd)
+    sin_wd = math.sin(wd)
+    beta = math.atan2(sin_b * sin_wd * math.sin(gamma), cos_wd - (cos_a * cos_b))
+    cos_c = cos_wd * cos_b + sin_wd * sin_b * math.cos(gamma)
+    cos_c = 1.0 if cos_c > 1.0 else (-1.0 if cos_c < -1.0 else cos_c)
+
+    # Find an average of coming from either direction for antipodal nodes
+    lng_c_1 = (lng_b - beta) % (2 * math.pi)
+    lng_c_2 = (lng_a + beta) % (2 * math.pi)
+    lng_a = ((((lng_c_1 + lng_c_2) / 2) + math.pi) % (2 * math.pi)) - math.pi
+    cos_a = cos_c
+    sin_a = math.sqrt(1.0 - cos_c * cos_c)
+  return (90.0 - math.degrees(math.acos(cos_a)), math.degrees(lng_a))
+
+# Ranks the servers by distance for every location in one pass, comparing unit vectors so only a dot
+# product per (location, server) pair is needed. Distances of the ranked servers are exact great circles.
+#
+# params:
+#   lats, lngs: arrays with the locations to rank servers for
+#   server_lats, server_lngs: arrays with the server locations
+#   k: the number of nearest servers to return per location, all servers by default
+#   chunk_size: the number of locations ranked at a time, bounding the memory used
+# returns: (indices, distances), (n, k) arrays of server indices from nearest to furthest and their distances in km
+def nearest_servers(lats, lngs, server_lats, server_lngs, k=None, chunk_size=10000):
+  lats = np.asarray(lats, dtype=np.float64)
+  lngs = np.asarray(lngs, dtype=np.float64)
+  server_lats = np.asarray(server_lats, dtype=np.float64)
+  server_lngs = np.asarray(server_lngs, dtype=np.float64)
+  if k is None or k > len(server_lats):
+    k = len(server_lats)
+
+  server_vectors = to_unit_vectors(server_lats, server_lngs)
+  indices = np.empty((len(lats), k), dtype=np.int64)
+  for start in range(0, len(lats), chunk_size):
+    end = min(start + chunk_size, len(lats))
+    similarities = to_unit_vectors(lats[start:end], lngs[start:end]).dot(server_vectors.T)
+    indices[start:end] = np.argsort(-similarities, axis=1, kind='mergesort')[:, :k]
+
+  distances = distance_km(lats[:, np.newaxis], lngs[:, np.newaxis], server_lats[indices], server_lngs[indices])
+  return (indices, distances)
@@ -0,0 +1,65 @@
+import unittest
+import mock
+import os
+import shutil
+import sys
+import tempfile
+
+# Files to test
+sys.path.insert(0, os.path.normpath('..'))
+import incremental_volley
+
+class TestIncrementalVolley(unittest.TestCase):
+  def setUp(self):
+    self.working_directory = tempfile.mkdtemp()
+    self.state_file = os.path.join(self.working_directory, 'state.db')
+    self.clients = {
+      '1.1.1.1': (42.2733204, -83.7376894),   # Ann Arbor
+      '2.2.2.2': (37.7577, -122.4376)         # San Francisco
+    }
+    self.volley = self.create_volley()
+
+  def create_volley(self):
+    volley = incremental_volley.IncrementalVolley(self.state_file)
+    volley.ip_cache = mock.Mock()
+    volley.ip_cache.get_many.side_effect = lambda ips: dict((ip, self.clients.get(ip)) for ip in ips)
+    return volley
+
+  def test_old_reads_decay(self):
+    half_life = incremental_volley.DECAY_HALF_LIFE
+    self.volley.ingest([
+      (1, 0, 'a', '1.1.1.1', None, 'READ', 200),
+      (2, half_life, 'a', '2.2.2.2', None, 'READ', 200),
+      (3, half_life, 'a', '2.2.2.2', None, 'READ', 302),
+      (4, half_life, 'b', '3.3.3.3', None, 'READ', 200),
+      (5, 0, 'a', 'server', 'b', 'READ', 200),
+      (6, half_life, 'b', 'server', 'a', 'READ', 200)
+    ])
+    self.assertEqual(self.volley.last_rowid, 6)
+    self.assertNotIn('b', self.volley.items)
+
+    # The read from Ann Arbor counts half as much as the one from San Francisco, so 'a' sits closer to San Francisco.
+    location = self.volley.place_initial()['a']
+    self.assertTrue(location[1] < (self.clients['1.1.1.1'][1] + self.clients['2.2.2.2'][1]) / 2)
+    count, updated_at = self.volley.edges[('a', 'b')]
+    self.assertAlmostEqual(self.volley.decay(count, updated_at, half_life), 0.5)
+    count, updated_at = self.volley.edges[('b', 'a')]
+    self.assertAlmostEqual(self.volley.decay(count, updated_at, half_life), 1.0)
+
+  def test_state_is_resumed(self):
+    self.volley.ingest([(1, 0, 'a', '1.1.1.1', None, 'READ', 200)])
+    location = self.volley.place_initial()['a']
+    self.assertEqual(self.volley.find_moved_items({ 'a': location }), { 'a': location })
+    self.volley.items['a']['placed'] = location
+    self.volley.save_state()
+
+    resumed = self.create_volley()
+    self.assertEqual(resumed.last_rowid, 1)
+    self.assertEqual(resumed.find_moved_items({ 'a': location }), {})
+    self.assertEqual(resumed.find_moved_items({ 'a': self.clients['2.2.2.2'] }), { 'a': self.clients['2.2.2.2'] })
+
+  def tearDown(self):
+    shutil.rmtree(self.working_directory)
+
+if __name__ == '__main__':
+  unittest.main()
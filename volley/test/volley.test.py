@@ -1,11 +1,13 @@
 import unittest
 import mock
 import os
+import random
 import sys
 
 # Files to test
 sys.path.insert(0, os.path.normpath('..'))
 import volley
+import util
 
 class TestVolley(unittest.TestCase):
   def setUp(self):
@@ -74,6 +76,126 @@ class TestVolley(unittest.TestCase):
     self.assertIn('2', results[self.servers['virginia']])
     self.assertIn('3', results[self.servers['tokyo']])
 
+  def test_assign_servers_by_capacity(self):
+    capacities = { self.servers['virginia']: 40, self.servers['oregon']: 10, self.servers['tokyo']: 30 }
+    self.volley.total_server_capacity = mock.Mock(side_effect=lambda server: capacities.get(server, 0))
+    rankings = self.volley.rank_servers([self.locations['san_francisco'], self.locations['chicago'], self.locations['ann_arbor']])
+
+    self.volley.uuid_metadata = {
+      '1': {'file_size': 20, 'request_count': 10, 'server_ranking': rankings[0] },
+      '2': {'file_size': 20, 'request_count': 4, 'server_ranking': rankings[1] },
+      '3': {'file_size': 20, 'request_count': 1, 'server_ranking': rankings[2] }
+    }
+
+    results = self.volley.assign_servers_by_capacity(['1', '2', '3'])
+
+    self.assertEqual(sorted(results[self.servers['virginia']]), ['1', '2'])
+    self.assertEqual(results[self.servers['tokyo']], ['3'])
+    self.assertEqual(len(results[self.servers['oregon']]), 0)
+
+    capacities = { self.servers['virginia']: 20 }
+    self.assertRaises(ValueError, self.volley.assign_servers_by_capacity, ['1', '2', '3'])
+
+  def test_redistribute_reuses_server_rankings(self):
+    self.volley.total_server_capacity = mock.Mock(side_effect=lambda server: 20 if server != self.servers['oregon'] else 0)
+    self.volley.find_closest_servers = mock.Mock()
+    rankings = self.volley.rank_servers([self.locations['ann_arbor'], self.locations['san_francisco']])
+    self.assertEqual(rankings[0][0]['server'], self.servers['virginia'])
+    self.assertEqual(rankings[1][0]['server'], self.servers['oregon'])
+
+    self.volley.uuid_metadata = {
+      '1': {'file_size': 20, 'request_count': 10, 'optimal_location': self.locations['ann_arbor'], 'server_ranking': rankings[0] },
+      '2': {'file_size': 20, 'request_count': 4, 'optimal_location': self.locations['san_francisco'], 'server_ranking': rankings[1] }
+    }
+    placements_by_server = dict((server, []) for server in self.volley.servers)
+    placements_by_server[self.servers['oregon']] = ['1', '2']
+
+    results = self.volley.redistribute_server_data_by_capacity(placements_by_server)
+
+    self.assertFalse(self.volley.find_closest_servers.called)
+    self.assertEqual(len(results[self.servers['oregon']]), 0)
+    self.assertIn('1', results[self.servers['virginia']])
+
+  def test_place_initial_matches_recursive_mean(self):
+    clients = {
+      '1.1.1.1': self.locations['ann_arbor'],
+      '2.2.2.2': self.locations['chicago'],
+      '3.3.3.3': self.locations['san_francisco']
+    }
+    self.volley.log_manager = mock.Mock()
+    self.volley.log_manager.get_unique_uuids.return_value = ['1', '2', '3']
+    self.volley.log_manager.get_reads_grouped_by_uuid_and_source.return_value = [
+      ('1', '1.1.1.1', 3), ('1', '2.2.2.2', 1), ('1', '3.3.3.3', 5), ('2', '3.3.3.3', 2)
+    ]
+    self.volley.ip_cache = mock.Mock()
+    self.volley.ip_cache.get_many.side_effect = lambda ips: dict((ip, clients[ip]) for ip in ips)
+
+    locations_by_uuid = self.volley.place_initial()
+
+    expected = self.volley.weighted_spherical_mean_helper(9.0, [3, 1, 5], [clients['1.1.1.1'], clients['2.2.2.2'], clients['3.3.3.3']])
+    self.assertAlmostEqual(locations_by_uuid['1'][0], expected[0])
+    self.assertAlmostEqual(locations_by_uuid['1'][1], expected[1])
+    self.assertAlmostEqual(locations_by_uuid['2'][0], clients['3.3.3.3'][0])
+    self.assertAlmostEqual(locations_by_uuid['2'][1], clients['3.3.3.3'][1])
+    self.assertIsNone(locations_by_uuid['3'])
+
+  def test_reduce_latency_moves_interdependent_items(self):
+    self.volley.log_manager = mock.Mock()
+    self.volley.log_manager.get_interdependencies.return_value = [('1', '2', 3), ('1', '3', 1), ('1', '4', 2)]
+    locations_by_uuid = {
+      '1': self.locations['ann_arbor'],
+      '2': self.locations['san_francisco'],
+      '3': None
+    }
+
+    with mock.patch.object(volley, 'INTERDEPENDENCY_ITERATIONS', 1):
+      results = self.volley.reduce_latency(dict(locations_by_uuid))
+
+    weight = 1 / (1 + (volley.KAPPA * util.get_distance(self.locations['ann_arbor'], self.locations['san_francisco']) * 3))
+    expected_1 = self.volley.interp(weight, self.locations['ann_arbor'], self.locations['san_francisco'])
+    expected_2 = self.volley.interp(weight, self.locations['san_francisco'], self.locations['ann_arbor'])
+    self.assertAlmostEqual(results['1'][0], expected_1[0])
+    self.assertAlmostEqual(results['1'][1], expected_1[1])
+    self.assertAlmostEqual(results['2'][0], expected_2[0])
+    self.assertAlmostEqual(results['2'][1], expected_2[1])
+    self.assertIsNone(results['3'])
+
+  def test_reduce_latency_moves_items_towards_every_neighbor_in_order(self):
+    random.seed(591)
+    uuids = [ 'item-%02d' % i for i in range(20) ]
+    locations_by_uuid = dict((uuid, (random.uniform(-60, 60), random.uniform(-180, 180))) for uuid in uuids)
+    # a hub interdependent with every item, and a few random interdependencies between the others
+    pairs = set([ ('item-00', uuid) for uuid in uuids[1:] ])
+    while len(pairs) < 60:
+      pair = tuple(sorted(random.sample(uuids[1:], 2)))
+      pairs.add(pair)
+    interdependencies = [ (uuid, other_item_uuid, random.randint(1, 5)) for uuid, other_item_uuid in sorted(pairs) ]
+
+    # the loop phase 2 used, except that every item reads the locations of its neighbors from the previous iteration
+    neighbors = dict((uuid, {}) for uuid in uuids)
+    for uuid, other_item_uuid, request_count in interdependencies:
+      neighbors[uuid][other_item_uuid] = request_count
+      neighbors[other_item_uuid][uuid] = request_count
+    expected = dict(locations_by_uuid)
+    for i in range(2):
+      previous = dict(expected)
+      for uuid in uuids:
+        location = previous[uuid]
+        for other_item_uuid in sorted(neighbors[uuid]):
+          distance = util.get_distance(location, previous[other_item_uuid])
+          weight = 1 / (1 + (volley.KAPPA * distance * neighbors[uuid][other_item_uuid]))
+          location = self.volley.interp(weight, location, previous[other_item_uuid])
+        expected[uuid] = location
+
+    # the hub and the items with the most neighbors are finished item by item
+    with mock.patch.object(volley, 'INTERDEPENDENCY_ITERATIONS', 2), mock.patch.object(volley, 'INTERDEPENDENCY_TOLERANCE', 0), \
+         mock.patch.object(volley.spherical, 'SCALAR_CHAIN_ITEMS', 4):
+      results = self.volley.reduce_latency(dict(locations_by_uuid), interdependencies)
+
+    for uuid in uuids:
+      self.assertAlmostEqual(results[uuid][0], expected[uuid][0], places=6)
+      self.assertAlmostEqual(results[uuid][1], expected[uuid][1], places=6)
+
   def tearDown(self):
     self.volley.close_connection()
 
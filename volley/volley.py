@@ -1,15 +1,12 @@
 # Implementation of Volley
-import geopy
 import json
 import math
+import numpy as np
 import os
 import requests
 import sqlite3
 import sys
 import time
-import urllib
-
-from geopy.distance import great_circle
 
 # Project Imports
 up_one_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
@@ -18,22 +15,34 @@ sys.path.insert(0, os.path.join(up_one_dir, 'cache'))
 sys.path.insert(0, os.path.join(up_one_dir, 'aggregator'))
 import ip_location_cache
 from log_manager import LogManager
+from migration import MigrationExecutor
+import peer_client
+import placement
+import spherical
 import util
 
 # Configurable Constants
-INTERDEPENDENCY_ITERATIONS = 5
+INTERDEPENDENCY_ITERATIONS = 5        # the maximum number of phase 2 iterations
+INTERDEPENDENCY_TOLERANCE = 1.0       # phase 2 stops once no item moves more than this many kilometers
 KAPPA = 0.5
+METADATA_BATCH_SIZE = 1000            # the number of uuids asked for in one /metadata/batch call
+METADATA_TIMEOUT = 300                # seconds to wait for one /metadata/batch call
+REDISTRIBUTION_HEURISTIC = 'heuristic'  # move the most requested items off full servers, one at a time
+REDISTRIBUTION_REGRET = 'regret'        # assign all items by regret under the capacity constraints
+MIGRATION_JOURNAL = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'migration_journal.txt')
 
 class Volley:
 
-  def __init__(self, start_time = 0, end_time = int(time.time())):
+  def __init__(self, start_time = 0, end_time = int(time.time()), redistribution_mode = REDISTRIBUTION_HEURISTIC):
     self.log_manager = LogManager(start_time, end_time)
+    self.redistribution_mode = redistribution_mode
     self.ip_cache = ip_location_cache.ip_location_cache()
 
     # for now, get from logs. maybe use aggregator to make these calls later?
     self.servers = self.log_manager.get_unique_destinations()
 
     self.uuid_metadata = {}     # dictionary mapping uuid -> metadata (includes state-ful data)
+    self.server_locations = {}  # dictionary mapping server -> lat/long tuple, resolved once per server
 
   # Execute Volley algorithm
   def execute(self):
@@ -44,87 +53,165 @@ class Volley:
     print 'Volley execution complete!'
 
   # PHASE 1: Compute Initial Placement
+  #
+  # Reads every (uuid, client) read count in one query and computes the weighted spherical
+  # means of all items together. Items without reads are placed at None.
   def place_initial(self):
     # should use aggregator to make these calls later
     uuids = self.log_manager.get_unique_uuids()
+    request_logs = self.log_manager.get_reads_grouped_by_uuid_and_source()
+
+    client_locations = self.ip_cache.get_many([ req[1] for req in request_logs ])
+    for client, client_loc in client_locations.iteritems():
+      if client_loc is None:
+        raise NameError('Could not find client ' + client + ' in client DB.')
+
+    item_index = {}
+    item_ids = np.empty(len(request_logs), dtype=np.int64)
+    weights = np.empty(len(request_logs))
+    lats = np.empty(len(request_logs))
+    lngs = np.empty(len(request_logs))
+    for i, req in enumerate(request_logs):
+      item_ids[i] = item_index.setdefault(req[0], len(item_index))
+      weights[i] = req[2]
+      lats[i], lngs[i] = client_locations[req[1]]
+
+    mean_lats, mean_lngs, has_reads = spherical.weighted_spherical_means(item_ids, weights, lats, lngs, len(item_index))
 
     locations_by_uuid = {}
 
     for uuid in uuids:
-      locations_by_uuid[uuid] = self.weighted_spherical_mean(uuid)
+      locations_by_uuid[uuid] = None
+    for uuid, i in item_index.iteritems():
+      if has_reads[i]:
+        locations_by_uuid[uuid] = (float(mean_lats[i]), float(mean_lngs[i]))
 
     return locations_by_uuid
 
   # PHASE 2: Iteratively Move Data to Reduce Latency
-  def reduce_latency(self, locations_by_uuid):
-
-    for i in range(INTERDEPENDENCY_ITERATIONS):
-      for uuid, location in locations_by_uuid.iteritems():
-        uuid_to_interdependencies = self.log_manager.get_interdependency_grouped_by_uuid(uuid)
-
-        for tuple in uuid_to_interdependencies:
-          other_item_uuid = tuple[0]
-          other_item_location = locations_by_uuid[other_item_uuid]
-          request_count = tuple[1]
-          distance = util.get_distance(location, other_item_location)
-          weight = 1 / (1 + (KAPPA * distance * request_count))
-          location = self.interp(weight, location, other_item_location)
-
-        locations_by_uuid[uuid] = location
+  #
+  # Builds the interdependency graph once from the logs and moves all items together on every
+  # iteration. Items without a location are left in place and ignored as neighbors.
+  #
+  # params:
+  #   locations_by_uuid: dictionary mapping uuid -> lat/long tuple or None
+  #   interdependencies: list of (uuid, source_uuid, request count), read from the logs by default
+  def reduce_latency(self, locations_by_uuid, interdependencies = None):
+    if interdependencies is None:
+      interdependencies = self.log_manager.get_interdependencies()
+
+    uuids = sorted([ uuid for uuid, location in locations_by_uuid.iteritems() if location is not None ])
+    item_index = dict((uuid, i) for i, uuid in enumerate(uuids))
+
+    sources = []
+    targets = []
+    counts = []
+    for uuid, other_item_uuid, request_count in interdependencies:
+      if uuid in item_index and other_item_uuid in item_index:
+        sources.extend([item_index[uuid], item_index[other_item_uuid]])
+        targets.extend([item_index[other_item_uuid], item_index[uuid]])
+        counts.extend([request_count, request_count])
+    indptr, indices, counts = spherical.csr_from_edges(sources, targets, counts, len(uuids))
+
+    lats = [ locations_by_uuid[uuid][0] for uuid in uuids ]
+    lngs = [ locations_by_uuid[uuid][1] for uuid in uuids ]
+    lats, lngs, iterations = spherical.reduce_latency(lats, lngs, indptr, indices, counts, KAPPA,
+      INTERDEPENDENCY_ITERATIONS, INTERDEPENDENCY_TOLERANCE)
+    print 'Interdependencies: ' + str(len(indices)) + ' edges, ' + str(iterations) + ' iterations'
+
+    for i, uuid in enumerate(uuids):
+      locations_by_uuid[uuid] = (float(lats[i]), float(lngs[i]))
 
     return locations_by_uuid
 
   # PHASE 3: Iteratively Collapse Data to Datacenters
+  #
+  # Items without a location (no reads) are not placed and stay where they are.
   def collapse_to_datacenters(self, locations_by_uuid):
     placements_by_server = {}
 
     for server in self.servers:
       placements_by_server[server] = []
 
-    for uuid, location in locations_by_uuid.iteritems():
+    located_uuids = [ uuid for uuid, location in locations_by_uuid.iteritems() if location is not None ]
+    file_info_by_uuid = self.get_file_metadata(located_uuids)
+    located_uuids = [ uuid for uuid in located_uuids if uuid in file_info_by_uuid ]
+    read_counts = self.log_manager.successful_read_counts()
+    rankings = self.rank_servers([ locations_by_uuid[uuid] for uuid in located_uuids ])
+
+    for uuid, server_ranking in zip(located_uuids, rankings):
+      location = locations_by_uuid[uuid]
       metadata = {'current_server': None, 'optimal_location': location, 'uuid': uuid, 'dist': None, 'file_size': None, 'request_count': None}
       best_server = None
 
-      # Query any server for metadata - server will update and get information 
-      any_server = util.convert_to_local_hostname(self.servers[0])
-      url = 'http://%s/metadata?%s' % (any_server, urllib.urlencode({ 'uuid': uuid }))
-      print url
-      r = requests.get(url)
-      print r.text
-      response = json.loads(r.text)
-      metadata['current_server'] = response['server']
-      metadata['file_size'] = response['file_size']
-      metadata['request_count'] = self.log_manager.successful_read_count(uuid)
+      file_info = file_info_by_uuid[uuid]
+      metadata['current_server'] = file_info['server']
+      metadata['file_size'] = file_info['file_size']
+      metadata['request_count'] = read_counts.get(uuid, 0)
+      metadata['server_ranking'] = server_ranking
 
-      best_servers = self.find_closest_servers(location)
-      best_server = best_servers[0]
+      best_server = server_ranking[0]
       metadata['dist'] = best_server['distance']
 
       self.uuid_metadata[uuid] = metadata
       placements_by_server[best_server['server']].append(uuid)
 
-    placements_by_server = self.redistribute_server_data_by_capacity(placements_by_server)
+    if self.redistribution_mode == REDISTRIBUTION_REGRET:
+      placements_by_server = self.assign_servers_by_capacity(located_uuids)
+    else:
+      placements_by_server = self.redistribute_server_data_by_capacity(placements_by_server)
 
     return placements_by_server
 
+  # Asks any server for the current location and size of the items, METADATA_BATCH_SIZE items per call
+  #
+  # params:
+  #   uuids: a list of uuids
+  # returns: dictionary mapping uuid -> dict with `server` and `file_size`, items no server stores are left out
+  def get_file_metadata(self, uuids):
+    # Query any server for metadata - server will update and get information
+    any_server = util.convert_to_local_hostname(self.servers[0])
+    url = 'http://%s/metadata/batch' % (any_server,)
+
+    file_info_by_uuid = {}
+    for i in range(0, len(uuids), METADATA_BATCH_SIZE):
+      chunk = uuids[i:i + METADATA_BATCH_SIZE]
+      r = peer_client.post(url, data=json.dumps({ 'uuids': chunk }), headers={ 'Content-Type': 'application/json' }, timeout=METADATA_TIMEOUT)
+      if r.status_code != requests.codes.ok:
+        raise Exception('FAILED: Could not retrieve metadata from <' + any_server + '>, status ' + str(r.status_code))
+      response = json.loads(r.text)
+      for file_info in response['files']:
+        file_info_by_uuid[file_info['uuid']] = file_info
+      for uuid in response['missing']:
+        print 'Metadata for ' + uuid + ' could not be found, leaving it in place'
+      print 'Retrieved metadata for ' + str(min(i + METADATA_BATCH_SIZE, len(uuids))) + '/' + str(len(uuids)) + ' items'
+
+    return file_info_by_uuid
+
   # PHASE 4: Call migration methods on each server
-  def migrate_to_locations(self, placements_by_server):
+  #
+  # params:
+  #   placements_by_server: dictionary mapping server hostname -> set of uuids
+  #   executor: the MigrationExecutor running the transfers, a resumable one by default
+  def migrate_to_locations(self, placements_by_server, executor = None):
+    if executor is None:
+      executor = MigrationExecutor('transfer', journal_file=MIGRATION_JOURNAL)
+
+    tasks = []
     for optimal_server, uuids in placements_by_server.iteritems():
+      # conver to local hostname in case of simulation
+      optimal_server = util.convert_to_local_hostname(optimal_server)
       for uuid in uuids:
-        current_server = self.uuid_metadata[uuid]['current_server']
-
-        # conver to local hostname in case of simulation
-        current_server = util.convert_to_local_hostname(current_server)
-        optimal_server = util.convert_to_local_hostname(optimal_server)
-
+        current_server = util.convert_to_local_hostname(self.uuid_metadata[uuid]['current_server'])
         if current_server != optimal_server:
-          url = 'http://%s/transfer?%s' % (current_server, urllib.urlencode({ 'uuid': uuid, 'destination': optimal_server }))
-          print url
-          r = requests.put(url, timeout=30)
-          if r.status_code == requests.codes.ok:
-            print 'SUCCESS: Migrating ' + uuid + ' from <' + current_server + '> to <' + optimal_server + '>'
-          else:
-            raise Exception('FAILED: Migrating ' + uuid + ' from <' + current_server + '> to <' + optimal_server + '>')
+          tasks.append({ 'uuid': uuid, 'source': current_server, 'destination': optimal_server, 'file_size': self.uuid_metadata[uuid]['file_size'] })
+
+    report = executor.execute(tasks)
+    print 'Migrated ' + str(report['succeeded']) + ' items (' + str(report['bytes_moved']) + ' bytes) in ' + str(report['wall_time']) + ' seconds, ' + \
+      str(report['skipped']) + ' already done, ' + str(len(report['failed'])) + ' failed'
+    if len(report['failed']) > 0:
+      raise Exception('FAILED: ' + str(len(report['failed'])) + ' migrations failed, run again to resume from ' + MIGRATION_JOURNAL)
+    return report
 
 
   # Gets sort key for sort function to sort by ascending request_count
@@ -135,6 +222,18 @@ class Volley:
   def get_distance_key(self, server_dict):
     return server_dict['distance']
 
+  # Returns the lat/long of a server, looking it up in the ip cache only the first time
+  #
+  # params:
+  #   server: ip address of the server
+  def get_server_location(self, server):
+    if server not in self.server_locations:
+      server_lat_lon = self.ip_cache.get_lat_lon_from_ip(server)
+      if server_lat_lon is None:
+        raise ValueError('Server <' + server + '> latitude/longitude could not be found!')
+      self.server_locations[server] = server_lat_lon
+    return self.server_locations[server]
+
   # Finds the closest server for a lat/long tuple pair
   #
   # params:
@@ -145,22 +244,27 @@ class Volley:
     if servers_to_search is None:
       servers_to_search = self.servers
 
-    best_servers = []
-
-    for server in servers_to_search:
-      server_dict = { 'server': server, 'distance': None }
-      item_location = geopy.Point(location[0], location[1])
-      server_lat_lon = self.ip_cache.get_lat_lon_from_ip(server)
-      if server_lat_lon is None:
-        raise ValueError('Server <' + server + '> latitude/longitude could not be found!')
-      server_location = geopy.Point(server_lat_lon[0], server_lat_lon[1])
-      server_dict['distance'] = great_circle(item_location, server_location).km
+    return self.rank_servers([location], servers_to_search)[0]
 
-      best_servers.append(server_dict)
+  # Finds the servers from closest to furthest for many lat/long tuple pairs at once
+  #
+  # params:
+  #   locations: a list of lat/long tuples
+  #   servers_to_search: a list of servers to search. Uses self.servers by default.
+  # returns: a list with, for each location, the list of servers from closest to furthest as in find_closest_servers
+  def rank_servers(self, locations, servers_to_search = None):
+    if servers_to_search is None:
+      servers_to_search = self.servers
+    servers_to_search = list(servers_to_search)
 
-    best_servers.sort(key=self.get_distance_key)
+    server_lat_lons = [ self.get_server_location(server) for server in servers_to_search ]
+    indices, distances = spherical.nearest_servers([ location[0] for location in locations ], [ location[1] for location in locations ],
+      [ lat_lon[0] for lat_lon in server_lat_lons ], [ lat_lon[1] for lat_lon in server_lat_lons ])
 
-    return best_servers
+    rankings = []
+    for i in range(len(locations)):
+      rankings.append([ { 'server': servers_to_search[j], 'distance': float(distance) } for j, distance in zip(indices[i], distances[i]) ])
+    return rankings
 
   # Check capacity of server
   #
@@ -169,9 +273,9 @@ class Volley:
   def total_server_capacity(self, server):
     server = util.convert_to_local_hostname(server)
 
-    url = 'http://%s/capacity?%s' % (server, urllib.urlencode({ 'file_size': 0 }))
-    r = requests.get(url, timeout=30)
-    return float(r.text)
+    url = 'http://%s/capacity' % (server,)
+    r = peer_client.get(url, timeout=30)
+    return float(json.loads(r.text)['total'])
 
   # Check capacity and redistribute data to each server
   #
@@ -205,7 +309,10 @@ class Volley:
       while space_remaining[server] < 0:
         uuid = placements.pop()
         metadata = self.uuid_metadata[uuid]
-        best_servers = self.find_closest_servers(metadata['optimal_location'], servers_with_capacity)
+        if 'server_ranking' in metadata:
+          best_servers = [ server_info for server_info in metadata['server_ranking'] if server_info['server'] in servers_with_capacity ]
+        else:
+          best_servers = self.find_closest_servers(metadata['optimal_location'], servers_with_capacity)
 
         for i, best_server_info in enumerate(best_servers):
           best_server = best_server_info['server']
@@ -222,6 +329,16 @@ class Volley:
 
     return placements_by_server
 
+  # Assign every item to a server by regret, using the server rankings stored in uuid_metadata
+  #
+  # params:
+  #   uuids: the uuids to place
+  def assign_servers_by_capacity(self, uuids):
+    space_remaining = {}
+    for server in self.servers:
+      space_remaining[server] = self.total_server_capacity(server)
+    return placement.assign_by_regret(self.uuid_metadata, uuids, space_remaining)
+
   # Convert from latitude to radians from the North Pole
   def convert_lat_to_radians(self, lat):
     # Subtract 90 to make range [-180, 0], then negate to make it [0, 180]
@@ -304,7 +421,7 @@ class Volley:
 
     return (lat_c, lng_c)
 
-  # Recursive helper for weighted_spherical_mean
+  # Recursive helper for weighted_spherical_mean, kept as the reference for spherical.weighted_spherical_means
   #
   # params:
   #   weights: a list of weights
@@ -355,10 +472,12 @@ class Volley:
 
 if __name__ == '__main__':
   if (len(sys.argv) < 3):
-    print 'Usage: python volley.py 1426809600 1427395218'
+    print 'Usage: python volley.py 1426809600 1427395218 [regret|heuristic]'
     print 'Integers are Unix timestamps for start and end times to retrieve log data'
+    print 'The last argument picks how items are redistributed when servers run out of capacity, regret by default'
     exit(1)
   start_time = sys.argv[1]
   end_time = sys.argv[2]
-  volley = Volley(start_time, end_time)
+  redistribution_mode = sys.argv[3] if len(sys.argv) > 3 else REDISTRIBUTION_HEURISTIC
+  volley = Volley(start_time, end_time, redistribution_mode)
   volley.execute()